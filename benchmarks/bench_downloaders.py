@@ -0,0 +1,126 @@
+"""
+Benchmark the downloaders end to end against a recorded cassette.
+
+First record real traffic once (this talks to the live servers):
+
+    python -m benchmarks.bench_downloaders record --cassette cassettes/live
+
+Then replay it as often as needed through a local stand-in server, optionally
+shaping the network with a fixed per-response latency and a per-connection
+bandwidth cap:
+
+    python -m benchmarks.bench_downloaders replay --cassette cassettes/live \\
+        [--latency-ms 80] [--bandwidth-mbps 50] [--repeat 3]
+
+Each target runs into a fresh temporary output directory, so nothing is reused
+from a previous run. Reported per run: wall time, requests served, requests/s,
+MB served and MB/s. ``download_datasus_data`` includes its OpenAPI step, as it
+does in production.
+
+Requests that are not in the cassette are answered 404 and reported as misses;
+the downloaders retry those with their usual delays, so record with the same
+targets and options that are replayed.
+
+Targets: datasus (download_datasus_data), ibge_agregados
+(download_ibge_agregados), openapi (download_openapi_data), ipea
+(download_ipea_data).
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from datatools.downloaders.cassette import (
+    Cassette,
+    ReplayServer,
+    recording,
+    replaying,
+)
+from datatools.downloaders.datasus import download_datasus_data
+from datatools.downloaders.datasus.openapi import download_openapi_data
+from datatools.downloaders.ibge.agregados import download_ibge_agregados
+from datatools.downloaders.ipea.ipea import download_ipea_data
+
+TARGETS = {
+    "datasus": lambda output_dir: download_datasus_data(output_dir),
+    "ibge_agregados": lambda output_dir: download_ibge_agregados(output_dir, []),
+    "openapi": download_openapi_data,
+    "ipea": download_ipea_data,
+}
+
+
+def run_target(name: str) -> float:
+    """Run one target into a fresh output directory and return wall seconds."""
+    with tempfile.TemporaryDirectory(prefix=f"bench_{name}_") as root:
+        output_dir = os.path.join(root, name, "tmp_bench")
+        os.makedirs(output_dir)
+        start = time.perf_counter()
+        TARGETS[name](output_dir)
+        return time.perf_counter() - start
+
+
+def record(args) -> None:
+    with recording(args.cassette) as cassette:
+        for name in args.targets:
+            wall = run_target(name)
+            print(f"recorded {name} in {wall:.1f}s")
+    print(f"{len(cassette)} interactions in {args.cassette}")
+
+
+def replay(args) -> None:
+    cassette = Cassette(args.cassette)
+    if not len(cassette):
+        raise SystemExit(f"No recorded interactions in {args.cassette}")
+
+    bandwidth = args.bandwidth_mbps * 1e6 / 8 if args.bandwidth_mbps else None
+    print(
+        f"{'target':<15} {'run':>3} {'wall s':>8} {'requests':>9} "
+        f"{'req/s':>8} {'MB':>9} {'MB/s':>8} {'misses':>7}"
+    )
+    with ReplayServer(cassette, args.latency_ms / 1000, bandwidth) as server:
+        with replaying(server):
+            for name in args.targets:
+                for run in range(1, args.repeat + 1):
+                    server.reset_stats()
+                    wall = run_target(name)
+                    stats = server.stats
+                    megabytes = stats.bytes_sent / 1e6
+                    print(
+                        f"{name:<15} {run:>3} {wall:>8.2f} {stats.requests:>9} "
+                        f"{stats.requests / wall:>8.1f} {megabytes:>9.2f} "
+                        f"{megabytes / wall:>8.2f} {stats.misses:>7}"
+                    )
+                    for url in stats.missed_urls[: args.show_misses]:
+                        print(f"  missed {url}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("mode", choices=["record", "replay"])
+    parser.add_argument("--cassette", required=True, help="Cassette directory")
+    parser.add_argument(
+        "--targets",
+        nargs="+",
+        choices=list(TARGETS),
+        default=list(TARGETS),
+    )
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument(
+        "--bandwidth-mbps",
+        type=float,
+        default=0.0,
+        help="Per-connection bandwidth cap in megabits/s (0: unlimited)",
+    )
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--show-misses", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.mode == "record":
+        record(args)
+    else:
+        replay(args)
+
+
+if __name__ == "__main__":
+    main()
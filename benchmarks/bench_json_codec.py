@@ -0,0 +1,100 @@
+"""
+Benchmark the DATASUS JSON codecs on a synthetic OpenAPI endpoint file.
+
+Builds a CNES-like endpoint with ``--records`` records and times a full
+encode + decode of it in the legacy single-document layout
+(``{"metadata": ..., "data": [...]}``) and in the NDJSON layout. json5 is
+timed on a ``--json5-sample`` subset and extrapolated, because a full
+1M-record run with it takes a very long time.
+
+Usage:
+    python -m benchmarks.bench_json_codec [--records 1000000] [--json5-sample 20000]
+"""
+
+import argparse
+import random
+import time
+
+from datatools.downloaders.datasus import codec
+
+
+def synthetic_records(count: int, seed: int = 42) -> list[dict]:
+    rng = random.Random(seed)
+    ufs = ["SP", "RJ", "MG", "BA", "RS", "PR", "PE", "CE", "PA", "SC"]
+    return [
+        {
+            "codigo_cnes": 2000000 + i,
+            "numero_cnpj_entidade": f"{rng.randrange(10**13, 10**14)}",
+            "nome_razao_social": f"ESTABELECIMENTO DE SAÚDE {i}",
+            "nome_fantasia": f"UNIDADE BÁSICA {i % 977}",
+            "codigo_uf": rng.randrange(11, 54),
+            "sigla_uf": rng.choice(ufs),
+            "codigo_municipio": rng.randrange(110000, 530000),
+            "latitude_estabelecimento_decimo_grau": round(rng.uniform(-33, 5), 6),
+            "longitude_estabelecimento_decimo_grau": round(rng.uniform(-73, -34), 6),
+            "estabelecimento_possui_centro_cirurgico": rng.random() < 0.1,
+            "data_atualizacao": "2024-05-01",
+        }
+        for i in range(count)
+    ]
+
+
+def time_call(fn) -> tuple[float, object]:
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+
+def bench_document(name: str, records: list[dict]) -> tuple[float, float, int]:
+    json_codec = codec.get_codec(name)
+    document = {"metadata": {"status": "complete"}, "data": records}
+    encode_s, encoded = time_call(lambda: json_codec.dumps(document))
+    decode_s, _ = time_call(lambda: json_codec.loads(encoded))
+    return encode_s, decode_s, len(encoded)
+
+
+def bench_ndjson(name: str, records: list[dict]) -> tuple[float, float, int]:
+    json_codec = codec.get_codec(name)
+    encode_s, lines = time_call(lambda: [json_codec.dumps(r) for r in records])
+    decode_s, _ = time_call(lambda: [json_codec.loads(line) for line in lines])
+    return encode_s, decode_s, sum(len(line) + 1 for line in lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--records", type=int, default=1_000_000)
+    parser.add_argument("--json5-sample", type=int, default=20_000)
+    args = parser.parse_args()
+
+    print(f"Generating {args.records} synthetic records...")
+    records = synthetic_records(args.records)
+
+    print(f"{'codec':<8} {'layout':<9} {'encode s':>10} {'decode s':>10} {'MB':>8}")
+    baseline = {}
+    for name in codec.CODECS:
+        sample = records
+        scale = 1.0
+        if name == "json5" and args.json5_sample < args.records:
+            sample = records[: args.json5_sample]
+            scale = args.records / args.json5_sample
+
+        for layout, bench in (("document", bench_document), ("ndjson", bench_ndjson)):
+            encode_s, decode_s, size = bench(name, sample)
+            encode_s, decode_s, size = encode_s * scale, decode_s * scale, size * scale
+            note = " (extrapolated)" if scale != 1.0 else ""
+            total = encode_s + decode_s
+            baseline.setdefault(layout, {})[name] = total
+            print(
+                f"{name:<8} {layout:<9} {encode_s:>10.2f} {decode_s:>10.2f} "
+                f"{size / 1e6:>8.1f}{note}"
+            )
+
+    print()
+    for layout, totals in baseline.items():
+        slowest = totals["json5"]
+        for name, total in totals.items():
+            print(f"{layout:<9} {name:<8} speedup over json5: {slowest / total:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
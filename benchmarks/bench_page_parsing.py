@@ -0,0 +1,160 @@
+"""
+Benchmark DATASUS page parsing on the fixture pages in fixtures/datasus.
+
+Compares the previous approach (a full ``BeautifulSoup(..., "html.parser")``
+tree kept by the caller and queried with find/select) against the lxml
+extractors in ``datatools.downloaders.datasus.pages``, reporting per page:
+
+- CPU time per parse (``time.process_time``, averaged over ``--iterations``)
+- peak memory allocated while parsing (tracemalloc; this only sees Python
+  allocations, so lxml's short-lived C tree is not counted in its peak)
+- memory still held by the result the crawler keeps around
+
+The fixtures are CKAN 2.9 pages shaped like opendatasus.saude.gov.br
+(header, facets, listing, resources, footer). Both parsers must extract the
+same values; the benchmark checks that before timing them.
+
+Usage:
+    python -m benchmarks.bench_page_parsing [--iterations 200]
+"""
+
+import argparse
+import gc
+import os
+import time
+import tracemalloc
+
+from bs4 import BeautifulSoup
+
+from datatools.downloaders.datasus import pages
+from datatools.downloaders.datasus.http_client import clean_filename
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures", "datasus")
+
+
+def soup(content: bytes) -> BeautifulSoup:
+    return BeautifulSoup(content, "html.parser")
+
+
+# What the crawler used to extract from each soup, for the equivalence check.
+# Titles are compared as the crawler uses them, through clean_filename, since
+# the two parsers keep different insignificant whitespace.
+def legacy_listing(page: BeautifulSoup):
+    links = []
+    for item in page.find_all("li", class_="dataset-item"):
+        link = item.find("h2", class_="dataset-heading").find("a")
+        links.append((clean_filename(link.text), link["href"]))
+    return links, len(page.find_all("li", class_="page-item"))
+
+
+def legacy_dataset(page: BeautifulSoup):
+    resources = []
+    for item in page.find_all("li", class_="resource-item"):
+        link = item.find("a")
+        resources.append(
+            (clean_filename(link.text), link.find("span").text, link["href"])
+        )
+    return resources
+
+
+def legacy_resource(page: BeautifulSoup):
+    download = page.find("div", class_="btn-group").find("a")
+    content = page.select_one("div.row.wrapper > section > div > p > a")
+    texts = [p.get_text() for p in page.find_all("p")]
+    username = next(t.split("Usuário:")[1].strip() for t in texts if "Usuário:" in t)
+    password = next(t.split("Senha:")[1].strip() for t in texts if "Senha:" in t)
+    return download["href"], content["href"], username, password
+
+
+def legacy_api(page: BeautifulSoup):
+    for script in page.find_all("script"):
+        if script.string and "var user_config" in script.string:
+            line = script.string.split('"url": "')[1]
+            return line.split('"')[0]
+
+
+def lxml_listing(result):
+    datasets = [(clean_filename(d.title), d.href) for d in result.datasets]
+    return datasets, result.page_count
+
+
+def lxml_dataset(result):
+    return [(clean_filename(r.title), r.format, r.href) for r in result.resources]
+
+
+def lxml_resource(result):
+    return (result.download_href, result.content_href, result.username, result.password)
+
+
+def lxml_api(result):
+    return result.api_path
+
+
+CASES = [
+    ("listing", pages.parse_listing_page, legacy_listing, lxml_listing),
+    ("dataset", pages.parse_dataset_page, legacy_dataset, lxml_dataset),
+    ("resource", pages.parse_resource_page, legacy_resource, lxml_resource),
+    ("api", pages.parse_api_config_page, legacy_api, lxml_api),
+]
+
+
+def cpu_ms(fn, content: bytes, iterations: int) -> float:
+    gc.collect()
+    start = time.process_time()
+    for _ in range(iterations):
+        fn(content)
+    return (time.process_time() - start) * 1000 / iterations
+
+
+def memory_kb(fn, content: bytes) -> tuple[float, float]:
+    """Peak KB allocated while parsing, and KB still held by the result."""
+    gc.collect()
+    tracemalloc.start()
+    result = fn(content)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return peak / 1024, retained / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+
+    header = (
+        f"{'page':<9} {'KB':>5} {'parser':<6} {'CPU ms':>8} "
+        f"{'peak KB':>9} {'kept KB':>9}"
+    )
+    print(header)
+    for name, parse, legacy_extract, lxml_extract in CASES:
+        with open(os.path.join(FIXTURES, f"{name}.html"), "rb") as f:
+            content = f.read()
+
+        if legacy_extract(soup(content)) != lxml_extract(parse(content)):
+            raise SystemExit(f"{name}: lxml extraction differs from BeautifulSoup")
+
+        rows = {}
+        for label, fn in (("bs4", soup), ("lxml", parse)):
+            rows[label] = (
+                cpu_ms(fn, content, args.iterations),
+                *memory_kb(fn, content),
+            )
+            cpu, peak, kept = rows[label]
+            print(
+                f"{name:<9} {len(content) / 1024:>5.0f} {label:<6} {cpu:>8.2f} "
+                f"{peak:>9.0f} {kept:>9.1f}"
+            )
+
+        (bs4_cpu, bs4_peak, bs4_kept), (lxml_cpu, lxml_peak, lxml_kept) = (
+            rows["bs4"],
+            rows["lxml"],
+        )
+        print(
+            f"{name:<9} {'':>5} {'gain':<6} {bs4_cpu / lxml_cpu:>7.1f}x "
+            f"{bs4_peak / lxml_peak:>8.1f}x {bs4_kept / max(lxml_kept, 0.1):>8.0f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
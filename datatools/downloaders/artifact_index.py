@@ -0,0 +1,364 @@
+"""
+Persistent index of downloaded artifacts, shared by every run of a source.
+
+The index lives in ``output/downloader/<source>/.artifacts.sqlite`` and maps
+each file of each run (``tmp_<uuid>`` while downloading, ``YYYYMMDD_HHMMSS``
+afterwards) to its source URL, size, content hash, HTTP validators and
+completion status. Resume checks become indexed queries instead of scanning
+every historical run directory, and files are reused across runs by reflink or
+hard link instead of being copied.
+
+The index uses WAL, except while a shared run downloads into the source
+directory: its processes may be on several hosts, which WAL's shared memory
+does not reach, so the index switches to a rollback journal like the work
+queue's.
+"""
+
+import errno
+import fcntl
+import logging
+import os
+import shutil
+import sqlite3
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Callable, Iterable, Optional
+
+from .work_queue import shared_run_active
+
+logger = logging.getLogger("downloader:artifacts")
+
+INDEX_FILENAME = ".artifacts.sqlite"
+
+# Linux ioctl for copy-on-write clones (btrfs, xfs, overlayfs on those...)
+FICLONE = 0x40049409
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS artifacts (
+    run TEXT NOT NULL,
+    relpath TEXT NOT NULL,
+    url TEXT,
+    size INTEGER,
+    content_hash TEXT,
+    etag TEXT,
+    last_modified TEXT,
+    status TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    PRIMARY KEY (run, relpath)
+);
+CREATE INDEX IF NOT EXISTS artifacts_relpath ON artifacts (relpath, status);
+CREATE INDEX IF NOT EXISTS artifacts_url ON artifacts (url);
+CREATE INDEX IF NOT EXISTS artifacts_hash ON artifacts (content_hash, size);
+CREATE TABLE IF NOT EXISTS index_state (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+
+@dataclass
+class Artifact:
+    run: str
+    relpath: str
+    url: Optional[str]
+    size: Optional[int]
+    content_hash: Optional[str]
+    etag: Optional[str]
+    last_modified: Optional[str]
+    status: str
+
+
+def clone_file(source: str, destination: str) -> str:
+    """
+    Make ``destination`` a copy of ``source`` as cheaply as the filesystem
+    allows: a copy-on-write reflink, then a hard link, then a real copy.
+    Returns the method used.
+    """
+    os.makedirs(os.path.dirname(destination) or ".", exist_ok=True)
+    try:
+        with open(source, "rb") as src, open(destination, "wb") as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        shutil.copystat(source, destination)
+        return "reflink"
+    except OSError as e:
+        if os.path.exists(destination):
+            os.remove(destination)
+        if e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL):
+            raise
+
+    try:
+        os.link(source, destination)
+        return "hardlink"
+    except OSError:
+        shutil.copy2(source, destination)
+        return "copy"
+
+
+class ArtifactIndex:
+    """SQLite-backed index of the artifacts under one source directory."""
+
+    def __init__(self, source_dir: str):
+        self.source_dir = source_dir
+        os.makedirs(source_dir, exist_ok=True)
+        self.path = os.path.join(source_dir, INDEX_FILENAME)
+        self._conn = sqlite3.connect(self.path, timeout=30)
+        self._set_journal_mode("DELETE" if shared_run_active(source_dir) else "WAL")
+        self._conn.executescript(SCHEMA)
+        self._conn.commit()
+
+    def _set_journal_mode(self, mode: str) -> None:
+        current = self._conn.execute(f"PRAGMA journal_mode={mode}").fetchone()[0]
+        if current.upper() != mode:
+            # Leaving WAL needs the database to itself
+            logger.warning(f"Index {self.path} stays in {current} mode, not {mode}")
+        if current.upper() == "WAL":
+            # Durable enough with WAL, which fsyncs at checkpoints
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+
+    def close(self) -> None:
+        self._conn.close()
+
+    def __enter__(self) -> "ArtifactIndex":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def absolute_path(self, artifact: Artifact) -> str:
+        return os.path.join(self.source_dir, artifact.run, artifact.relpath)
+
+    def locate(self, path: str) -> tuple[str, str]:
+        """Split a path under the source directory into (run, relpath)."""
+        relative = os.path.relpath(
+            os.path.abspath(path), os.path.abspath(self.source_dir)
+        )
+        run, _, relpath = relative.partition(os.sep)
+        if not relpath or run == os.pardir:
+            raise ValueError(f"{path} is not inside a run of {self.source_dir}")
+        return run, relpath.replace(os.sep, "/")
+
+    def record(
+        self,
+        run: str,
+        relpath: str,
+        status: str = "complete",
+        url: Optional[str] = None,
+        size: Optional[int] = None,
+        content_hash: Optional[str] = None,
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+    ) -> None:
+        self._conn.execute(
+            """
+            INSERT INTO artifacts (run, relpath, url, size, content_hash, etag,
+                                   last_modified, status, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (run, relpath) DO UPDATE SET
+                url = excluded.url,
+                size = excluded.size,
+                content_hash = excluded.content_hash,
+                etag = excluded.etag,
+                last_modified = excluded.last_modified,
+                status = excluded.status,
+                updated_at = excluded.updated_at
+            """,
+            (
+                run,
+                relpath,
+                url,
+                size,
+                content_hash,
+                etag,
+                last_modified,
+                status,
+                datetime.now().isoformat(),
+            ),
+        )
+        self._conn.commit()
+
+    def record_file(self, path: str, **fields) -> tuple[str, str]:
+        """Index a finished file by its path; size defaults to the file's size."""
+        run, relpath = self.locate(path)
+        fields.setdefault("size", os.path.getsize(path))
+        self.record(run, relpath, **fields)
+        return run, relpath
+
+    def _rows(self, query: str, params: tuple) -> list[Artifact]:
+        return [Artifact(*row) for row in self._conn.execute(query, params)]
+
+    def _select(self, where: str) -> str:
+        return (
+            "SELECT run, relpath, url, size, content_hash, etag, last_modified, "
+            f"status FROM artifacts WHERE {where} ORDER BY run DESC"
+        )
+
+    def _alive(self, artifacts: Iterable[Artifact]) -> list[Artifact]:
+        """Drop rows whose file was deleted or changed size since indexing."""
+        alive = []
+        for artifact in artifacts:
+            path = self.absolute_path(artifact)
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                size = None
+            if size is not None and artifact.size in (None, size):
+                alive.append(artifact)
+            else:
+                self.forget(artifact.run, artifact.relpath)
+        return alive
+
+    def find(self, relpath: str, status: Optional[str] = "complete") -> list[Artifact]:
+        """Artifacts stored under ``relpath`` in any run, newest run first."""
+        if status is None:
+            rows = self._rows(self._select("relpath = ?"), (relpath,))
+        else:
+            rows = self._rows(
+                self._select("relpath = ? AND status = ?"), (relpath, status)
+            )
+        return self._alive(rows)
+
+    def find_previous(self, relpath: str, current_run: str) -> Optional[Artifact]:
+        """Newest complete copy of ``relpath`` from a finished earlier run."""
+        for artifact in self.find(relpath):
+            if artifact.run != current_run and not artifact.run.startswith("tmp_"):
+                return artifact
+        return None
+
+    def previous_of(self, path: str) -> Optional[Artifact]:
+        """Newest complete copy, from an earlier run, of the file at ``path``."""
+        run, relpath = self.locate(path)
+        return self.find_previous(relpath, run)
+
+    def find_prefix(self, prefix: str) -> list[Artifact]:
+        """Artifacts whose relpath starts with ``prefix`` (indexed range scan)."""
+        upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        rows = self._rows(self._select("relpath >= ? AND relpath < ?"), (prefix, upper))
+        return self._alive(rows)
+
+    def find_by_url(self, url: str) -> list[Artifact]:
+        return self._alive(self._rows(self._select("url = ?"), (url,)))
+
+    def find_by_hash(self, content_hash: str, size: int) -> list[Artifact]:
+        rows = self._rows(
+            self._select("content_hash = ? AND size = ? AND status = 'complete'"),
+            (content_hash, size),
+        )
+        return self._alive(rows)
+
+    def find_run(self, run: str) -> list[Artifact]:
+        """Every artifact indexed for ``run``, whatever its status."""
+        return self._rows(self._select("run = ?"), (run,))
+
+    def update(self, run: str, relpath: str, **fields) -> None:
+        """Change some columns (e.g. status, content_hash) of one artifact."""
+        assignments = "".join(f"{column} = ?, " for column in fields)
+        self._conn.execute(
+            f"UPDATE artifacts SET {assignments}updated_at = ? "
+            "WHERE run = ? AND relpath = ?",
+            (*fields.values(), datetime.now().isoformat(), run, relpath),
+        )
+        self._conn.commit()
+
+    def forget(self, run: str, relpath: str) -> None:
+        self._conn.execute(
+            "DELETE FROM artifacts WHERE run = ? AND relpath = ?", (run, relpath)
+        )
+        self._conn.commit()
+
+    def rename_run(self, old_run: str, new_run: str) -> None:
+        """Re-key a run after its directory was moved (tmp_<uuid> -> timestamp)."""
+        self._conn.execute(
+            "UPDATE artifacts SET run = ? WHERE run = ?", (new_run, old_run)
+        )
+        self._conn.commit()
+
+    def reuse(self, artifact: Artifact, run: str, relpath: str) -> str:
+        """
+        Materialise ``artifact`` as ``relpath`` of ``run`` without copying data
+        where possible, index it there and return the new absolute path.
+        """
+        destination = os.path.join(self.source_dir, run, relpath)
+        method = clone_file(self.absolute_path(artifact), destination)
+        logger.debug(f"Reused {artifact.run}/{artifact.relpath} via {method}")
+        self.record(
+            run,
+            relpath,
+            status=artifact.status,
+            url=artifact.url,
+            size=artifact.size,
+            content_hash=artifact.content_hash,
+            etag=artifact.etag,
+            last_modified=artifact.last_modified,
+        )
+        return destination
+
+    def deduplicate(self, run: str, relpath: str) -> Optional[str]:
+        """
+        If an identical file (same hash and size) already exists in another
+        run, replace the freshly written copy with a link to it.
+        Returns the reuse method, or None if nothing was deduplicated.
+        """
+        (current,) = self._rows(
+            self._select("run = ? AND relpath = ?"), (run, relpath)
+        ) or (None,)
+        if current is None or not current.content_hash:
+            return None
+
+        for twin in self.find_by_hash(current.content_hash, current.size):
+            if twin.run == run and twin.relpath == relpath:
+                continue
+            path = os.path.join(self.source_dir, run, relpath)
+            tmp_path = path + ".dedup"
+            try:
+                method = clone_file(self.absolute_path(twin), tmp_path)
+                if method == "copy":
+                    # A plain copy saves nothing
+                    os.remove(tmp_path)
+                    return None
+                os.replace(tmp_path, path)
+                return method
+            except OSError as e:
+                logger.debug(f"Could not deduplicate {path}: {e}")
+                return None
+        return None
+
+    def is_backfilled(self) -> bool:
+        row = self._conn.execute(
+            "SELECT value FROM index_state WHERE key = 'backfilled'"
+        ).fetchone()
+        return row is not None
+
+    def backfill(
+        self,
+        runs: Iterable[str],
+        list_files: Callable[[str], Iterable[str]],
+        status_of: Callable[[str], str],
+    ) -> int:
+        """
+        Index artifacts of runs that were downloaded before the index existed.
+        This is the only full scan of the source directory, done once.
+        """
+        count = 0
+        for run in runs:
+            run_dir = os.path.join(self.source_dir, run)
+            for relpath in list_files(run_dir):
+                path = os.path.join(run_dir, relpath)
+                self._conn.execute(
+                    """
+                    INSERT OR IGNORE INTO artifacts (run, relpath, size, status,
+                                                     updated_at)
+                    VALUES (?, ?, ?, ?, ?)
+                    """,
+                    (
+                        run,
+                        relpath,
+                        os.path.getsize(path),
+                        status_of(path),
+                        datetime.now().isoformat(),
+                    ),
+                )
+                count += 1
+        self._conn.execute(
+            "INSERT OR REPLACE INTO index_state (key, value) VALUES ('backfilled', ?)",
+            (datetime.now().isoformat(),),
+        )
+        self._conn.commit()
+        logger.info(f"Indexed {count} artifacts from previous runs")
+        return count
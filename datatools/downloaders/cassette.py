@@ -0,0 +1,453 @@
+"""
+Record/replay of HTTP traffic for offline, deterministic downloader runs.
+
+``recording(path)`` captures every response the downloaders receive, through
+httpx (DATASUS, OpenAPI, IBGE agregados, IPEA) or requests (IBGE localidades),
+into a cassette directory:
+
+    <path>/interactions.ndjson   one JSON line per request/response
+    <path>/bodies/<sha256>       response bodies, stored once per content
+
+``ReplayServer`` serves a cassette from a local HTTP server with configurable
+latency and bandwidth, and ``replaying(server)`` routes both HTTP stacks to it,
+so a downloader runs unchanged against a stand-in for the government servers.
+
+Bodies are stored decoded (without Content-Encoding). While recording,
+conditional request headers are dropped so every resource is captured in full;
+the replay server answers Range and conditional requests from the full body.
+Partial (206) and server error (5xx) responses are not recorded.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+
+logger = logging.getLogger("downloader:cassette")
+
+INTERACTIONS_FILENAME = "interactions.ndjson"
+BODIES_DIRNAME = "bodies"
+CHUNK_SIZE = 64 * 1024
+
+# Headers describing one transfer rather than the resource itself
+TRANSFER_HEADERS = {
+    "connection",
+    "content-encoding",
+    "content-length",
+    "keep-alive",
+    "transfer-encoding",
+}
+CONDITIONAL_HEADERS = ("If-None-Match", "If-Modified-Since")
+# Sent by the replay server itself
+SERVER_HEADERS = {"date", "server"}
+
+
+@dataclass
+class Interaction:
+    method: str
+    url: str
+    status: int
+    headers: List[Tuple[str, str]]
+    body: str
+    size: int
+
+
+class Cassette:
+    """A directory of recorded interactions, keyed by method and URL."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.bodies_dir = os.path.join(path, BODIES_DIRNAME)
+        self.index_path = os.path.join(path, INTERACTIONS_FILENAME)
+        self.interactions: Dict[Tuple[str, str], Interaction] = {}
+        self._lock = threading.Lock()
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "rb") as f:
+                for line in f:
+                    interaction = Interaction(**json.loads(line))
+                    interaction.headers = [tuple(h) for h in interaction.headers]
+                    # Later recordings of the same request win
+                    self.interactions[(interaction.method, interaction.url)] = (
+                        interaction
+                    )
+
+    def __len__(self) -> int:
+        return len(self.interactions)
+
+    def body_path(self, digest: str) -> str:
+        return os.path.join(self.bodies_dir, digest)
+
+    def find(self, method: str, url: str) -> Optional[Interaction]:
+        interaction = self.interactions.get((method, url))
+        if interaction is None and method == "HEAD":
+            interaction = self.interactions.get(("GET", url))
+        return interaction
+
+    def body_writer(self) -> "BodyWriter":
+        return BodyWriter(self)
+
+    def write_body(self, content: bytes) -> Tuple[str, int]:
+        writer = self.body_writer()
+        writer.write(content)
+        return writer.commit()
+
+    def add(
+        self,
+        method: str,
+        url: str,
+        status: int,
+        headers: List[Tuple[str, str]],
+        digest: str,
+        size: int,
+    ) -> Interaction:
+        interaction = Interaction(
+            method=method,
+            url=url,
+            status=status,
+            headers=[(k, v) for k, v in headers if k.lower() not in TRANSFER_HEADERS],
+            body=digest,
+            size=size,
+        )
+        with self._lock:
+            os.makedirs(self.path, exist_ok=True)
+            with open(self.index_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(asdict(interaction), ensure_ascii=False) + "\n")
+            self.interactions[(method, url)] = interaction
+        return interaction
+
+
+class BodyWriter:
+    """Streams a body into the cassette, stored under its SHA-256."""
+
+    def __init__(self, cassette: Cassette):
+        os.makedirs(cassette.bodies_dir, exist_ok=True)
+        self.cassette = cassette
+        self.size = 0
+        self._hasher = hashlib.sha256()
+        self._tmp_path = os.path.join(
+            cassette.bodies_dir, f".tmp-{threading.get_ident()}-{time.monotonic_ns()}"
+        )
+        self._file = open(self._tmp_path, "wb")
+
+    def write(self, chunk: bytes) -> None:
+        self._file.write(chunk)
+        self._hasher.update(chunk)
+        self.size += len(chunk)
+
+    def commit(self) -> Tuple[str, int]:
+        """Close the body and return (digest, size)."""
+        self._file.close()
+        digest = self._hasher.hexdigest()
+        os.replace(self._tmp_path, self.cassette.body_path(digest))
+        return digest, self.size
+
+    def discard(self) -> None:
+        self._file.close()
+        os.unlink(self._tmp_path)
+
+
+def should_record(status: int) -> bool:
+    return status != 206 and status != 304 and status < 500
+
+
+class _BodyFileStream(httpx.AsyncByteStream):
+    def __init__(self, path: str):
+        self.path = path
+
+    async def __aiter__(self):
+        with open(self.path, "rb") as f:
+            while chunk := f.read(CHUNK_SIZE):
+                yield chunk
+
+
+@contextmanager
+def _restoring(target, name: str):
+    """Yield target.name and put it back on exit, however it was replaced."""
+    original = getattr(target, name)
+    try:
+        yield original
+    finally:
+        setattr(target, name, original)
+
+
+@contextmanager
+def recording(path: str) -> Iterator[Cassette]:
+    """Record all httpx (async) and requests traffic into the cassette at path."""
+    cassette = Cassette(path)
+
+    with (
+        _restoring(httpx.AsyncHTTPTransport, "handle_async_request") as (
+            original_httpx
+        ),
+        _restoring(requests.adapters.HTTPAdapter, "send") as original_send,
+    ):
+
+        async def record_httpx(transport, request: httpx.Request) -> httpx.Response:
+            for header in CONDITIONAL_HEADERS:
+                request.headers.pop(header, None)
+            response = await original_httpx(transport, request)
+            if not should_record(response.status_code):
+                return response
+
+            writer = cassette.body_writer()
+            try:
+                async for chunk in response.aiter_bytes():
+                    writer.write(chunk)
+            except BaseException:
+                writer.discard()
+                raise
+            finally:
+                await response.aclose()
+            digest, size = writer.commit()
+            interaction = cassette.add(
+                request.method,
+                str(request.url),
+                response.status_code,
+                list(response.headers.multi_items()),
+                digest,
+                size,
+            )
+            return httpx.Response(
+                response.status_code,
+                headers=interaction.headers + [("Content-Length", str(size))],
+                stream=_BodyFileStream(cassette.body_path(digest)),
+                request=request,
+            )
+
+        def record_requests(adapter, request, *args, **kwargs):
+            for header in CONDITIONAL_HEADERS:
+                request.headers.pop(header, None)
+            response = original_send(adapter, request, *args, **kwargs)
+            if should_record(response.status_code):
+                digest, size = cassette.write_body(response.content)
+                cassette.add(
+                    request.method,
+                    request.url,
+                    response.status_code,
+                    list(response.headers.items()),
+                    digest,
+                    size,
+                )
+            return response
+
+        httpx.AsyncHTTPTransport.handle_async_request = record_httpx
+        requests.adapters.HTTPAdapter.send = record_requests
+        logger.info(f"Recording HTTP traffic into {path}")
+        yield cassette
+
+    logger.info(f"Recorded {len(cassette)} interactions into {path}")
+
+
+def rewrite_url(base_url: str, url: str) -> str:
+    """Map https://host/path?q to <base_url>/https/host/path?q."""
+    parts = urlsplit(url)
+    query = f"?{parts.query}" if parts.query else ""
+    return f"{base_url}/{parts.scheme}/{parts.netloc}{parts.path or '/'}{query}"
+
+
+def original_url(path: str) -> Optional[str]:
+    """Inverse of rewrite_url for the request path seen by the server."""
+    scheme, _, rest = path.lstrip("/").partition("/")
+    netloc, _, tail = rest.partition("/")
+    if scheme not in ("http", "https") or not netloc:
+        return None
+    return f"{scheme}://{netloc}/{tail}"
+
+
+@contextmanager
+def replaying(server: "ReplayServer") -> Iterator["ReplayServer"]:
+    """Send all httpx (async) and requests traffic to a running ReplayServer."""
+    base_url = server.base_url
+
+    with (
+        _restoring(httpx.AsyncHTTPTransport, "handle_async_request") as (
+            original_httpx
+        ),
+        _restoring(requests.adapters.HTTPAdapter, "send") as original_send,
+    ):
+
+        async def replay_httpx(transport, request: httpx.Request) -> httpx.Response:
+            request.url = httpx.URL(rewrite_url(base_url, str(request.url)))
+            return await original_httpx(transport, request)
+
+        def replay_requests(adapter, request, *args, **kwargs):
+            request.url = rewrite_url(base_url, request.url)
+            kwargs.pop("proxies", None)
+            return original_send(adapter, request, *args, **kwargs)
+
+        httpx.AsyncHTTPTransport.handle_async_request = replay_httpx
+        requests.adapters.HTTPAdapter.send = replay_requests
+        yield server
+
+
+@dataclass
+class ReplayStats:
+    requests: int = 0
+    bytes_sent: int = 0
+    misses: int = 0
+    missed_urls: List[str] = field(default_factory=list)
+
+
+class _ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def replay(self) -> "ReplayServer":
+        return self.server.replay
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def do_GET(self):
+        self._replay(send_body=True)
+
+    def do_HEAD(self):
+        self._replay(send_body=False)
+
+    def _replay(self, send_body: bool) -> None:
+        if self.replay.latency:
+            time.sleep(self.replay.latency)
+
+        url = original_url(self.path)
+        interaction = url and self.replay.cassette.find(self.command, url)
+        if not interaction:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            self.replay.count(missed_url=url or self.path)
+            return
+
+        status, start, end = self._select_range(interaction)
+        self.send_response(status)
+        for name, value in interaction.headers:
+            if name.lower() not in SERVER_HEADERS:
+                self.send_header(name, value)
+        if interaction.status == 200:
+            self.send_header("Accept-Ranges", "bytes")
+        if status == 206:
+            self.send_header(
+                "Content-Range", f"bytes {start}-{end - 1}/{interaction.size}"
+            )
+        self.send_header("Content-Length", str(end - start))
+        self.end_headers()
+
+        sent = 0
+        if send_body and end > start:
+            sent = self._send_body(interaction, start, end - start)
+        self.replay.count(sent)
+
+    def _is_not_modified(self, interaction: Interaction) -> bool:
+        headers = {k.lower(): v for k, v in interaction.headers}
+        etag = self.headers.get("If-None-Match")
+        if etag and etag == headers.get("etag"):
+            return True
+        modified_since = self.headers.get("If-Modified-Since")
+        return bool(modified_since and modified_since == headers.get("last-modified"))
+
+    def _select_range(self, interaction: Interaction) -> Tuple[int, int, int]:
+        """Status and [start, end) byte range answering this request."""
+        size = interaction.size
+        if interaction.status != 200:
+            return interaction.status, 0, size
+        if self._is_not_modified(interaction):
+            return 304, 0, 0
+
+        byte_range = self.headers.get("Range", "")
+        if byte_range.startswith("bytes="):
+            first, _, last = byte_range[len("bytes=") :].partition("-")
+            if first.isdigit() and int(first) < size:
+                end = int(last) + 1 if last.isdigit() else size
+                return 206, int(first), min(end, size)
+        return 200, 0, size
+
+    def _send_body(self, interaction: Interaction, start: int, length: int) -> int:
+        bandwidth = self.replay.bandwidth
+        sent = 0
+        began = time.monotonic()
+        try:
+            with open(self.replay.cassette.body_path(interaction.body), "rb") as f:
+                f.seek(start)
+                while sent < length:
+                    chunk = f.read(min(CHUNK_SIZE, length - sent))
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+                    sent += len(chunk)
+                    if bandwidth:
+                        # Sleep off whatever we are ahead of the allowed rate
+                        ahead = sent / bandwidth - (time.monotonic() - began)
+                        if ahead > 0:
+                            time.sleep(ahead)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        return sent
+
+
+class ReplayServer:
+    """
+    Local stand-in server for a cassette.
+
+    ``latency`` (seconds) is added before every response and ``bandwidth``
+    (bytes per second, per connection) caps how fast bodies are sent.
+    """
+
+    def __init__(
+        self,
+        cassette: Cassette,
+        latency: float = 0.0,
+        bandwidth: Optional[float] = None,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ):
+        self.cassette = cassette
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.stats = ReplayStats()
+        self._stats_lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), _ReplayHandler)
+        self._server.daemon_threads = True
+        self._server.replay = self
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "ReplayServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        logger.info(f"Replaying {len(self.cassette)} interactions at {self.base_url}")
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "ReplayServer":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    def reset_stats(self) -> None:
+        with self._stats_lock:
+            self.stats = ReplayStats()
+
+    def count(self, sent: int = 0, missed_url: Optional[str] = None) -> None:
+        with self._stats_lock:
+            self.stats.requests += 1
+            self.stats.bytes_sent += sent
+            if missed_url is not None:
+                self.stats.misses += 1
+                self.stats.missed_urls.append(missed_url)
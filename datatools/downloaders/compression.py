@@ -0,0 +1,114 @@
+"""
+Transparent zstd compression of raw downloaded artifacts.
+
+Raw JSON payloads (DATASUS OpenAPI endpoints, IBGE agregados and localidades)
+are written as ``<name>.zst`` with the ``zstandard`` package, a dependency;
+writing fails rather than falling back to plain files when it is missing, so
+a broken install can't silently change a run's layout. Files are written as a
+sequence of independent zstd frames, one per checkpoint of the writer, so a
+partial file can still be truncated back to its last checkpoint and resumed;
+readers decode across frames.
+
+Readers go through ``open_artifact``/``find_artifact``, which accept both
+forms, so runs written before compression stay readable.
+"""
+
+import io
+import os
+from typing import BinaryIO, List, Optional, Tuple
+
+try:
+    import zstandard
+except ImportError:  # a dependency; only plain files can be read without it
+    zstandard = None
+
+ZSTD_SUFFIX = ".zst"
+# Fast levels already shrink indented JSON several times over
+COMPRESSION_LEVEL = 3
+
+
+def require_zstandard(path: str) -> None:
+    if zstandard is None:
+        raise RuntimeError(
+            f"zstandard is not installed, so {path} can't be compressed; "
+            "reinstall the project's dependencies"
+        )
+
+
+def is_compressed(path: str) -> bool:
+    return path.endswith(ZSTD_SUFFIX)
+
+
+def logical_path(path: str) -> str:
+    """``foo.json.zst`` -> ``foo.json``"""
+    return path.removesuffix(ZSTD_SUFFIX)
+
+
+def artifact_path(path: str) -> str:
+    """The path to write the artifact ``path`` to, always compressed."""
+    require_zstandard(path)
+    return path + ZSTD_SUFFIX
+
+
+def candidate_paths(path: str) -> Tuple[str, str]:
+    """Both forms of an artifact, the compressed one written today first."""
+    plain = logical_path(path)
+    return (plain + ZSTD_SUFFIX, plain)
+
+
+def find_artifact(path: str) -> Optional[str]:
+    """The existing file of an artifact, compressed or not, if any."""
+    for candidate in candidate_paths(path):
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+
+def open_artifact(path: str) -> BinaryIO:
+    """Open an artifact for streaming reads, decompressing ``.zst`` files."""
+    if not is_compressed(path):
+        return open(path, "rb")
+    require_zstandard(path)
+    reader = zstandard.ZstdDecompressor().stream_reader(
+        open(path, "rb"), read_across_frames=True, closefd=True
+    )
+    # Buffered for readline() and line iteration
+    return io.BufferedReader(reader)
+
+
+class FrameWriter:
+    """
+    Buffer writes to a binary file and emit them as one frame per commit,
+    compressed when the file is a ``.zst`` artifact.
+    """
+
+    def __init__(self, file: BinaryIO, compress: bool):
+        if compress:
+            require_zstandard(file.name)
+        self._file = file
+        self._compressor = (
+            zstandard.ZstdCompressor(level=COMPRESSION_LEVEL) if compress else None
+        )
+        self._pending: List[bytes] = []
+
+    def write(self, data: bytes) -> None:
+        self._pending.append(data)
+
+    def commit(self) -> bytes:
+        """Write everything buffered; returns the bytes that reached the file."""
+        data = b"".join(self._pending)
+        self._pending.clear()
+        if not data:
+            return b""
+        if self._compressor is not None:
+            data = self._compressor.compress(data)
+        self._file.write(data)
+        return data
+
+
+def write_artifact(path: str, data: bytes) -> None:
+    """Write a whole artifact at once, compressed if path is a ``.zst`` file."""
+    with open(path, "wb") as f:
+        writer = FrameWriter(f, is_compressed(path))
+        writer.write(data)
+        writer.commit()
@@ -0,0 +1,64 @@
+"""
+HTTP validators for incremental refreshes.
+
+Downloaders record the ``ETag`` and ``Last-Modified`` headers of every artifact
+in the artifact index. On the next run the same request is sent with
+``If-None-Match`` / ``If-Modified-Since``; a ``304 Not Modified`` answer means
+the previous run's file is still current and is linked into the new run
+instead of being transferred again.
+"""
+
+from dataclasses import dataclass
+from typing import Any, Dict, Mapping, Optional
+
+from .artifact_index import Artifact
+
+
+class NotModified(Exception):
+    """The server answered 304: the previously downloaded artifact is current."""
+
+
+@dataclass
+class Validators:
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+    @classmethod
+    def from_headers(cls, headers: Mapping[str, str]) -> "Validators":
+        return cls(etag=headers.get("ETag"), last_modified=headers.get("Last-Modified"))
+
+    @classmethod
+    def from_artifact(cls, artifact: Optional[Artifact]) -> "Validators":
+        if artifact is None:
+            return cls()
+        return cls(etag=artifact.etag, last_modified=artifact.last_modified)
+
+    def __bool__(self) -> bool:
+        return bool(self.etag or self.last_modified)
+
+    def matches(self, other: "Validators") -> bool:
+        """True if both describe the same version of a resource."""
+        if self.etag and other.etag:
+            return self.etag == other.etag
+        if self.last_modified and other.last_modified:
+            return self.last_modified == other.last_modified
+        return False
+
+    def request_headers(self) -> Dict[str, str]:
+        """Conditional request headers asking for the body only if it changed."""
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+    def if_range(self) -> Optional[str]:
+        """Value for ``If-Range``: a strong ETag, else Last-Modified."""
+        if self.etag and not self.etag.startswith("W/"):
+            return self.etag
+        return self.last_modified
+
+    def as_fields(self) -> Dict[str, Any]:
+        """Keyword arguments for ``ArtifactIndex.record``."""
+        return {"etag": self.etag, "last_modified": self.last_modified}
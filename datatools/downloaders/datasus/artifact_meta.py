@@ -0,0 +1,106 @@
+"""
+Small sidecar files describing finished downloads.
+
+Every file written by ``download_file`` gets a ``<file>.meta`` next to it with
+its completion status, size and content hash, so resume checks can decide
+whether a file is complete by reading a few hundred bytes instead of parsing
+the file itself. OpenAPI NDJSON files keep the same fields in their manifest.
+"""
+
+import logging
+import os
+import re
+from typing import Any, Dict, Optional
+
+from . import codec
+from .types import PART_SUFFIX
+
+logger = logging.getLogger("downloader:DATASUS:meta")
+
+META_SUFFIX = ".meta"
+
+# Legacy OpenAPI files embed {"metadata": {...}} before the data array; only
+# this many leading bytes are read to find it.
+HEADER_READ_BYTES = 64 * 1024
+
+
+def meta_path_for(path: str) -> str:
+    return path + META_SUFFIX
+
+
+def write_meta(path: str, **fields: Any) -> None:
+    """Atomically write the sidecar of ``path``; status defaults to complete."""
+    meta = {"status": "complete", "size": os.path.getsize(path), **fields}
+    meta_path = meta_path_for(path)
+    tmp_path = meta_path + PART_SUFFIX
+    with open(tmp_path, "wb") as f:
+        f.write(codec.dumps(meta, indent=True))
+    os.replace(tmp_path, meta_path)
+
+
+def read_meta(path: str) -> Optional[Dict[str, Any]]:
+    meta_path = meta_path_for(path)
+    if not os.path.exists(meta_path):
+        return None
+    try:
+        with open(meta_path, "rb") as f:
+            return codec.loads(f.read())
+    except Exception as e:
+        logger.warning(f"Failed to read {meta_path}: {e}")
+        return None
+
+
+def is_meta_complete(path: str, meta: Dict[str, Any]) -> bool:
+    """A sidecar only vouches for a file that still has the recorded size."""
+    return meta.get("status") == "complete" and meta.get("size") == os.path.getsize(
+        path
+    )
+
+
+_METADATA_KEY = re.compile(r"""["']?metadata["']?\s*:\s*\{""")
+
+
+def _object_end(text: str, start: int) -> Optional[int]:
+    """Index just past the JSON(5) object opening at start, if it closes."""
+    depth = 0
+    quote = None
+    escaped = False
+    for i in range(start, len(text)):
+        char = text[i]
+        if quote:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == quote:
+                quote = None
+        elif char in "\"'":
+            quote = char
+        elif char == "{":
+            depth += 1
+        elif char == "}":
+            depth -= 1
+            if depth == 0:
+                return i + 1
+    return None
+
+
+def read_embedded_metadata(
+    path: str, max_bytes: int = HEADER_READ_BYTES
+) -> Optional[Dict[str, Any]]:
+    """
+    Read the ``metadata`` object of a legacy ``{"metadata": ..., "data": ...}``
+    OpenAPI file from its first ``max_bytes`` bytes, without parsing the data.
+    """
+    with open(path, "rb") as f:
+        head = f.read(max_bytes).decode("utf-8", errors="ignore")
+
+    match = _METADATA_KEY.search(head)
+    if not match:
+        return None
+
+    start = match.end() - 1
+    end = _object_end(head, start)
+    if end is None:
+        return None
+    return codec.loads_lenient(head[start:end])
@@ -0,0 +1,115 @@
+"""
+Per-run cache of fetched HTML pages.
+
+The same resource and API pages are reached from several places during one
+crawl (picking the resource, collecting all download links of a dataset,
+reading the API configuration). ``PageCache`` keeps response bodies in an LRU
+bounded by total size so each URL is requested once per run; concurrent
+requests for the same URL share one fetch. Entries evicted from memory can
+optionally be spilled to a temporary directory instead of being dropped.
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, Optional
+
+logger = logging.getLogger("downloader:DATASUS:cache")
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    disk_hits: int = 0
+    evictions: int = 0
+
+    def __str__(self) -> str:
+        total = self.hits + self.misses
+        ratio = self.hits / total if total else 0.0
+        return (
+            f"{self.hits} hits ({self.disk_hits} from disk), {self.misses} misses, "
+            f"{self.evictions} evictions, hit ratio {ratio:.0%}"
+        )
+
+
+class PageCache:
+    def __init__(self, max_bytes: int, spill: bool = False):
+        self.max_bytes = max_bytes
+        self.stats = CacheStats()
+        self._entries: "OrderedDict[str, bytes]" = OrderedDict()
+        self._size = 0
+        self._in_flight: Dict[str, asyncio.Future] = {}
+        self._spill_dir = tempfile.mkdtemp(prefix="datasus_pages_") if spill else None
+
+    def _spill_path(self, url: str) -> str:
+        return os.path.join(self._spill_dir, hashlib.sha1(url.encode()).hexdigest())
+
+    def _lookup(self, url: str) -> Optional[bytes]:
+        if url in self._entries:
+            self._entries.move_to_end(url)
+            return self._entries[url]
+        if self._spill_dir and os.path.exists(path := self._spill_path(url)):
+            with open(path, "rb") as f:
+                content = f.read()
+            self.stats.disk_hits += 1
+            self._store(url, content)
+            return content
+        return None
+
+    def _store(self, url: str, content: bytes) -> None:
+        if len(content) > self.max_bytes:
+            return
+        self._entries[url] = content
+        self._size += len(content)
+        while self._size > self.max_bytes:
+            evicted_url, evicted = self._entries.popitem(last=False)
+            self._size -= len(evicted)
+            self.stats.evictions += 1
+            if self._spill_dir:
+                with open(self._spill_path(evicted_url), "wb") as f:
+                    f.write(evicted)
+
+    async def get_or_fetch(
+        self, url: str, fetch: Callable[[], Awaitable[bytes]]
+    ) -> bytes:
+        """Return the cached body of ``url``, fetching it once if needed."""
+        content = self._lookup(url)
+        if content is not None:
+            self.stats.hits += 1
+            return content
+
+        if url in self._in_flight:
+            # Another task is already fetching this page; wait for its result
+            self.stats.hits += 1
+            return await asyncio.shield(self._in_flight[url])
+
+        self.stats.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[url] = future
+        try:
+            content = await fetch()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Nobody else may be waiting; don't warn about a lost exception
+            future.exception()
+            raise
+        else:
+            future.set_result(content)
+            self._store(url, content)
+            return content
+        finally:
+            del self._in_flight[url]
+
+    def close(self) -> None:
+        if self._spill_dir:
+            shutil.rmtree(self._spill_dir, ignore_errors=True)
+            self._spill_dir = None
@@ -0,0 +1,104 @@
+"""
+JSON serialization layer for the DATASUS downloader.
+
+Every JSON file the package reads or writes (OpenAPI pages and manifests,
+progress and segment state) goes through a codec from this module. The default
+codec is strict JSON: orjson, a dependency of the package, with the
+C-accelerated standard library ``json`` as fallback where it is missing.
+``json5`` is a pure-Python parser that is orders of magnitude slower, so it is
+only used for inputs that are not strict JSON: the swagger spec and OpenAPI
+files written by older versions of the downloader.
+"""
+
+import json
+import logging
+from typing import Any, Callable, Dict, Optional
+
+import json5
+
+logger = logging.getLogger("downloader:DATASUS:codec")
+
+try:
+    import orjson
+except ImportError:  # falls back to the standard library
+    orjson = None
+
+
+class JsonCodec:
+    """Encode to and decode from UTF-8 bytes."""
+
+    name = "json"
+
+    def dumps(self, obj: Any, indent: bool = False) -> bytes:
+        text = json.dumps(obj, ensure_ascii=False, indent=2 if indent else None)
+        return text.encode("utf-8")
+
+    def loads(self, data: bytes | str) -> Any:
+        return json.loads(data)
+
+
+class OrjsonCodec(JsonCodec):
+    name = "orjson"
+
+    def dumps(self, obj: Any, indent: bool = False) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+
+    def loads(self, data: bytes | str) -> Any:
+        return orjson.loads(data)
+
+
+class Json5Codec(JsonCodec):
+    name = "json5"
+
+    def dumps(self, obj: Any, indent: bool = False) -> bytes:
+        text = json5.dumps(obj, ensure_ascii=False, indent=2 if indent else None)
+        return text.encode("utf-8")
+
+    def loads(self, data: bytes | str) -> Any:
+        if isinstance(data, bytes):
+            data = data.decode("utf-8")
+        return json5.loads(data)
+
+
+CODECS: Dict[str, Callable[[], JsonCodec]] = {
+    "json": JsonCodec,
+    "json5": Json5Codec,
+}
+if orjson is not None:
+    CODECS["orjson"] = OrjsonCodec
+
+DEFAULT_CODEC = "orjson" if orjson is not None else "json"
+
+_codec: JsonCodec = CODECS[DEFAULT_CODEC]()
+
+
+def get_codec(name: Optional[str] = None) -> JsonCodec:
+    """Return the named codec, or the active default codec."""
+    if name is None:
+        return _codec
+    if name not in CODECS:
+        raise ValueError(f"Unknown JSON codec: {name} (available: {list(CODECS)})")
+    return CODECS[name]()
+
+
+def set_codec(name: str) -> None:
+    """Switch the codec used by dumps/loads for the whole package."""
+    global _codec
+    _codec = get_codec(name)
+    logger.info(f"Using JSON codec: {name}")
+
+
+def dumps(obj: Any, indent: bool = False) -> bytes:
+    return _codec.dumps(obj, indent)
+
+
+def loads(data: bytes | str) -> Any:
+    return _codec.loads(data)
+
+
+def loads_lenient(data: bytes | str) -> Any:
+    """Strict decode first; fall back to json5 for legacy, non-strict files."""
+    try:
+        return _codec.loads(data)
+    except ValueError:
+        return Json5Codec().loads(data)
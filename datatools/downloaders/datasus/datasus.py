@@ -1,64 +1,92 @@
+import asyncio
 import logging
 import os
 import traceback
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import Set
+from typing import Optional, Set
 
+from ..work_queue import WorkQueue, claim_task, remaining, settle, share_task
+from .cache import PageCache
+from .engine import DownloadEngine
 from .http_client import download_resource, get_page_content
 from .openapi import download_openapi_data
+from .pages import parse_dataset_page, parse_listing_page
 from .parser import (
-    extract_dataset_info_from_page,
     get_highest_priority_resource,
     get_resource_page_and_link,
+    iter_dataset_info_from_page,
 )
 from .progress_tracker import ProgressTracker
-from .types import URL, DatasetInfo, DownloadContext
+from .scheduler import SizeScheduler, estimate_size
+from .transcode import Transcoder
+from .types import (
+    DATASET_TASK_PREFIX,
+    DISCOVERY_QUEUE_SIZE,
+    LISTING_PAGE_CONCURRENCY,
+    OPENAPI_TASK,
+    PREPARE_WORKERS,
+    URL,
+    CrawlStats,
+    DatasetInfo,
+    DownloadContext,
+    DownloadOptions,
+)
 
 logger = logging.getLogger("downloader:DATASUS")
 logging.basicConfig(level=logging.INFO)
 
 
-def process_dataset(
-    dataset_info: DatasetInfo, output_dir: str, progress_tracker: ProgressTracker
-) -> tuple[str, bool]:
+async def prepare_dataset(
+    engine: DownloadEngine,
+    dataset_info: DatasetInfo,
+    output_dir: str,
+    progress_tracker: ProgressTracker,
+    options: DownloadOptions,
+    transcoder: Optional[Transcoder] = None,
+) -> tuple[Optional[DownloadContext], bool]:
     """
-    Process a single dataset.
-    Returns: (dataset_name, success)
+    Pick a dataset's best resource and resolve its download link.
+    Returns: (context to download, or None if there is nothing to download,
+    success so far)
     """
     dataset_name = dataset_info.name
 
-    # Check if already completed
-    if progress_tracker.is_completed(dataset_name):
-        logger.info(f"Skipping already completed dataset: {dataset_name}")
-        return (dataset_name, True)
-
-    # Check if files already exist (from interrupted download)
-    if progress_tracker.verify_dataset_files(dataset_name, output_dir):
-        logger.info(f"Files already exist for dataset: {dataset_name}, marking as completed")
-        progress_tracker.mark_completed(dataset_name)
-        return (dataset_name, True)
+    # On refresh, finished datasets are downloaded again with conditional
+    # requests, which link unchanged files from the previous run
+    if not options.refresh:
+        # Check if already completed
+        if progress_tracker.is_completed(dataset_name):
+            logger.info(f"Skipping already completed dataset: {dataset_name}")
+            return (None, True)
+
+        # Check if files already exist (from interrupted download)
+        if progress_tracker.verify_dataset_files(dataset_name, output_dir):
+            logger.info(
+                f"Files already exist for dataset: {dataset_name}, marking as completed"
+            )
+            await asyncio.to_thread(progress_tracker.mark_completed, dataset_name)
+            return (None, True)
 
     logger.info(f"Processing dataset: {dataset_name}")
 
-    resources = dataset_info.page_content.find_all("li", class_="resource-item")
+    resources = dataset_info.page.resources
     if not resources:
         logger.warning(f"No resources found for dataset {dataset_name}")
-        return (dataset_name, False)
+        return (None, False)
 
     best_resource = get_highest_priority_resource(resources)
     if not best_resource:
         logger.warning(f"No suitable resources found for dataset {dataset_name}")
-        return (dataset_name, False)
+        return (None, False)
 
-    logger.info(
-        f"Selected format '{best_resource.type}' for dataset {dataset_name}"
-    )
+    logger.info(f"Selected format '{best_resource.type}' for dataset {dataset_name}")
 
-    resource_page, download_item = get_resource_page_and_link(best_resource.resource)
+    resource_page, download_href = await get_resource_page_and_link(
+        engine, best_resource.resource
+    )
 
-    if not resource_page or not download_item:
+    if not resource_page or not download_href:
         logger.warning(f"Failed to get download link for {best_resource.name}")
-        return (dataset_name, False)
+        return (None, False)
 
     ctx = DownloadContext(
         dataset_name=dataset_name,
@@ -66,32 +94,123 @@ def process_dataset(
         file_type=best_resource.type,
         output_dir=output_dir,
         resource_page=resource_page,
-        download_item=download_item,
+        download_href=download_href,
         dataset_info=dataset_info,
+        engine=engine,
+        options=options,
+        artifact_index=progress_tracker.artifact_index,
+        transcoder=transcoder,
     )
+    return (ctx, True)
+
 
+async def download_dataset(
+    ctx: DownloadContext, progress_tracker: ProgressTracker
+) -> bool:
+    """Download a prepared dataset and mark it completed on success."""
     try:
-        success = download_resource(ctx)
+        success = await download_resource(ctx)
         if success:
-            progress_tracker.mark_completed(dataset_name)
-            return (dataset_name, True)
+            # May wait on another process's journal lock; not on the event loop
+            await asyncio.to_thread(progress_tracker.mark_completed, ctx.dataset_name)
+            return True
         else:
-            logger.error(f"Download failed for {dataset_name}")
-            return (dataset_name, False)
+            logger.error(f"Download failed for {ctx.dataset_name}")
+            return False
     except Exception as e:
-        logger.error(f"Error downloading resource {best_resource.name}: {e}")
+        logger.error(f"Error downloading resource {ctx.resource_name}: {e}")
         logger.error(traceback.format_exc())
-        return (dataset_name, False)
+        return False
 
 
-def download_datasus_data(output_dir: str, max_workers: int = 4) -> None:
+async def process_dataset(
+    engine: DownloadEngine,
+    dataset_info: DatasetInfo,
+    output_dir: str,
+    progress_tracker: ProgressTracker,
+    options: DownloadOptions,
+    transcoder: Optional[Transcoder] = None,
+) -> tuple[str, bool]:
+    """
+    Process a single dataset.
+    Returns: (dataset_name, success)
+    """
+    ctx, success = await prepare_dataset(
+        engine, dataset_info, output_dir, progress_tracker, options, transcoder
+    )
+    if ctx is not None:
+        success = await download_dataset(ctx, progress_tracker)
+    return (dataset_info.name, success)
+
+
+def dataset_task(dataset_name: str) -> str:
+    return f"{DATASET_TASK_PREFIX}{dataset_name}"
+
+
+async def process_leftover(
+    engine: DownloadEngine,
+    task: str,
+    url: str,
+    output_dir: str,
+    progress_tracker: ProgressTracker,
+    options: DownloadOptions,
+    transcoder: Optional[Transcoder] = None,
+) -> bool:
+    """Download a dataset of a shared run that another process did not finish."""
+    name = task[len(DATASET_TASK_PREFIX) :]
+    logger.info(f"Taking over dataset {name} from the shared run")
+    try:
+        page = await get_page_content(engine, url, parse_dataset_page)
+        if not page:
+            logger.warning(f"Failed to get dataset page for {name}")
+            return False
+        _, success = await process_dataset(
+            engine,
+            DatasetInfo(name=name, url=url, page=page),
+            output_dir,
+            progress_tracker,
+            options,
+            transcoder,
+        )
+        return success
+    except Exception as e:
+        logger.error(f"Error processing dataset {name}: {e}")
+        logger.error(traceback.format_exc())
+        return False
+
+
+async def download_openapi_step(output_dir: str, queue: WorkQueue) -> None:
+    """Run the OpenAPI download in one process of a shared run."""
+    queue.add([OPENAPI_TASK])
+    # Only one process runs it; the others wait and take over if it crashes
+    async for task, _ in queue.remaining(OPENAPI_TASK):
+        try:
+            await asyncio.to_thread(download_openapi_data, output_dir)
+        except Exception as e:
+            logger.error(f"Error during OpenAPI download: {e}")
+            queue.fail(task, str(e))
+            continue
+        queue.complete(task)
+
+
+def download_datasus_data(
+    output_dir: str,
+    max_workers: int = 4,
+    options: Optional[DownloadOptions] = None,
+    queue: Optional[WorkQueue] = None,
+) -> None:
     """
     Download DATASUS data with parallel processing support.
 
     Args:
         output_dir: Directory to save downloaded files
-        max_workers: Number of parallel workers (default: 4)
+        max_workers: Number of concurrent dataset workers, also used as the
+            default per-host request limit (default: 4)
+        options: File download options, e.g. segmented downloads (default: off)
+        queue: Work queue of a shared run, splitting the datasets and the
+            OpenAPI download with other processes (default: none)
     """
+    options = options or DownloadOptions()
     try:
         os.makedirs(output_dir, exist_ok=True)
         logger.info(f"Output directory: {output_dir}")
@@ -100,84 +219,256 @@ def download_datasus_data(output_dir: str, max_workers: int = 4) -> None:
         logger.error(f"Failed to create output directory {output_dir}: {e}")
         return
 
-    # Initialize progress tracker
-    progress_tracker = ProgressTracker(output_dir)
-    stats = progress_tracker.get_stats()
-    logger.info(f"Progress tracker initialized. Previously completed: {stats['completed_datasets']} datasets")
-
-    datasets_listing_page = get_page_content(URL)
-    if not datasets_listing_page:
-        logger.error("Failed to get datasets listing page content")
-        return
-
-    total_pages = len(datasets_listing_page.find_all("li", class_="page-item"))
-    logger.info(f"Found {total_pages} page(s)")
+    asyncio.run(crawl_datasus_datasets(output_dir, max_workers, options, queue))
 
-    # Collect all datasets info first
-    all_datasets_info = []
-    seen_dataset_names: Set[str] = set()
-
-    for page_num in range(1, total_pages):
-        logger.info(f"Collecting datasets from page {page_num}/{total_pages}")
-        datasets_info = extract_dataset_info_from_page(page_num)
-
-        for dataset_info in datasets_info:
-            if dataset_info.name in seen_dataset_names:
-                logger.info(f"Duplicate dataset found: {dataset_info.name}, skipping")
-                continue
-
-            seen_dataset_names.add(dataset_info.name)
-            all_datasets_info.append(dataset_info)
+    logger.info("Starting OpenAPI data download...")
+    if queue is not None:
+        asyncio.run(download_openapi_step(output_dir, queue))
+    else:
+        try:
+            download_openapi_data(output_dir)
+        except Exception as e:
+            logger.error(f"Error during OpenAPI download: {e}")
 
-    logger.info(f"Total unique datasets to process: {len(all_datasets_info)}")
+    logger.info("All DATASUS data download completed")
 
-    # Process datasets in parallel
-    success_count = 0
-    failure_count = 0
-    skipped_count = 0
 
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        # Submit all tasks
-        future_to_dataset = {
-            executor.submit(
-                process_dataset, dataset_info, output_dir, progress_tracker
-            ): dataset_info
-            for dataset_info in all_datasets_info
-        }
+class DatasetPipeline:
+    """
+    The discovery, preparation and download stages of one crawl, with the
+    state they share. See crawl_datasus_datasets.
+    """
 
-        # Process completed tasks
-        for future in as_completed(future_to_dataset):
-            dataset_info = future_to_dataset[future]
-            try:
-                dataset_name, success = future.result()
-                if success:
-                    success_count += 1
-                else:
-                    failure_count += 1
-
-                # Log progress
-                total_processed = success_count + failure_count
-                logger.info(
-                    f"Progress: {total_processed}/{len(all_datasets_info)} "
-                    f"(Success: {success_count}, Failed: {failure_count})"
+    def __init__(
+        self,
+        engine: DownloadEngine,
+        output_dir: str,
+        max_workers: int,
+        options: DownloadOptions,
+        progress_tracker: ProgressTracker,
+        transcoder: Optional[Transcoder] = None,
+        shared_queue: Optional[WorkQueue] = None,
+    ):
+        self.engine = engine
+        self.output_dir = output_dir
+        self.max_workers = max_workers
+        self.options = options
+        self.progress_tracker = progress_tracker
+        self.transcoder = transcoder
+        self.shared_queue = shared_queue
+        self.stats = CrawlStats()
+        self.queue: asyncio.Queue[Optional[DatasetInfo]] = asyncio.Queue(
+            maxsize=max(DISCOVERY_QUEUE_SIZE, max_workers)
+        )
+        self.scheduler = SizeScheduler()
+        self.seen_dataset_names: Set[str] = set()
+        self.page_slots = asyncio.Semaphore(LISTING_PAGE_CONCURRENCY)
+
+    async def run(self, total_pages: int) -> None:
+        await asyncio.gather(
+            self.prepare_all(total_pages),
+            *(self.download_worker() for _ in range(self.max_workers)),
+        )
+        await self.download_leftovers()
+
+    async def discover_page(self, page_num: int, total_pages: int) -> None:
+        async with self.page_slots:
+            logger.info(f"Collecting datasets from page {page_num}/{total_pages}")
+            async for dataset_info in iter_dataset_info_from_page(
+                self.engine, page_num
+            ):
+                if dataset_info.name in self.seen_dataset_names:
+                    logger.info(
+                        f"Duplicate dataset found: {dataset_info.name}, skipping"
+                    )
+                    continue
+
+                self.seen_dataset_names.add(dataset_info.name)
+                self.stats.discovered += 1
+                await asyncio.to_thread(
+                    share_task,
+                    self.shared_queue,
+                    dataset_task(dataset_info.name),
+                    dataset_info.url,
                 )
-
+                await self.queue.put(dataset_info)
+
+    async def discover_all(self, total_pages: int) -> None:
+        try:
+            results = await asyncio.gather(
+                *(
+                    self.discover_page(page_num, total_pages)
+                    for page_num in range(1, total_pages)
+                ),
+                return_exceptions=True,
+            )
+            for page_num, result in enumerate(results, 1):
+                if isinstance(result, Exception):
+                    logger.error(f"Error discovering page {page_num}: {result}")
+            logger.info(f"Discovery finished: {self.stats.discovered} unique datasets")
+        finally:
+            self.stats.discovery_done = True
+            for _ in range(PREPARE_WORKERS):
+                await self.queue.put(None)
+
+    async def claim(self, task: str) -> bool:
+        # The queue's SQLite calls may wait on a lock; keep them off the loop
+        return await asyncio.to_thread(claim_task, self.shared_queue, task)
+
+    async def count_result(self, task: str, success: bool) -> None:
+        await asyncio.to_thread(settle, self.shared_queue, task, success)
+        self.stats.record(success)
+        logger.info(self.stats.progress())
+
+    async def prepare(self, dataset_info: DatasetInfo) -> Optional[bool]:
+        """
+        Schedule a dataset's download and return None. A dataset settled
+        without a download returns its result instead: True if it was already
+        complete, False if it failed before a download.
+        """
+        ctx, success = await prepare_dataset(
+            self.engine,
+            dataset_info,
+            self.output_dir,
+            self.progress_tracker,
+            self.options,
+            self.transcoder,
+        )
+        if ctx is None:
+            return success
+        await self.scheduler.put(ctx, await estimate_size(ctx))
+        return None
+
+    async def prepare_worker(self) -> None:
+        while (dataset_info := await self.queue.get()) is not None:
+            try:
+                success = await self.prepare(dataset_info)
+                if success is None:
+                    continue
             except Exception as e:
                 logger.error(f"Error processing dataset {dataset_info.name}: {e}")
                 logger.error(traceback.format_exc())
-                failure_count += 1
+                success = False
+            task = dataset_task(dataset_info.name)
+            if await self.claim(task):
+                await self.count_result(task, success)
+
+    async def prepare_all(self, total_pages: int) -> None:
+        try:
+            await asyncio.gather(
+                self.discover_all(total_pages),
+                *(self.prepare_worker() for _ in range(PREPARE_WORKERS)),
+            )
+        finally:
+            await self.scheduler.close(self.max_workers)
+
+    async def download_worker(self) -> None:
+        while (ctx := await self.scheduler.get()) is not None:
+            # In a shared run, the dataset may be another process's
+            task = dataset_task(ctx.dataset_name)
+            if await self.claim(task):
+                success = await download_dataset(ctx, self.progress_tracker)
+                await self.count_result(task, success)
+
+    async def download_leftovers(self) -> None:
+        async for task, url in remaining(self.shared_queue, DATASET_TASK_PREFIX):
+            success = await process_leftover(
+                self.engine,
+                task,
+                url,
+                self.output_dir,
+                self.progress_tracker,
+                self.options,
+                self.transcoder,
+            )
+            await self.count_result(task, success)
+
+
+async def crawl_datasus_datasets(
+    output_dir: str,
+    max_workers: int,
+    options: DownloadOptions,
+    shared_queue: Optional[WorkQueue] = None,
+) -> None:
+    """
+    Crawl the DATASUS catalogue and download every dataset's best resource.
+
+    Discovery and download run as a producer/consumer pipeline: listing pages
+    and dataset pages are fetched concurrently and each DatasetInfo is put on a
+    bounded queue as soon as it is parsed. PREPARE_WORKERS workers resolve the
+    download link and expected size of each dataset and hand it to a
+    SizeScheduler, from which max_workers download workers always take the
+    largest waiting download. Only the bounded queue holds parsed dataset
+    pages; the scheduler holds their resource links. Pages and files use
+    separate workers and per-host slots, so scraping is never stuck behind
+    multi-GB transfers.
+
+    In a shared run every process discovers and prepares the whole catalogue,
+    but a dataset is leased from shared_queue only when a download worker is
+    free for it, so the processes split the downloads between them. Datasets
+    leased by a process that crashed are taken over at the end.
+    """
+    progress_tracker = ProgressTracker(output_dir)
+    try:
+        await crawl_with_tracker(
+            output_dir, max_workers, options, progress_tracker, shared_queue
+        )
+    finally:
+        progress_tracker.close()
+
+
+async def crawl_with_tracker(
+    output_dir: str,
+    max_workers: int,
+    options: DownloadOptions,
+    progress_tracker: ProgressTracker,
+    shared_queue: Optional[WorkQueue] = None,
+) -> None:
+    stats = progress_tracker.get_stats()
+    logger.info(
+        "Progress tracker initialized. "
+        f"Previously completed: {stats['completed_datasets']} datasets"
+    )
 
+    page_cache = PageCache(options.page_cache_bytes, spill=options.page_cache_spill)
+    async with DownloadEngine(
+        default_host_limit=max_workers, page_cache=page_cache
+    ) as engine:
+        datasets_listing_page = await get_page_content(engine, URL, parse_listing_page)
+        if not datasets_listing_page:
+            logger.error("Failed to get datasets listing page content")
+            return
+
+        total_pages = datasets_listing_page.page_count
+        logger.info(f"Found {total_pages} page(s)")
+        del datasets_listing_page
+
+        transcoder = (
+            Transcoder(output_dir, options.transcode_workers, options.keep_raw)
+            if options.transcode
+            else None
+        )
+        pipeline = DatasetPipeline(
+            engine,
+            output_dir,
+            max_workers,
+            options,
+            progress_tracker,
+            transcoder,
+            shared_queue,
+        )
+        try:
+            await pipeline.run(total_pages)
+        finally:
+            if transcoder is not None:
+                await transcoder.close()
+
+    crawl_stats = pipeline.stats
     logger.info("=" * 80)
     logger.info("DATASUS dataset download completed")
-    logger.info(f"Total datasets: {len(all_datasets_info)}")
-    logger.info(f"Successfully downloaded: {success_count}")
-    logger.info(f"Failed: {failure_count}")
+    logger.info(f"Total datasets: {crawl_stats.discovered}")
+    logger.info(f"Successfully downloaded: {crawl_stats.succeeded}")
+    logger.info(f"Failed: {crawl_stats.failed}")
+    logger.info(f"HTTP requests: {engine.request_count}")
+    logger.info(f"Page cache: {page_cache.stats}")
     logger.info("=" * 80)
-
-    logger.info("Starting OpenAPI data download...")
-    try:
-        download_openapi_data(output_dir)
-    except Exception as e:
-        logger.error(f"Error during OpenAPI download: {e}")
-
-    logger.info("All DATASUS data download completed")
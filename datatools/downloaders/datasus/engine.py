@@ -0,0 +1,117 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional
+from urllib.parse import urlsplit
+
+import httpx
+
+from ..retry import CircuitBreaker
+from .cache import PageCache
+from .types import DEFAULT_HOST_CONCURRENCY, HOST_CONCURRENCY_LIMITS, REQUEST_TIMEOUT
+
+logger = logging.getLogger("downloader:DATASUS:engine")
+
+
+class DownloadEngine:
+    """
+    Shared asyncio HTTP engine for the DATASUS crawler.
+
+    A single ``httpx.AsyncClient`` keeps one keep-alive connection pool per
+    host, so pages, files and API calls reuse TCP+TLS connections instead of
+    opening a new one per request. Each host also gets its own semaphores,
+    which cap how many requests may be in flight against it at the same time:
+    one for pages and other short requests, and one for streamed file
+    transfers, so long downloads never take the slots page scraping needs.
+
+    An optional ``PageCache`` is shared by everything that fetches HTML pages
+    through the engine (see ``http_client.get_page_content``), and the
+    ``CircuitBreaker`` by every call retried through ``..retry``.
+    """
+
+    def __init__(
+        self,
+        default_host_limit: int = DEFAULT_HOST_CONCURRENCY,
+        host_limits: Optional[Dict[str, int]] = None,
+        timeout: float = REQUEST_TIMEOUT,
+        page_cache: Optional[PageCache] = None,
+    ):
+        self.default_host_limit = default_host_limit
+        self.host_limits = {**HOST_CONCURRENCY_LIMITS, **(host_limits or {})}
+        # Streams per host; file workers number default_host_limit
+        self.file_host_limit = default_host_limit
+        self.timeout = timeout
+        self.page_cache = page_cache
+        self.request_count = 0
+        self.breaker = CircuitBreaker()
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._file_semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._client: Optional[httpx.AsyncClient] = None
+
+    async def __aenter__(self) -> "DownloadEngine":
+        max_connections = (
+            sum(self.host_limits.values())
+            + self.default_host_limit
+            + self.file_host_limit * (len(self.host_limits) + 1)
+        )
+        self._client = httpx.AsyncClient(
+            timeout=self.timeout,
+            follow_redirects=True,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+                keepalive_expiry=30,
+            ),
+        )
+        logger.info(
+            f"HTTP engine started (default per-host limit: {self.default_host_limit}, "
+            f"overrides: {self.host_limits})"
+        )
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+        if self.page_cache is not None:
+            self.page_cache.close()
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            raise RuntimeError(
+                "DownloadEngine must be used as an async context manager"
+            )
+        return self._client
+
+    def _host_semaphore(self, url: str) -> asyncio.Semaphore:
+        host = urlsplit(url).hostname or ""
+        if host not in self._semaphores:
+            limit = self.host_limits.get(host, self.default_host_limit)
+            self._semaphores[host] = asyncio.Semaphore(limit)
+        return self._semaphores[host]
+
+    def _file_semaphore(self, url: str) -> asyncio.Semaphore:
+        host = urlsplit(url).hostname or ""
+        if host not in self._file_semaphores:
+            self._file_semaphores[host] = asyncio.Semaphore(self.file_host_limit)
+        return self._file_semaphores[host]
+
+    async def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        """Send a request and read the whole body, respecting the host limit."""
+        async with self._host_semaphore(url):
+            self.request_count += 1
+            return await self.client.request(method, url, **kwargs)
+
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("GET", url, **kwargs)
+
+    @asynccontextmanager
+    async def stream(
+        self, method: str, url: str, **kwargs
+    ) -> AsyncIterator[httpx.Response]:
+        """Open a streaming response. A file slot is held until it is closed."""
+        async with self._file_semaphore(url):
+            self.request_count += 1
+            async with self.client.stream(method, url, **kwargs) as response:
+                yield response
@@ -1,25 +1,39 @@
+import asyncio
 import logging
 import os
 import re
-import time
-from typing import Any, Optional
-
-import requests
-from bs4 import BeautifulSoup
-from requests.auth import HTTPBasicAuth
-
+from typing import Any, Callable, Optional, TypeVar
+
+import httpx
+
+from ..artifact_index import Artifact, ArtifactIndex, clone_file
+from ..conditional import NotModified, Validators
+from ..hashing import StreamHasher, format_digest, hash_file
+from ..retry import CircuitOpenError, RetryPolicy, retry_async
+from . import codec
+from .artifact_meta import meta_path_for, write_meta
+from .engine import DownloadEngine
+from .pages import parse_api_config_page, parse_resource_page
+from .segmented import ResourceProbe, download_segmented, probe_resource
 from .types import (
-    MAX_RETRIES,
+    CHUNK_SIZE,
+    FILE_RETRY_POLICY,
     OPEN_API_URL,
+    PART_SUFFIX,
     PRE_URL,
     PRE_URL_API,
-    REQUEST_TIMEOUT,
-    RETRY_DELAY_SECONDS,
+    RETRY_POLICY,
+    TRANSCODED_FILE_TYPES,
     DownloadContext,
+    DownloadOptions,
+    TransferError,
 )
 
 logger = logging.getLogger("downloader: DATASUS")
 
+# Validators of the version a partial download was started from
+VALIDATORS_SUFFIX = ".validators"
+
 
 def clean_filename(filename: str) -> str:
     return re.sub(r"[\n\t\s/]*", "", filename)
@@ -31,152 +45,336 @@ def build_full_url(url: str) -> str:
     return url
 
 
-def get_page_content(
-    url: str, max_retries: int = MAX_RETRIES, delay_seconds: int = RETRY_DELAY_SECONDS
-) -> Optional[BeautifulSoup]:
-    retries = 0
-    while retries < max_retries:
-        try:
-            logger.debug(
-                f"Making request to: {url} (attempt {retries + 1}/{max_retries})"
-            )
-            response = requests.get(url, timeout=REQUEST_TIMEOUT)
-            response.raise_for_status()
-            content = BeautifulSoup(response.content, "html.parser")
+PageT = TypeVar("PageT")
 
-            if content is not None:
-                logger.debug(f"Successfully retrieved content from {url}")
-                return content
 
-        except requests.exceptions.Timeout:
-            logger.error(f"Request timeout for {url}")
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Request failed for {url}: {e}")
-        except Exception as e:
-            logger.error(f"Unexpected error parsing content from {url}: {e}")
+async def fetch_page_body(engine: DownloadEngine, url: str) -> bytes:
+    response = await engine.get(url)
+    response.raise_for_status()
+    return response.content
 
-        retries += 1
-        if retries < max_retries:
-            logger.debug(f"Retrying after {delay_seconds} seconds...")
-            time.sleep(delay_seconds)
 
-    logger.error(f"Max retries reached. Unable to retrieve content from {url}")
-    return None
+async def get_page_content(
+    engine: DownloadEngine,
+    url: str,
+    parse: Callable[[bytes], PageT],
+    policy: RetryPolicy = RETRY_POLICY,
+) -> Optional[PageT]:
+    """Fetch an HTML page and return what ``parse`` (see ``pages``) extracts."""
 
+    async def fetch() -> bytes:
+        logger.debug(f"Making request to: {url}")
+        if engine.page_cache is not None:
+            return await engine.page_cache.get_or_fetch(
+                url, lambda: fetch_page_body(engine, url)
+            )
+        return await fetch_page_body(engine, url)
 
-def download_file(
-    url: str, save_path: str, auth: Optional[HTTPBasicAuth] = None
-) -> bool:
-    if os.path.exists(save_path):
-        logger.info(f"File already exists: {save_path}")
-        return True
+    try:
+        body = await retry_async(fetch, url, policy, engine.breaker, logger)
+        content = parse(body)
+    except Exception as e:
+        logger.error(f"Unable to retrieve content from {url}: {e}")
+        return None
 
-    retries = 0
-    while retries < MAX_RETRIES:
-        try:
-            logger.info(
-                f"Downloading: {url} to {save_path} (attempt {retries + 1}/{MAX_RETRIES})"
-            )
+    logger.debug(f"Successfully retrieved content from {url}")
+    return content
 
-            if auth is not None:
-                response = requests.get(url, auth=auth, timeout=REQUEST_TIMEOUT)
-            else:
-                response = requests.get(url, timeout=REQUEST_TIMEOUT)
 
-            response.raise_for_status()
-            os.makedirs(os.path.dirname(save_path), exist_ok=True)
+def parse_total_size(response: httpx.Response) -> Optional[int]:
+    """
+    Return the full size of the resource a response belongs to, if announced.
 
-            with open(save_path, "wb") as file:
-                file.write(response.content)
+    For ``206 Partial Content`` the total comes from ``Content-Range``
+    (``bytes start-end/total``); otherwise from ``Content-Length``.
+    """
+    content_range = response.headers.get("Content-Range", "")
+    if "/" in content_range:
+        total = content_range.rsplit("/", 1)[1].strip()
+        return int(total) if total.isdigit() else None
 
-            logger.info(f"Successfully downloaded: {save_path}")
-            return True
+    content_length = response.headers.get("Content-Length", "")
+    return int(content_length) if content_length.isdigit() else None
 
-        except requests.exceptions.Timeout:
-            logger.error(f"Request timeout for {url}")
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Request failed for {url}: {e}")
-        except Exception as e:
-            logger.error(f"Failed to download {url}: {e}")
 
-        retries += 1
-        if retries < MAX_RETRIES:
-            logger.debug(f"Retrying after {RETRY_DELAY_SECONDS} seconds...")
-            time.sleep(RETRY_DELAY_SECONDS)
+def part_validators_path(part_path: str) -> str:
+    # "<name>.validators.part", cleaned up like any other partial file
+    return part_path.removesuffix(PART_SUFFIX) + VALIDATORS_SUFFIX + PART_SUFFIX
 
-    logger.error(f"Max retries reached. Unable to download {url}")
-    return False
 
+def load_part_validators(part_path: str) -> Validators:
+    """The validators of the version a partial file was started from."""
+    path = part_validators_path(part_path)
+    if not os.path.exists(path):
+        return Validators()
+    try:
+        with open(path, "rb") as f:
+            fields = codec.loads(f.read())
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable validators {path}: {e}")
+        return Validators()
+    return Validators(fields.get("etag"), fields.get("last_modified"))
+
+
+def save_part_validators(part_path: str, validators: Validators) -> None:
+    path = part_validators_path(part_path)
+    tmp_path = f"{path}.tmp{PART_SUFFIX}"
+    with open(tmp_path, "wb") as f:
+        f.write(codec.dumps(validators.as_fields()))
+    os.replace(tmp_path, path)
+
+
+def remove_part_validators(part_path: str) -> None:
+    path = part_validators_path(part_path)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def resume_request(url: str, part_path: str) -> tuple[int, dict[str, str]]:
+    """The offset to resume a partial file from, and the headers asking for it."""
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    # Byte offsets are only meaningful on the identity encoding
+    headers = {"Accept-Encoding": "identity"}
+    if not offset:
+        return 0, headers
+    if_range = load_part_validators(part_path).if_range()
+    if not if_range:
+        # Nothing proves the kept bytes belong to the current version
+        logger.info(f"No validator recorded for {part_path}, restarting")
+        return 0, headers
+    headers["Range"] = f"bytes={offset}-"
+    headers["If-Range"] = if_range
+    logger.info(f"Resuming {url} from byte {offset}")
+    return offset, headers
+
+
+async def stream_to_part_file(
+    engine: DownloadEngine,
+    url: str,
+    part_path: str,
+    auth: Optional[httpx.BasicAuth] = None,
+    validators: Optional[Validators] = None,
+) -> tuple[str, Validators]:
+    """
+    Stream ``url`` into ``part_path`` without holding the body in memory.
+
+    If the part file already holds bytes from an interrupted attempt, only the
+    missing range is requested, with ``If-Range`` carrying the validator the
+    part file was started with: if the remote file changed meanwhile the server
+    sends it whole and the download restarts. Raises TransferError when the stream
+    ends before the announced size, so the caller can retry and resume from
+    where it stopped.
+    A fresh download with ``validators`` is sent as a conditional request and
+    raises NotModified on 304.
+    Returns the content hash of the complete file, computed while streaming,
+    and the validators the server sent for it.
+    """
+    offset, headers = resume_request(url, part_path)
+    if not offset and validators:
+        headers.update(validators.request_headers())
+
+    async with engine.stream("GET", url, auth=auth, headers=headers) as response:
+        if response.status_code == 304:
+            raise NotModified(url)
+
+        received = Validators.from_headers(response.headers)
+        if response.status_code == 416:
+            # Range not satisfiable: the part file is either complete or bogus
+            if parse_total_size(response) == offset:
+                hasher = await asyncio.to_thread(hash_file, part_path)
+                remove_part_validators(part_path)
+                return format_digest(hasher), received
+            os.remove(part_path)
+            raise TransferError(f"Discarded invalid partial file {part_path}")
+
+        response.raise_for_status()
+
+        if offset and response.status_code != 206:
+            logger.info(f"Remote file changed or Range ignored for {url}, restarting")
+            offset = 0
+        if not offset:
+            save_part_validators(part_path, received)
+
+        expected_size = parse_total_size(response)
+        # Bytes kept from a previous attempt are hashed from disk once, off the
+        # event loop; the rest is hashed on the hash pool as it arrives
+        hasher = StreamHasher(
+            await asyncio.to_thread(hash_file, part_path, limit=offset)
+            if offset
+            else None
+        )
+        # Chunks are written as they arrive and flushed every CHUNK_SIZE bytes;
+        # whatever was received before a dropped connection stays on disk.
+        mode = "ab" if offset else "wb"
+        with open(part_path, mode, buffering=CHUNK_SIZE) as file:
+            async for chunk in response.aiter_bytes():
+                file.write(chunk)
+                hasher.update(chunk)
+
+    written = os.path.getsize(part_path)
+    if expected_size is not None and written != expected_size:
+        raise TransferError(
+            f"Incomplete download for {url}: {written}/{expected_size} bytes"
+        )
+    remove_part_validators(part_path)
+    return format_digest(hasher), received
+
+
+def record_artifact(
+    index: ArtifactIndex,
+    save_path: str,
+    url: str,
+    content_hash: str,
+    validators: Validators,
+) -> None:
+    """Index a finished download and link it to an identical earlier copy."""
+    try:
+        run, relpath = index.record_file(
+            save_path, url=url, content_hash=content_hash, **validators.as_fields()
+        )
+        method = index.deduplicate(run, relpath)
+        if method:
+            logger.info(f"Linked {save_path} to an identical artifact ({method})")
+    except Exception as e:
+        logger.warning(f"Failed to index {save_path}: {e}")
 
-def extract_api_credentials(
-    resource_page: BeautifulSoup,
-) -> tuple[Optional[str], Optional[str]]:
-    usuario = None
-    senha = None
 
-    for tag in resource_page.find_all("p"):
-        try:
-            text = tag.get_text()
-            if "Usuário:" in text:
-                usuario = text.split("Usuário:")[1].strip()
-            elif "Senha:" in text:
-                senha = text.split("Senha:")[1].strip()
-        except Exception as e:
-            logger.warning(f"Error parsing credentials: {e}")
+def reuse_previous_artifact(
+    index: ArtifactIndex, previous: Artifact, save_path: str
+) -> bool:
+    """Link the unchanged copy from an earlier run, with its sidecar, into place."""
+    logger.info(f"Not modified since run {previous.run}, reusing: {save_path}")
+    previous_path = index.absolute_path(previous)
+    index.reuse(previous, *index.locate(save_path))
+    if os.path.exists(meta_path_for(previous_path)):
+        clone_file(meta_path_for(previous_path), meta_path_for(save_path))
+    else:
+        write_meta(save_path, url=previous.url, content_hash=previous.content_hash)
+    return True
+
+
+async def probe_for_segments(
+    engine: DownloadEngine,
+    url: str,
+    auth: Optional[httpx.BasicAuth],
+    options: Optional[DownloadOptions],
+) -> Optional[ResourceProbe]:
+    """Probe url when segmented downloads are enabled, else return None."""
+    if options is None or options.segments <= 1:
+        return None
+    return await probe_resource(engine, url, auth)
 
-    return usuario, senha
 
+async def download_file(
+    engine: DownloadEngine,
+    url: str,
+    save_path: str,
+    auth: Optional[httpx.BasicAuth] = None,
+    options: Optional[DownloadOptions] = None,
+    index: Optional[ArtifactIndex] = None,
+) -> bool:
+    if os.path.exists(save_path):
+        logger.info(f"File already exists: {save_path}")
+        return True
+
+    os.makedirs(os.path.dirname(save_path), exist_ok=True)
+    part_path = save_path + PART_SUFFIX
+
+    # Validators recorded for this file by an earlier run make the request
+    # conditional, so an unchanged file is linked instead of transferred
+    previous = index.previous_of(save_path) if index is not None else None
+    known = Validators.from_artifact(previous)
+
+    # Opt-in: large files on servers that serve byte ranges are fetched as
+    # several concurrent segments instead of one stream
+    probe = await probe_for_segments(engine, url, auth, options)
+    if probe and known.matches(probe.validators):
+        return reuse_previous_artifact(index, previous, save_path)
+    if probe and not (probe.accepts_ranges and probe.size >= options.segment_threshold):
+        probe = None
+
+    async def attempt() -> bool:
+        logger.info(f"Downloading: {url} to {save_path}")
+        if probe is not None:
+            content_hash = await download_segmented(
+                engine, url, save_path, probe, options.segments, auth
+            )
+            validators = probe.validators
+        else:
+            content_hash, validators = await stream_to_part_file(
+                engine, url, part_path, auth, known
+            )
+            os.replace(part_path, save_path)
+        write_meta(
+            save_path, url=url, content_hash=content_hash, **validators.as_fields()
+        )
+        if index is not None:
+            record_artifact(index, save_path, url, content_hash, validators)
+
+        logger.info(f"Successfully downloaded: {save_path}")
+        return True
 
-def extract_api_url_from_javascript(item: any) -> Optional[str]:
     try:
-        apidata = get_page_content(item["href"])
-        if not apidata:
-            return None
+        return await retry_async(
+            attempt, url, FILE_RETRY_POLICY, engine.breaker, logger
+        )
+    except NotModified:
+        return reuse_previous_artifact(index, previous, save_path)
+    except Exception as e:
+        logger.error(f"Unable to download {url}: {e}")
+        return False
+
 
-        for script_tag in apidata.find_all("script"):
-            javascript_code = script_tag.string if script_tag else None
-
-            if javascript_code and "var user_config" in javascript_code:
-                for line in javascript_code.split("\n"):
-                    if "var user_config" in line:
-                        url_start = line.find('"url": "') + len('"url": "')
-                        url_end = line.find('"', url_start)
-                        if url_start > 7 and url_end > url_start:
-                            url = line[url_start:url_end]
-                            return PRE_URL_API + url
+async def extract_api_url_from_javascript(
+    engine: DownloadEngine, href: str
+) -> Optional[str]:
+    try:
+        apidata = await get_page_content(engine, href, parse_api_config_page)
+        if apidata and apidata.api_path:
+            return PRE_URL_API + apidata.api_path
     except Exception as e:
         logger.warning(f"Error extracting API URL: {e}")
 
     return None
 
 
-def handle_api_download(ctx: DownloadContext) -> bool:
-    api_link = ctx.resource_page.select_one("div.row.wrapper > section > div > p > a")
+async def handle_api_download(ctx: DownloadContext) -> bool:
+    api_link = ctx.resource_page.content_href
 
-    if OPEN_API_URL in api_link["href"]:
+    if api_link and OPEN_API_URL in api_link:
         logger.info("Skipping OpenAPI link (handled separately)")
         return True  # Not an error, just skipped
     else:
-        return handle_basic_api_download(ctx)
+        return await handle_basic_api_download(ctx)
 
 
-def handle_basic_api_download(ctx: DownloadContext) -> bool:
-    usuario, senha = extract_api_credentials(ctx.resource_page)
+async def handle_basic_api_download(ctx: DownloadContext) -> bool:
+    usuario = ctx.resource_page.username
+    senha = ctx.resource_page.password
     auth = None
+    download_href = ctx.download_href
     if usuario is None or senha is None:
-        api_url = extract_api_url_from_javascript(ctx.download_item)
+        api_url = await extract_api_url_from_javascript(ctx.engine, download_href)
         if api_url:
-            ctx.download_item["href"] = api_url
+            download_href = api_url
     else:
-        auth = HTTPBasicAuth(usuario, senha)
+        auth = httpx.BasicAuth(usuario, senha)
 
     file_name = f"{ctx.dataset_name}_{ctx.resource_name}.json"
     file_path = os.path.join(ctx.output_dir, file_name)
-    return download_file(ctx.download_item["href"], file_path, auth)
+    return await download_file(
+        ctx.engine,
+        download_href,
+        file_path,
+        auth,
+        index=ctx.artifact_index,
+    )
 
 
-def create_api_function(endpoint_path: str, spec: dict[str, Any], base_url: str):
-    def api_call(**kwargs):
+def create_api_function(
+    engine: DownloadEngine, endpoint_path: str, spec: dict[str, Any], base_url: str
+):
+    async def api_call(**kwargs):
         endpoint = f"{base_url.rstrip('/')}{endpoint_path}"
 
         method_spec = spec.get("get", {})
@@ -200,65 +398,55 @@ def create_api_function(endpoint_path: str, spec: dict[str, Any], base_url: str)
         else:
             headers["Accept"] = "application/json"
 
-        retries = 0
-        while retries < MAX_RETRIES:
-            try:
-                response = requests.get(
-                    endpoint, params=params, headers=headers, timeout=REQUEST_TIMEOUT
-                )
-                response.raise_for_status()
-
-                if headers["Accept"] == "text/csv":
-                    return response.text
-                else:
-                    return response.json()
-
-            except requests.exceptions.RequestException as e:
-                logger.error(
-                    f"API request error (attempt {retries + 1}/{MAX_RETRIES}): {e}"
-                )
-                retries += 1
-                if retries < MAX_RETRIES:
-                    time.sleep(RETRY_DELAY_SECONDS)
-                else:
-                    return None
+        async def request() -> Any:
+            response = await engine.get(endpoint, params=params, headers=headers)
+            response.raise_for_status()
 
-        return None
+            if headers["Accept"] == "text/csv":
+                return response.text
+            else:
+                return codec.loads(response.content)
+
+        try:
+            return await retry_async(
+                request, endpoint, RETRY_POLICY, engine.breaker, logger
+            )
+        except (httpx.HTTPError, ValueError, CircuitOpenError) as e:
+            logger.error(f"API request error: {e}")
+            return None
 
     return api_call
 
 
-def find_all_download_links(ctx: DownloadContext, file_type: str) -> list[dict]:
-    resource_pages_links = []
-    resource_items = ctx.dataset_info.page_content.find_all(
-        "li", class_="resource-item"
-    )
-    for item in resource_items:
-        heading_link = item.find("a", class_="heading", href=True)
-        if heading_link:
-            label = heading_link.find("span").get_text()
-            if file_type.lower() in label.lower():
-                resource_pages_links.append(heading_link)
+async def find_all_download_links(ctx: DownloadContext, file_type: str) -> list[str]:
+    resource_pages_links = [
+        resource.href
+        for resource in ctx.dataset_info.page.resources
+        if resource.is_heading
+        and resource.href
+        and file_type.lower() in (resource.format or "").lower()
+    ]
 
     download_links = []
-    for link in resource_pages_links:
-        href = link.get("href", "")
-        resource_page = get_page_content(PRE_URL + href)
-        if resource_page:
-            download_link = resource_page.select_one(
-                "div.row.wrapper > section > div > p > a"
-            )
-            download_link_href = download_link.get("href")
-            if download_link_href:
-                download_links.append(download_link_href)
+    for href in resource_pages_links:
+        resource_page = await get_page_content(
+            ctx.engine, PRE_URL + href, parse_resource_page
+        )
+        if resource_page and resource_page.content_href:
+            download_links.append(resource_page.content_href)
 
     return download_links
 
 
-def handle_file_download(ctx: DownloadContext) -> bool:
+def queue_transcoding(ctx: DownloadContext, file_path: str) -> None:
+    if ctx.transcoder is not None and ctx.file_type in TRANSCODED_FILE_TYPES:
+        ctx.transcoder.submit(file_path)
+
+
+async def handle_file_download(ctx: DownloadContext) -> bool:
     file_extension = "zip" if ctx.file_type == "zip csv" else ctx.file_type
 
-    all_links = find_all_download_links(ctx, file_extension)
+    all_links = await find_all_download_links(ctx, file_extension)
     logger.info(f"Found {len(all_links)} download links")
 
     all_successful = True
@@ -272,25 +460,41 @@ def handle_file_download(ctx: DownloadContext) -> bool:
             )
             file_path = os.path.join(ctx.output_dir, file_name)
             download_url = build_full_url(link)
-            success = download_file(download_url, file_path)
+            success = await download_file(
+                ctx.engine,
+                download_url,
+                file_path,
+                options=ctx.options,
+                index=ctx.artifact_index,
+            )
             if not success:
                 all_successful = False
                 logger.error(f"Failed to download file {idx + 1}/{len(all_links)}")
+            else:
+                queue_transcoding(ctx, file_path)
     else:
         file_name = f"{ctx.dataset_name}_{ctx.resource_name}.{file_extension}"
         file_path = os.path.join(ctx.output_dir, file_name)
-        download_url = build_full_url(ctx.download_item["href"])
-        all_successful = download_file(download_url, file_path)
+        download_url = build_full_url(ctx.download_href)
+        all_successful = await download_file(
+            ctx.engine,
+            download_url,
+            file_path,
+            options=ctx.options,
+            index=ctx.artifact_index,
+        )
+        if all_successful:
+            queue_transcoding(ctx, file_path)
 
     return all_successful
 
 
-def download_resource(ctx: DownloadContext) -> bool:
+async def download_resource(ctx: DownloadContext) -> bool:
     """
     Download a resource (file or API data).
     Returns True if download was successful, False otherwise.
     """
     if ctx.file_type == "api":
-        return handle_api_download(ctx)
+        return await handle_api_download(ctx)
     else:
-        return handle_file_download(ctx)
+        return await handle_file_download(ctx)
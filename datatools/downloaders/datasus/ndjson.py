@@ -0,0 +1,146 @@
+import logging
+import os
+from typing import Any, Dict, Iterable, Iterator, Optional
+
+from ..compression import FrameWriter, is_compressed, logical_path, open_artifact
+from ..hashing import StreamHasher, format_digest, hash_file
+from . import codec
+
+logger = logging.getLogger("downloader:DATASUS:ndjson")
+
+NDJSON_SUFFIX = ".ndjson"
+MANIFEST_SUFFIX = ".manifest.json"
+
+
+def manifest_path_for(data_path: str) -> str:
+    """``foo.ndjson`` or ``foo.ndjson.zst`` -> ``foo.manifest.json``"""
+    return logical_path(data_path).removesuffix(NDJSON_SUFFIX) + MANIFEST_SUFFIX
+
+
+def read_manifest(manifest_path: str) -> Optional[Dict[str, Any]]:
+    if not os.path.exists(manifest_path):
+        return None
+    try:
+        with open(manifest_path, "rb") as f:
+            return codec.loads(f.read())
+    except Exception as e:
+        logger.warning(f"Failed to read manifest {manifest_path}: {e}")
+        return None
+
+
+def write_manifest(manifest_path: str, manifest: Dict[str, Any]) -> None:
+    """Atomically replace the manifest, so readers never see a torn write."""
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(codec.dumps(manifest, indent=True))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, manifest_path)
+
+
+def iter_records(data_path: str) -> Iterator[Any]:
+    """Stream the records of an NDJSON file one at a time."""
+    with open_artifact(data_path) as f:
+        for line in f:
+            if line.strip():
+                yield codec.loads(line)
+
+
+class NdjsonWriter:
+    """
+    Append-only NDJSON writer with a small sidecar manifest.
+
+    Every page is serialised once and buffered until the next checkpoint,
+    which appends the buffered pages to ``<name>.ndjson`` (one zstd frame for
+    ``<name>.ndjson.zst``); nothing already on disk is rewritten, so a
+    checkpoint costs O(pages since the last one) and memory does not grow with
+    the endpoint. ``<name>.manifest.json`` records how many bytes and records
+    of the data file are committed, their content hash, the next offset to
+    request and the download status. When resuming, the data file is
+    truncated back to the committed size, dropping any page appended after the
+    last checkpoint.
+
+    The manifest names the run it was written for. A file is only reopened
+    for in-place writes when resuming a manifest of the same run; anything
+    else at the path, such as a link to a previous run's file, is unlinked
+    and written anew.
+    """
+
+    def __init__(
+        self, data_path: str, manifest: Dict[str, Any], run: Optional[str] = None
+    ):
+        self.data_path = data_path
+        self.manifest_path = manifest_path_for(data_path)
+        self.manifest = manifest
+        self.manifest["run"] = run
+        self.manifest.setdefault("format", "ndjson")
+        self.manifest.setdefault("total_records", 0)
+        self.manifest.setdefault("pages_downloaded", 0)
+        self.manifest.setdefault("next_offset", 0)
+        self.manifest.setdefault("bytes", 0)
+        self.manifest.setdefault("status", "in_progress")
+
+        if self.manifest["bytes"] and os.path.exists(data_path):
+            self._file = open(data_path, "r+b")
+        else:
+            if os.path.exists(data_path):
+                # Truncating would write through a hard link; unlinking does not
+                os.remove(data_path)
+            self._file = open(data_path, "wb")
+        self._file.truncate(self.manifest["bytes"])
+        self._file.seek(self.manifest["bytes"])
+        self._frames = FrameWriter(self._file, is_compressed(data_path))
+        # The hash covers committed bytes only, so a resumed file is rehashed
+        self._hasher = StreamHasher(
+            hash_file(data_path, limit=self.manifest["bytes"])
+            if self.manifest["bytes"]
+            else None
+        )
+
+    @classmethod
+    def resume_or_create(
+        cls, data_path: str, initial: Dict[str, Any], run: Optional[str] = None
+    ) -> "NdjsonWriter":
+        manifest = read_manifest(manifest_path_for(data_path))
+        if (
+            manifest
+            and manifest.get("status") == "in_progress"
+            and manifest.get("run") == run
+            and os.path.exists(data_path)
+        ):
+            logger.info(
+                f"Resuming {os.path.basename(data_path)} at offset "
+                f"{manifest['next_offset']} ({manifest['total_records']} records)"
+            )
+            return cls(data_path, {**manifest, **initial}, run)
+        return cls(data_path, dict(initial), run)
+
+    def append_page(self, records: Iterable[Any], next_offset: int) -> int:
+        lines = [codec.dumps(record) for record in records]
+        if lines:
+            self._frames.write(b"\n".join(lines) + b"\n")
+        count = len(lines)
+        self.manifest["total_records"] += count
+        self.manifest["pages_downloaded"] += 1
+        self.manifest["next_offset"] = next_offset
+        return count
+
+    def checkpoint(self, status: str = "in_progress", **fields: Any) -> None:
+        # The hash covers the bytes on disk, compressed or not
+        self._hasher.update(self._frames.commit())
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.manifest["bytes"] = self._file.tell()
+        self.manifest["content_hash"] = format_digest(self._hasher)
+        self.manifest["status"] = status
+        self.manifest.update(fields)
+        write_manifest(self.manifest_path, self.manifest)
+
+    def close(self) -> None:
+        self._file.close()
+
+    def __enter__(self) -> "NdjsonWriter":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
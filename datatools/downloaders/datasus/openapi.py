@@ -1,15 +1,26 @@
+import asyncio
 import logging
 import os
-import shutil
 import time
 from datetime import datetime
-from pathlib import Path
-from typing import Any, Dict, List, Optional
-
-import json5
-import requests
-
-from .types import MAX_RETRIES, PRE_URL_API, RETRY_DELAY_SECONDS
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import httpx
+
+from ..artifact_index import Artifact, ArtifactIndex, clone_file
+from ..compression import artifact_path, candidate_paths, find_artifact
+from ..rate_limiter import TokenBucket
+from ..retry import CircuitOpenError, RetryPolicy, retry_async
+from . import codec
+from .engine import DownloadEngine
+from .ndjson import (
+    NDJSON_SUFFIX,
+    NdjsonWriter,
+    manifest_path_for,
+    read_manifest,
+)
+from .progress_tracker import open_artifact_index
+from .types import MAX_RETRIES, PRE_URL_API
 
 logger = logging.getLogger("downloader:DATASUS:OpenAPI")
 
@@ -17,12 +28,24 @@ SWAGGER_URL = f"{PRE_URL_API}/static/swagger.json"
 SAVE_INTERVAL = 10
 REQUEST_TIMEOUT = 60
 
+# Scheduling: PAGE_WINDOW offset windows of one endpoint are in flight at once,
+# ENDPOINT_CONCURRENCY endpoints run side by side, and every page request
+# takes a token from a bucket refilled at REQUESTS_PER_SECOND.
+PAGE_WINDOW = 4
+ENDPOINT_CONCURRENCY = 3
+REQUESTS_PER_SECOND = 4
+REQUESTS_BURST = 8
+
+# Undecodable pages are retried too, as they have always been here
+PAGE_RETRY_POLICY = RetryPolicy(max_attempts=MAX_RETRIES, retry_on=(ValueError,))
 
-def load_swagger_spec() -> Dict[str, Any]:
+
+async def load_swagger_spec(engine: DownloadEngine) -> Dict[str, Any]:
     logger.info(f"Loading API specification from {SWAGGER_URL}...")
-    response = requests.get(SWAGGER_URL)
+    response = await engine.get(SWAGGER_URL)
     response.raise_for_status()
-    return json5.loads(response.text)
+    # The swagger spec is not strict JSON
+    return codec.get_codec("json5").loads(response.content)
 
 
 def extract_endpoints(swagger_spec: Dict[str, Any]) -> List[Dict[str, Any]]:
@@ -61,91 +84,136 @@ def extract_endpoints(swagger_spec: Dict[str, Any]) -> List[Dict[str, Any]]:
 
 def sanitize_filename(path: str) -> str:
     filename = path.lstrip("/").replace("/", "_")
-    return f"{filename}.json"
+    return f"{filename}{NDJSON_SUFFIX}"
 
 
-def fetch_page(endpoint: str, offset: int, limit: int) -> Optional[Dict[str, Any]]:
+async def fetch_page(
+    engine: DownloadEngine,
+    limiter: TokenBucket,
+    endpoint: str,
+    offset: int,
+    limit: int,
+) -> Optional[Dict[str, Any]]:
     url = f"{PRE_URL_API}{endpoint}"
     params = {"offset": offset, "limit": limit}
 
-    for attempt in range(MAX_RETRIES):
-        try:
-            response = requests.get(url, params=params, timeout=REQUEST_TIMEOUT)
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            logger.warning(f"Error on attempt {attempt + 1}/{MAX_RETRIES}: {e}")
-            if attempt < MAX_RETRIES - 1:
-                time.sleep(RETRY_DELAY_SECONDS)
-            else:
-                logger.error(f"Failed after {MAX_RETRIES} attempts")
-                return None
+    async def request() -> Dict[str, Any]:
+        await limiter.acquire()
+        response = await engine.get(url, params=params)
+        response.raise_for_status()
+        return codec.loads(response.content)
 
+    try:
+        return await retry_async(
+            request, url, PAGE_RETRY_POLICY, engine.breaker, logger
+        )
+    except (httpx.HTTPError, ValueError, CircuitOpenError) as e:
+        logger.error(f"Failed to fetch {endpoint} offset={offset}: {e}")
+        return None
 
-def save_data(filepath: str, data: List[Any], metadata: Dict[str, Any]):
-    output = {"metadata": metadata, "data": data}
 
-    with open(filepath, "w", encoding="utf-8") as f:
-        json5.dump(output, f, ensure_ascii=False, indent=2)
+def extract_page_data(result: Any) -> List[Any]:
+    if isinstance(result, list):
+        return result
+    elif isinstance(result, dict):
+        keys = list(result.keys())
+        key = keys[0]
+        return result[key]
+    else:
+        return [result] if result else []
 
 
 def find_complete_file_in_previous_runs(
-    filename: str, current_output_dir: str
-) -> Optional[str]:
+    index: ArtifactIndex, filename: str, current_output_dir: str
+) -> Optional[Artifact]:
     """
-    Search for a complete OpenAPI file in previous timestamped runs.
+    Look up a complete OpenAPI file from a previous timestamped run.
 
     Args:
-        filename: The filename to search for (e.g., "cnes_estabelecimentos.json")
+        index: Artifact index of the DATASUS source directory
+        filename: The filename to search for (e.g., "cnes_estabelecimentos.ndjson"),
+            found compressed or not
         current_output_dir: Current openapi directory (e.g., ".../tmp_uuid/openapi")
 
     Returns:
-        Path to complete file if found, None otherwise
+        The indexed artifact if found, None otherwise
     """
     try:
-        # Get parent of openapi dir (tmp_uuid)
-        tmp_dir = Path(current_output_dir).parent
-        # Get parent of tmp_uuid (datasus)
-        datasus_dir = tmp_dir.parent
-
-        if not datasus_dir.exists():
-            return None
-
-        # Search in timestamped directories (format: YYYYMMDD_HHMMSS)
-        for subdir in datasus_dir.iterdir():
-            if subdir.is_dir() and not subdir.name.startswith("tmp_"):
-                # Check if openapi subdir exists
-                openapi_dir = subdir / "openapi"
-                if not openapi_dir.exists():
-                    continue
-
-                # Check if file exists
-                candidate_file = openapi_dir / filename
-                if not candidate_file.exists():
-                    continue
-
-                # Check if file is complete
-                try:
-                    with open(candidate_file, "r", encoding="utf-8") as f:
-                        data = json5.load(f)
-                        metadata = data.get("metadata", {})
-                        if metadata.get("status") == "complete":
-                            logger.info(
-                                f"Found complete file in previous run: {subdir.name}/{filename} "
-                                f"({metadata.get('total_records', 0)} records)"
-                            )
-                            return str(candidate_file)
-                except Exception as e:
-                    logger.debug(f"Failed to check {candidate_file}: {e}")
-                    continue
-
+        current_run = os.path.basename(os.path.dirname(current_output_dir))
+        for candidate in candidate_paths(filename):
+            artifact = index.find_previous(f"openapi/{candidate}", current_run)
+            if artifact is not None:
+                logger.info(
+                    f"Found complete file in previous run: {artifact.relpath} "
+                    f"of {artifact.run}"
+                )
+                return artifact
         return None
     except Exception as e:
         logger.warning(f"Error searching for previous files: {e}")
         return None
 
 
-def download_endpoint(endpoint_info: Dict[str, Any], output_dir: str) -> bool:
+def reuse_previous_file(
+    index: ArtifactIndex, previous: Artifact, output_dir: str
+) -> bool:
+    """
+    Link (or reflink) a complete file and its manifest from a previous run
+    instead of copying the data, keeping its form. On failure nothing linked
+    is left behind, so the re-download never writes through a link into the
+    previous run's file.
+    """
+    previous_file = index.absolute_path(previous)
+    # Data file and manifest are both named after the previous file
+    reused_path = os.path.join(output_dir, os.path.basename(previous.relpath))
+    manifest_path = manifest_path_for(reused_path)
+    run, relpath = index.locate(reused_path)
+    try:
+        # The manifest first: a data file is never left linked without it
+        clone_file(manifest_path_for(previous_file), manifest_path)
+        index.reuse(previous, run, relpath)
+    except Exception as e:
+        logger.warning(f"Failed to reuse file from previous run: {e}. Re-downloading.")
+        for leftover in (reused_path, manifest_path):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+        index.forget(run, relpath)
+        return False
+    logger.info(f"Reused complete file from previous run: {reused_path}")
+    return True
+
+
+def endpoint_already_done(
+    index: ArtifactIndex, path: str, filename: str, filepath: str, output_dir: str
+) -> bool:
+    """True if the endpoint is complete in this run or reused from a previous one."""
+    # Check if file already exists and is complete in current directory
+    metadata = read_manifest(manifest_path_for(filepath))
+    if metadata and os.path.exists(filepath):
+        if metadata.get("status") == "complete":
+            logger.info(
+                f"Endpoint {path} already complete "
+                f"({metadata.get('total_records', 0)} records). Skipping."
+            )
+            return True
+        logger.info(
+            f"Endpoint {path} incomplete "
+            f"(status: {metadata.get('status')}). Resuming."
+        )
+        return False
+
+    # File doesn't exist in current dir, check previous runs
+    previous = find_complete_file_in_previous_runs(index, filename, output_dir)
+    return previous is not None and reuse_previous_file(index, previous, output_dir)
+
+
+async def download_endpoint(
+    engine: DownloadEngine,
+    limiter: TokenBucket,
+    endpoint_info: Dict[str, Any],
+    output_dir: str,
+    index: ArtifactIndex,
+) -> bool:
     path = endpoint_info["path"]
     max_limit = endpoint_info["max_limit"]
 
@@ -156,124 +224,178 @@ def download_endpoint(endpoint_info: Dict[str, Any], output_dir: str) -> bool:
     logger.info("=" * 80)
 
     filename = sanitize_filename(path)
-    filepath = os.path.join(output_dir, filename)
+    # A partial file is resumed in the form it was started in
+    plain_path = os.path.join(output_dir, filename)
+    filepath = find_artifact(plain_path) or artifact_path(plain_path)
 
-    # Check if file already exists and is complete in current directory
-    if os.path.exists(filepath):
-        try:
-            with open(filepath, "r", encoding="utf-8") as f:
-                data = json5.load(f)
-                metadata = data.get("metadata", {})
-                if metadata.get("status") == "complete":
-                    logger.info(
-                        f"Endpoint {path} already complete "
-                        f"({metadata.get('total_records', 0)} records). Skipping."
-                    )
-                    return True
-                else:
-                    logger.info(
-                        f"Endpoint {path} incomplete (status: {metadata.get('status')}). Re-downloading."
-                    )
-        except Exception as e:
-            logger.warning(f"Failed to check existing file: {e}. Re-downloading.")
-    else:
-        # File doesn't exist in current dir, check previous runs
-        previous_file = find_complete_file_in_previous_runs(filename, output_dir)
-        if previous_file:
-            try:
-                # Copy the complete file from previous run
-                shutil.copy2(previous_file, filepath)
-                logger.info(
-                    f"Reused complete file from previous run: {filename}"
-                )
-                return True
-            except Exception as e:
-                logger.warning(
-                    f"Failed to copy file from previous run: {e}. Re-downloading."
-                )
+    if endpoint_already_done(index, path, filename, filepath, output_dir):
+        return True
 
-    all_data = []
-    offset = 0
+    run, _ = index.locate(filepath)
+    # Resuming rehashes the committed part of the file, off the event loop
+    writer = await asyncio.to_thread(
+        NdjsonWriter.resume_or_create,
+        filepath,
+        {
+            "endpoint": path,
+            "summary": endpoint_info["summary"],
+            "tag": endpoint_info["tag"],
+            "page_limit": max_limit,
+        },
+        run,
+    )
+    completed = False
     page_count = 0
-    total_records = 0
 
     start_time = time.time()
+    previous_elapsed = writer.manifest.get("elapsed_seconds", 0)
 
-    while True:
-        page_count += 1
-        logger.info(f"Page {page_count} (offset={offset})...")
-
-        result = fetch_page(path, offset, max_limit)
-
-        if result is None:
-            logger.error("Download error, stopping this endpoint")
-            break
-
-        page_data = []
-        if isinstance(result, list):
-            page_data = result
-        elif isinstance(result, dict):
-            keys = list(result.keys())
-            key = keys[0]
-            page_data = result[key]
-        else:
-            page_data = [result] if result else []
-
-        records_in_page = len(page_data)
-        logger.info(f"{records_in_page} records")
-
-        if records_in_page == 0:
-            logger.info("No records returned, finishing endpoint")
-            break
-
-        all_data.extend(page_data)
-        total_records += records_in_page
-
-        if page_count % SAVE_INTERVAL == 0:
-            elapsed = time.time() - start_time
-            metadata = {
-                "endpoint": path,
-                "summary": endpoint_info["summary"],
-                "tag": endpoint_info["tag"],
-                "download_date": datetime.now().isoformat(),
-                "total_records": total_records,
-                "pages_downloaded": page_count,
-                "elapsed_seconds": round(elapsed, 2),
-                "status": "in_progress",
-            }
-            save_data(filepath, all_data, metadata)
-            logger.info(f"Checkpoint saved: {total_records} total records")
+    def elapsed_seconds() -> float:
+        return round(previous_elapsed + time.time() - start_time, 2)
 
-        if records_in_page < max_limit:
-            logger.info(f"Last page reached ({records_in_page} < {max_limit})")
-            break
+    try:
+        page_count, failed = await fetch_pages(
+            engine, limiter, path, max_limit, writer, elapsed_seconds
+        )
+        completed = not failed
+    finally:
+        await asyncio.to_thread(
+            writer.checkpoint,
+            status="complete" if completed else "in_progress",
+            download_date=datetime.now().isoformat(),
+            elapsed_seconds=elapsed_seconds(),
+        )
+        writer.close()
 
-        offset += max_limit
-        time.sleep(0.5)
+    if not completed:
+        return False
+    return record_endpoint(index, writer, path, page_count, elapsed_seconds())
 
-    if all_data:
-        elapsed = time.time() - start_time
-        metadata = {
-            "endpoint": path,
-            "summary": endpoint_info["summary"],
-            "tag": endpoint_info["tag"],
-            "download_date": datetime.now().isoformat(),
-            "total_records": total_records,
-            "pages_downloaded": page_count,
-            "elapsed_seconds": round(elapsed, 2),
-            "status": "complete",
-        }
-        save_data(filepath, all_data, metadata)
-        logger.info(f"Completed: {total_records} records in {page_count} pages")
-        logger.info(f"File: {filepath}")
-        logger.info(f"Time: {elapsed:.2f}s")
-        return True
-    else:
+
+async def fetch_pages(
+    engine: DownloadEngine,
+    limiter: TokenBucket,
+    path: str,
+    max_limit: int,
+    writer: NdjsonWriter,
+    elapsed_seconds: Callable[[], float],
+) -> Tuple[int, bool]:
+    """
+    Append the pages of an endpoint to ``writer`` from its next offset on.
+    Returns the number of pages fetched and whether a page failed.
+    """
+    page_count = 0
+
+    # Keep PAGE_WINDOW offsets in flight, but always consume the lowest one,
+    # so pages are appended to the output strictly in offset order.
+    in_flight: Dict[int, asyncio.Task] = {}
+    next_offset = writer.manifest["next_offset"]
+
+    try:
+        while True:
+            while len(in_flight) < PAGE_WINDOW:
+                in_flight[next_offset] = asyncio.create_task(
+                    fetch_page(engine, limiter, path, next_offset, max_limit)
+                )
+                next_offset += max_limit
+
+            offset = min(in_flight)
+            result = await in_flight.pop(offset)
+            page_count += 1
+            logger.info(f"{path}: page {page_count} (offset={offset})...")
+
+            if result is None:
+                logger.error(f"Download error on {path}, stopping this endpoint")
+                return page_count, True
+
+            page_data = extract_page_data(result)
+
+            records_in_page = len(page_data)
+            logger.info(f"{path}: {records_in_page} records")
+
+            if records_in_page == 0:
+                logger.info(f"{path}: no records returned, finishing endpoint")
+                return page_count, False
+
+            writer.append_page(page_data, offset + max_limit)
+
+            if page_count % SAVE_INTERVAL == 0:
+                await save_checkpoint(writer, path, elapsed_seconds())
+
+            if records_in_page < max_limit:
+                logger.info(
+                    f"{path}: last page reached ({records_in_page} < {max_limit})"
+                )
+                return page_count, False
+    finally:
+        # Windows past the last page are not needed
+        for task in in_flight.values():
+            task.cancel()
+        await asyncio.gather(*in_flight.values(), return_exceptions=True)
+
+
+async def save_checkpoint(writer: NdjsonWriter, path: str, elapsed: float) -> None:
+    # The fsyncs run in a thread; the pages in flight keep downloading
+    await asyncio.to_thread(
+        writer.checkpoint,
+        download_date=datetime.now().isoformat(),
+        elapsed_seconds=elapsed,
+    )
+    logger.info(
+        f"{path}: checkpoint saved, {writer.manifest['total_records']} total records"
+    )
+
+
+def record_endpoint(
+    index: ArtifactIndex,
+    writer: NdjsonWriter,
+    path: str,
+    page_count: int,
+    elapsed: float,
+) -> bool:
+    """Index a finished endpoint file, or drop it if it holds no records."""
+    total_records = writer.manifest["total_records"]
+    if not total_records:
         logger.warning("No data collected for this endpoint")
+        os.remove(writer.data_path)
+        os.remove(writer.manifest_path)
         return False
 
+    run, relpath = index.record_file(
+        writer.data_path,
+        url=f"{PRE_URL_API}{path}",
+        content_hash=writer.manifest.get("content_hash"),
+    )
+    index.deduplicate(run, relpath)
+    logger.info(f"Completed: {total_records} records in {page_count} pages")
+    logger.info(f"File: {writer.data_path}")
+    logger.info(f"Time: {elapsed:.2f}s")
+    return True
+
+
+def log_endpoints(endpoints: List[Dict[str, Any]]) -> None:
+    logger.info(f"Found {len(endpoints)} endpoints for download")
+
+    endpoints_by_tag = {}
+    for ep in endpoints:
+        tag = ep["tag"]
+        if tag not in endpoints_by_tag:
+            endpoints_by_tag[tag] = []
+        endpoints_by_tag[tag].append(ep)
+
+    logger.info("Endpoints by category:")
+    for tag, eps in sorted(endpoints_by_tag.items()):
+        logger.info(f"  {tag}: {len(eps)} endpoints")
+
+    logger.warning(f"Data from {len(endpoints)} endpoints will be downloaded.")
+    logger.warning("This may take a long time depending on the data volume.")
+
 
 def download_openapi_data(output_dir: str) -> None:
+    asyncio.run(download_openapi_endpoints(output_dir))
+
+
+async def download_openapi_endpoints(output_dir: str) -> None:
     logger.info("=" * 80)
     logger.info("DOWNLOADING OPEN DATA API OF THE BRAZILIAN MINISTRY OF HEALTH")
     logger.info("=" * 80)
@@ -286,44 +408,47 @@ def download_openapi_data(output_dir: str) -> None:
         logger.error(f"Failed to create OpenAPI output directory: {e}")
         return
 
+    # Pages of one endpoint plus several endpoints share the API host
+    host_limit = PAGE_WINDOW * ENDPOINT_CONCURRENCY
     try:
-        swagger_spec = load_swagger_spec()
-        logger.info(
-            f"Specification loaded: {swagger_spec['info']['title']} v{swagger_spec['info']['version']}"
-        )
-
-        endpoints = extract_endpoints(swagger_spec)
-        logger.info(f"Found {len(endpoints)} endpoints for download")
-
-        endpoints_by_tag = {}
-        for ep in endpoints:
-            tag = ep["tag"]
-            if tag not in endpoints_by_tag:
-                endpoints_by_tag[tag] = []
-            endpoints_by_tag[tag].append(ep)
-
-        logger.info("Endpoints by category:")
-        for tag, eps in sorted(endpoints_by_tag.items()):
-            logger.info(f"  {tag}: {len(eps)} endpoints")
-
-        logger.warning(f"Data from {len(endpoints)} endpoints will be downloaded.")
-        logger.warning("This may take a long time depending on the data volume.")
-
-        logger.info("Starting downloads...")
-
-        successful = 0
-        failed = 0
-
-        for i, endpoint_info in enumerate(endpoints, 1):
-            logger.info(
-                f"[{i}/{len(endpoints)}] Starting download of endpoint: {endpoint_info['path']}"
+        async with DownloadEngine(
+            default_host_limit=host_limit,
+            host_limits={httpx.URL(PRE_URL_API).host: host_limit},
+            timeout=REQUEST_TIMEOUT,
+        ) as engine:
+            swagger_spec = await load_swagger_spec(engine)
+            info = swagger_spec["info"]
+            logger.info(f"Specification loaded: {info['title']} v{info['version']}")
+
+            endpoints = extract_endpoints(swagger_spec)
+            log_endpoints(endpoints)
+
+            logger.info("Starting downloads...")
+
+            index = open_artifact_index(os.path.dirname(output_dir))
+            limiter = TokenBucket(REQUESTS_PER_SECOND, REQUESTS_BURST)
+            endpoint_slots = asyncio.Semaphore(ENDPOINT_CONCURRENCY)
+
+            async def run_endpoint(i: int, endpoint_info: Dict[str, Any]) -> bool:
+                async with endpoint_slots:
+                    logger.info(
+                        f"[{i}/{len(endpoints)}] Starting download of endpoint: "
+                        f"{endpoint_info['path']}"
+                    )
+                    try:
+                        return await download_endpoint(
+                            engine, limiter, endpoint_info, openapi_dir, index
+                        )
+                    except Exception as e:
+                        logger.error(f"Error downloading {endpoint_info['path']}: {e}")
+                        return False
+
+            results = await asyncio.gather(
+                *(run_endpoint(i, ep) for i, ep in enumerate(endpoints, 1))
             )
-            if download_endpoint(endpoint_info, openapi_dir):
-                successful += 1
-            else:
-                failed += 1
-
-            time.sleep(1)
+            successful = sum(results)
+            failed = len(results) - successful
+            index.close()
 
         logger.info("=" * 80)
         logger.info(
@@ -0,0 +1,124 @@
+"""
+Extraction of the few fragments the crawler needs from DATASUS (CKAN) pages.
+
+Pages are parsed with lxml's C HTML parser and queried with XPath; only the
+extracted strings, wrapped in the small dataclasses from ``types``, outlive the
+call. Nothing keeps a reference to a document tree, so a worker holds a few
+hundred bytes per page instead of a full BeautifulSoup tree.
+"""
+
+from typing import Optional
+
+from lxml import etree, html
+
+from .types import (
+    ApiConfigPage,
+    DatasetLink,
+    DatasetPage,
+    ListingPage,
+    ResourceLink,
+    ResourcePage,
+)
+
+_PARSER = html.HTMLParser(remove_comments=True, remove_pis=True, no_network=True)
+
+
+def _has_class(name: str) -> str:
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+
+# Link to the file or API behind a resource, the XPath equivalent of the CSS
+# selector "div.row.wrapper > section > div > p > a"
+_CONTENT_LINK = (
+    f"//div[{_has_class('row')} and {_has_class('wrapper')}]/section/div/p/a"
+)
+
+
+def _parse(content: bytes) -> etree._Element:
+    try:
+        return html.document_fromstring(content, parser=_PARSER)
+    except etree.ParserError:
+        # Empty document: behave like a page without any of the fragments
+        return html.document_fromstring("<html></html>")
+
+
+def _first(root: etree._Element, xpath: str) -> Optional[etree._Element]:
+    found = root.xpath(xpath)
+    return found[0] if found else None
+
+
+def parse_listing_page(content: bytes) -> ListingPage:
+    """Dataset links (``li.dataset-item``) and pagination of a catalogue page."""
+    root = _parse(content)
+    datasets = []
+    for item in root.xpath(f"//li[{_has_class('dataset-item')}]"):
+        link = _first(item, f".//h2[{_has_class('dataset-heading')}]//a")
+        if link is not None and link.get("href") is not None:
+            datasets.append(
+                DatasetLink(title=link.text_content(), href=link.get("href"))
+            )
+
+    page_count = len(root.xpath(f"//li[{_has_class('page-item')}]"))
+    return ListingPage(datasets=datasets, page_count=page_count)
+
+
+def parse_dataset_page(content: bytes) -> DatasetPage:
+    """
+    Resources (``li.resource-item``) of a dataset page. Each resource is read
+    from its first link, whose text is the resource title followed by the
+    format label in a ``<span>``.
+    """
+    resources = []
+    for item in _parse(content).xpath(f"//li[{_has_class('resource-item')}]"):
+        link = _first(item, ".//a")
+        if link is None:
+            continue
+        span = _first(link, ".//span")
+        resources.append(
+            ResourceLink(
+                title=link.text_content(),
+                format=span.text_content() if span is not None else None,
+                href=link.get("href"),
+                is_heading="heading" in (link.get("class") or "").split(),
+            )
+        )
+    return DatasetPage(resources=resources)
+
+
+def parse_resource_page(content: bytes) -> ResourcePage:
+    """Download links and Basic Auth credentials published on a resource page."""
+    root = _parse(content)
+
+    download = _first(root, f"//div[{_has_class('btn-group')}]//a")
+    content_link = _first(root, _CONTENT_LINK)
+
+    username = None
+    password = None
+    for paragraph in root.iter("p"):
+        text = paragraph.text_content()
+        if "Usuário:" in text:
+            username = text.split("Usuário:")[1].strip()
+        elif "Senha:" in text:
+            password = text.split("Senha:")[1].strip()
+
+    return ResourcePage(
+        download_href=download.get("href") if download is not None else None,
+        content_href=content_link.get("href") if content_link is not None else None,
+        username=username,
+        password=password,
+    )
+
+
+def parse_api_config_page(content: bytes) -> ApiConfigPage:
+    """The API path set in the ``var user_config`` script of an API page."""
+    for script in _parse(content).iter("script"):
+        code = script.text
+        if not code or "var user_config" not in code:
+            continue
+        for line in code.split("\n"):
+            if "var user_config" in line:
+                url_start = line.find('"url": "') + len('"url": "')
+                url_end = line.find('"', url_start)
+                if url_start > 7 and url_end > url_start:
+                    return ApiConfigPage(api_path=line[url_start:url_end])
+    return ApiConfigPage(api_path=None)
@@ -1,29 +1,36 @@
+import asyncio
 import logging
-from typing import List, Optional
-
-from bs4 import BeautifulSoup
+from typing import AsyncIterator, List, Optional
 
+from .engine import DownloadEngine
 from .http_client import clean_filename, get_page_content
-from .types import FILE_FORMAT_PRIORITY, PRE_URL, URL, DatasetInfo, ResourceInfo
+from .pages import parse_dataset_page, parse_listing_page, parse_resource_page
+from .types import (
+    FILE_FORMAT_PRIORITY,
+    PRE_URL,
+    URL,
+    DatasetInfo,
+    DatasetLink,
+    ResourceInfo,
+    ResourceLink,
+    ResourcePage,
+)
 
 logger = logging.getLogger("downloader: DATASUS")
 
 
-def get_highest_priority_resource(resources: List[any]) -> Optional[ResourceInfo]:
+def get_highest_priority_resource(
+    resources: List[ResourceLink],
+) -> Optional[ResourceInfo]:
     resource_formats = {}
 
     for resource in resources:
         try:
-            resource_item = resource.find("a")
-            if not resource_item:
-                continue
-
-            span = resource_item.find("span")
-            if not span:
+            if not resource.format:
                 continue
 
-            file_type = span.text.lower().strip()
-            resource_name = clean_filename(resource_item.text)
+            file_type = resource.format.lower().strip()
+            resource_name = clean_filename(resource.title)
 
             if file_type in FILE_FORMAT_PRIORITY:
                 priority = FILE_FORMAT_PRIORITY.index(file_type)
@@ -47,70 +54,64 @@ def get_highest_priority_resource(resources: List[any]) -> Optional[ResourceInfo
     return min(resource_formats.values(), key=lambda x: x.priority)
 
 
-def parse_dataset_item(dataset: any) -> Optional[DatasetInfo]:
+async def parse_dataset_item(
+    engine: DownloadEngine, dataset: DatasetLink
+) -> Optional[DatasetInfo]:
     try:
-        heading = dataset.find("h2", class_="dataset-heading")
-        if not heading:
-            return None
-
-        heading_link = heading.find("a")
-        if not heading_link:
-            return None
-
-        dataset_name = clean_filename(heading_link.text)
-        dataset_url = PRE_URL + heading_link["href"]
+        dataset_name = clean_filename(dataset.title)
+        dataset_url = PRE_URL + dataset.href
 
-        data = get_page_content(dataset_url)
-        if not data:
+        page = await get_page_content(engine, dataset_url, parse_dataset_page)
+        if not page:
             logger.warning(f"Failed to get dataset page for {dataset_name}")
             return None
 
-        return DatasetInfo(name=dataset_name, url=dataset_url, page_content=data)
+        return DatasetInfo(name=dataset_name, url=dataset_url, page=page)
 
     except Exception as e:
         logger.error(f"Error parsing dataset: {e}")
         return None
 
 
-def extract_dataset_info_from_page(page_num: int) -> List[DatasetInfo]:
+async def iter_dataset_info_from_page(
+    engine: DownloadEngine, page_num: int
+) -> AsyncIterator[DatasetInfo]:
+    """
+    Yield the datasets listed on a catalogue page as soon as each one is parsed.
+
+    All dataset pages of the listing are requested concurrently, so the caller
+    receives the first DatasetInfo without waiting for the slowest page.
+    """
     curr_page_url = URL + f"?page={page_num}"
-    content = get_page_content(curr_page_url)
+    listing = await get_page_content(engine, curr_page_url, parse_listing_page)
 
-    if not content:
+    if not listing:
         logger.error(f"Failed to get content for page {page_num}")
-        return []
+        return
 
-    datasets = content.find_all("li", class_="dataset-item")
+    datasets = listing.datasets
     logger.info(f"Found {len(datasets)} datasets on page {page_num}")
 
-    dataset_infos = []
-    for dataset in datasets:
-        dataset_info = parse_dataset_item(dataset)
+    for parsed in asyncio.as_completed(
+        [parse_dataset_item(engine, dataset) for dataset in datasets]
+    ):
+        dataset_info = await parsed
         if dataset_info:
-            dataset_infos.append(dataset_info)
-
-    return dataset_infos
+            yield dataset_info
 
 
-def get_resource_page_and_link(
-    resource: any,
-) -> tuple[Optional[BeautifulSoup], Optional[any]]:
+async def get_resource_page_and_link(
+    engine: DownloadEngine, resource: ResourceLink
+) -> tuple[Optional[ResourcePage], Optional[str]]:
     try:
-        resource_item = resource.find("a")
-        resource_page = get_page_content(PRE_URL + resource_item["href"])
-
-        if not resource_page:
-            return None, None
-
-        download_btn = resource_page.find("div", class_="btn-group")
-        if not download_btn:
-            return None, None
+        resource_page = await get_page_content(
+            engine, PRE_URL + resource.href, parse_resource_page
+        )
 
-        item = download_btn.find("a")
-        if not item:
+        if not resource_page or not resource_page.download_href:
             return None, None
 
-        return resource_page, item
+        return resource_page, resource_page.download_href
 
     except Exception as e:
         logger.error(f"Error getting resource page: {e}")
@@ -1,16 +1,86 @@
-import json
+import fcntl
 import logging
 import os
+import threading
+import time
 from pathlib import Path
-from typing import Optional, Set
+from typing import Iterator, Set
 
-import json5
+from ..artifact_index import ArtifactIndex
+from ..compression import logical_path
+from ..integrity import RUN_MANIFEST
+from . import codec
+from .artifact_meta import (
+    META_SUFFIX,
+    is_meta_complete,
+    read_embedded_metadata,
+    read_meta,
+)
+from .ndjson import MANIFEST_SUFFIX, NDJSON_SUFFIX, manifest_path_for, read_manifest
+from .types import PART_SUFFIX
 
 logger = logging.getLogger("downloader:DATASUS:progress")
 
 
+def iter_artifact_files(run_dir: str) -> Iterator[str]:
+    """Relative paths of the data files of a run, without sidecars or partials."""
+    for root, _, files in os.walk(run_dir):
+        for name in files:
+            if name == RUN_MANIFEST or name.endswith(
+                (PART_SUFFIX, META_SUFFIX, MANIFEST_SUFFIX)
+            ):
+                continue
+            path = os.path.join(root, name)
+            yield os.path.relpath(path, run_dir).replace(os.sep, "/")
+
+
+def open_artifact_index(source_dir: str) -> ArtifactIndex:
+    """
+    Open the artifact index of the DATASUS source directory, indexing the
+    runs that were downloaded before it existed on first use.
+    """
+    index = ArtifactIndex(source_dir)
+    if not index.is_backfilled():
+        runs = [
+            entry.name
+            for entry in os.scandir(source_dir)
+            if entry.is_dir() and not entry.name.startswith("tmp_")
+        ]
+        index.backfill(
+            runs,
+            iter_artifact_files,
+            lambda path: (
+                "complete"
+                if ProgressTracker._check_file_complete(Path(path))
+                else "incomplete"
+            ),
+        )
+    return index
+
+
 class ProgressTracker:
-    """Tracks download progress to enable resuming interrupted downloads."""
+    """
+    Tracks download progress to enable resuming interrupted downloads.
+
+    Completed datasets live in a snapshot (``.datasus_progress.json``) plus an
+    append-only journal (``.datasus_progress.journal``) with one JSON-encoded
+    dataset name per line. Marking a dataset appends one line under a lock,
+    so it costs O(1) and is safe from any number of threads. Every line is
+    flushed to the OS right away, which survives a killed process; fsyncs,
+    which guard against power loss, are batched. Once the journal grows past
+    COMPACT_THRESHOLD lines it is folded into the snapshot and replaced by a
+    new, empty journal file. Other processes notice the replacement when they
+    next lock the journal and reopen it, so nothing is written to the old file.
+
+    The lock is a POSIX record lock, like SQLite's and the work queue's, since
+    flock is not shared between hosts on some network filesystems. POSIX locks
+    are dropped when any handle of the file is closed, so the journal is only
+    ever read and written through the one handle that holds the lock.
+    """
+
+    FSYNC_BATCH = 32
+    FSYNC_INTERVAL_SECONDS = 5.0
+    COMPACT_THRESHOLD = 1000
 
     def __init__(self, output_dir: str):
         self.output_dir = output_dir
@@ -18,79 +88,207 @@ class ProgressTracker:
         # output_dir is like: /app/output/downloader/datasus/tmp_uuid
         # We want: /app/output/downloader/datasus/.datasus_progress.json
         parent_dir = os.path.dirname(output_dir)
+        os.makedirs(parent_dir, exist_ok=True)
         self.progress_file = os.path.join(parent_dir, ".datasus_progress.json")
+        self.journal_file = os.path.join(parent_dir, ".datasus_progress.journal")
         self.completed_datasets: Set[str] = set()
-        self._load_progress()
+        self._lock = threading.Lock()
+        self._journal_entries = 0
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self._journal = self._open_journal()
+        # Replaying may cut off a torn entry, so it runs under the lock too
+        self._lock_journal()
+        try:
+            self._load_progress()
+        finally:
+            self._unlock_journal()
+        # Files of every run, so previous runs are looked up instead of scanned
+        self.artifact_index = open_artifact_index(parent_dir)
 
     def _load_progress(self) -> None:
-        """Load progress from disk if it exists."""
+        """Load the snapshot, then replay the journal on top of it."""
+        self._load_snapshot()
+        self._replay_journal()
+
+        if self.completed_datasets:
+            logger.info(
+                f"Loaded progress: {len(self.completed_datasets)} "
+                "datasets already completed"
+            )
+        else:
+            logger.info("No previous progress found, starting fresh")
+
+    def _load_snapshot(self) -> None:
         if os.path.exists(self.progress_file):
             try:
-                with open(self.progress_file, "r", encoding="utf-8") as f:
-                    data = json.load(f)
-                    self.completed_datasets = set(data.get("completed_datasets", []))
-                    logger.info(
-                        f"Loaded progress: {len(self.completed_datasets)} datasets already completed"
-                    )
+                with open(self.progress_file, "rb") as f:
+                    data = codec.loads(f.read())
+                    self.completed_datasets |= set(data.get("completed_datasets", []))
             except Exception as e:
                 logger.warning(f"Failed to load progress file: {e}")
-                self.completed_datasets = set()
-        else:
-            logger.info("No previous progress found, starting fresh")
 
-    def _save_progress(self) -> None:
-        """Save current progress to disk."""
-        try:
-            # Ensure parent directory exists
-            os.makedirs(os.path.dirname(self.progress_file), exist_ok=True)
-            with open(self.progress_file, "w", encoding="utf-8") as f:
-                json.dump(
-                    {"completed_datasets": list(self.completed_datasets)},
-                    f,
-                    indent=2,
-                    ensure_ascii=False,
-                )
-        except Exception as e:
-            logger.error(f"Failed to save progress: {e}")
+    def _replay_journal(self) -> None:
+        self._journal.seek(0)
+        data = self._journal.read()
+        # A line without its newline was torn by a crash mid-write; cut it off
+        # so the next append starts on a clean line
+        complete_size = data.rfind(b"\n") + 1
+        if complete_size < len(data):
+            logger.warning(f"Dropping torn journal entry: {data[complete_size:]!r}")
+            self._journal.truncate(complete_size)
+
+        self._journal_entries = 0
+        for line in data[:complete_size].splitlines():
+            try:
+                self.completed_datasets.add(codec.loads(line))
+                self._journal_entries += 1
+            except ValueError:
+                logger.warning(f"Skipping invalid journal entry: {line!r}")
+
+    def _open_journal(self):
+        # Appends always go to the end; reads seek back for a replay
+        return open(self.journal_file, "a+b")
+
+    def _lock_journal(self) -> None:
+        """
+        Lock the journal for this process, first reopening it if another
+        process compacted it: the handle would still point to the old file.
+        """
+        while True:
+            fcntl.lockf(self._journal, fcntl.LOCK_EX)
+            try:
+                current = os.stat(self.journal_file).st_ino
+            except FileNotFoundError:
+                current = None
+            if current == os.fstat(self._journal.fileno()).st_ino:
+                return
+            # Closing the stale handle releases its lock
+            self._journal.close()
+            self._journal = self._open_journal()
+            self._journal_entries = 0
+
+    def _unlock_journal(self) -> None:
+        fcntl.lockf(self._journal, fcntl.LOCK_UN)
+
+    def _sync(self) -> None:
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def _compact(self) -> None:
+        """
+        Fold the journal into a new snapshot and start an empty journal.
+        Called with the journal locked; entries other processes appended
+        since we loaded are merged in first, so none are lost.
+        """
+        self._load_snapshot()
+        self._replay_journal()
+        snapshot = codec.dumps(
+            {"completed_datasets": sorted(self.completed_datasets)}, indent=True
+        )
+        tmp_path = self.progress_file + PART_SUFFIX
+        with open(tmp_path, "wb") as f:
+            f.write(snapshot)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.progress_file)
+        # If we die before the journal is replaced, replaying the old one over
+        # the new snapshot is harmless: entries are idempotent. The journal is
+        # replaced rather than truncated, because a truncated file would still
+        # be written to by processes that hold it open.
+        empty_path = self.journal_file + PART_SUFFIX
+        open(empty_path, "wb").close()
+        os.replace(empty_path, self.journal_file)
+        # Closing the old handle releases the lock; whoever waited for it
+        # sees the new file and reopens
+        self._journal.close()
+        self._journal = self._open_journal()
+        self._sync()
+        self._journal_entries = 0
+
+    def _append(self, dataset_name: str) -> None:
+        self._journal.write(codec.dumps(dataset_name) + b"\n")
+        self._journal.flush()
+        self._journal_entries += 1
+        self._unsynced += 1
+        if (
+            self._unsynced >= self.FSYNC_BATCH
+            or time.monotonic() - self._last_sync >= self.FSYNC_INTERVAL_SECONDS
+        ):
+            self._sync()
+        if self._journal_entries >= self.COMPACT_THRESHOLD:
+            self._compact()
 
     def is_completed(self, dataset_name: str) -> bool:
         """Check if a dataset has already been completed."""
         return dataset_name in self.completed_datasets
 
     def mark_completed(self, dataset_name: str) -> None:
-        """Mark a dataset as completed and save progress."""
-        self.completed_datasets.add(dataset_name)
-        self._save_progress()
-        logger.info(
-            f"Marked {dataset_name} as completed. Total: {len(self.completed_datasets)}"
-        )
+        """
+        Mark a dataset as completed by appending it to the journal. It may
+        block on the journal lock and fsync, so async callers run it in a
+        thread; self._lock keeps concurrent calls apart.
+        """
+        with self._lock:
+            if dataset_name in self.completed_datasets:
+                return
+            self.completed_datasets.add(dataset_name)
+            try:
+                # The lock also serialises against other processes sharing the
+                # journal (e.g. several downloaders on one output directory)
+                self._lock_journal()
+                try:
+                    self._append(dataset_name)
+                finally:
+                    self._unlock_journal()
+            except OSError as e:
+                logger.error(f"Failed to save progress: {e}")
+            total = len(self.completed_datasets)
+        logger.info(f"Marked {dataset_name} as completed. Total: {total}")
 
-    def _check_openapi_file_complete(self, filepath: Path) -> bool:
+    @staticmethod
+    def _check_file_complete(filepath: Path) -> bool:
         """
-        Check if an OpenAPI JSON file is complete by verifying metadata status.
-        Returns True if file has status='complete', False otherwise.
+        Check if a downloaded file is complete without parsing its contents.
+
+        - NDJSON files, compressed or not: status from the sidecar manifest.
+        - Files with a ``.meta`` sidecar: recorded status and size.
+        - Legacy OpenAPI JSON files: the embedded metadata header, read from
+          the first few KB of the file.
+        - Anything else predates sidecars and is trusted if it exists.
+
+        Returns True if the file is complete, False otherwise.
         """
         try:
-            with open(filepath, "r", encoding="utf-8") as f:
-                data = json5.load(f)
-                metadata = data.get("metadata", {})
+            if logical_path(filepath.name).endswith(NDJSON_SUFFIX):
+                metadata = read_manifest(manifest_path_for(str(filepath))) or {}
                 status = metadata.get("status", "")
+            elif (metadata := read_meta(str(filepath))) is not None:
+                status = (
+                    "complete"
+                    if is_meta_complete(str(filepath), metadata)
+                    else metadata.get("status", "size mismatch")
+                )
+            elif filepath.suffix == ".json":
+                metadata = read_embedded_metadata(str(filepath)) or {}
+                status = metadata.get("status", "")
+            else:
+                return True
 
-                if status == "complete":
-                    logger.debug(
-                        f"OpenAPI file {filepath.name} is complete "
-                        f"({metadata.get('total_records', 0)} records, "
-                        f"{metadata.get('pages_downloaded', 0)} pages)"
-                    )
-                    return True
-                else:
-                    logger.warning(
-                        f"OpenAPI file {filepath.name} is incomplete "
-                        f"(status: {status})"
-                    )
-                    return False
+            if status == "complete":
+                logger.debug(
+                    f"File {filepath.name} is complete "
+                    f"({metadata.get('total_records', 0)} records, "
+                    f"{metadata.get('pages_downloaded', 0)} pages)"
+                )
+                return True
+            else:
+                logger.warning(f"File {filepath.name} is incomplete (status: {status})")
+                return False
         except Exception as e:
-            logger.warning(f"Failed to check OpenAPI file {filepath.name}: {e}")
+            logger.warning(f"Failed to check file {filepath.name}: {e}")
             return False
 
     def _verify_files_in_directory(
@@ -102,29 +300,29 @@ class ProgressTracker:
         Args:
             directory: Directory to check
             dataset_name: Name of the dataset
-            check_openapi: If True, also verify OpenAPI file completeness
+            check_openapi: If True, also verify file completeness from the
+                sidecar/manifest/header metadata
 
         Returns:
-            True if files exist (and are complete for OpenAPI), False otherwise
+            True if files exist (and are complete), False otherwise
         """
-        matching_files = list(directory.glob(f"{dataset_name}_*"))
+        # Partial downloads (.part) are resumable leftovers, not finished files,
+        # and manifests/.meta files describe the data file next to them
+        matching_files = [
+            f
+            for f in directory.glob(f"{dataset_name}_*")
+            if f.suffix not in (PART_SUFFIX, META_SUFFIX)
+            and not f.name.endswith(MANIFEST_SUFFIX)
+        ]
 
         if not matching_files:
             return False
 
-        # For OpenAPI files, check completeness
         if check_openapi:
-            json_files = [f for f in matching_files if f.suffix == ".json"]
-            if json_files:
-                # All JSON files must be complete
-                all_complete = all(
-                    self._check_openapi_file_complete(f) for f in json_files
-                )
-                if not all_complete:
-                    logger.warning(
-                        f"Dataset {dataset_name} has incomplete OpenAPI files"
-                    )
-                    return False
+            all_complete = all(self._check_file_complete(f) for f in matching_files)
+            if not all_complete:
+                logger.warning(f"Dataset {dataset_name} has incomplete files")
+                return False
 
         logger.info(
             f"Found {len(matching_files)} complete files for dataset {dataset_name} "
@@ -136,9 +334,11 @@ class ProgressTracker:
         """
         Verify if dataset files already exist on disk and are complete.
         This helps resume downloads that were interrupted.
-        Checks both current tmp directory and previous timestamped directories.
+        Checks the current tmp directory on disk and previous timestamped
+        runs through the artifact index.
 
-        For OpenAPI JSON files, verifies that metadata.status == 'complete'.
+        Completeness is read from sidecar metadata (manifest, .meta or the
+        header of legacy OpenAPI JSON files), never by parsing whole files.
         """
         # Check current output directory (tmp_uuid)
         path = Path(output_dir)
@@ -146,19 +346,43 @@ class ProgressTracker:
             if self._verify_files_in_directory(path, dataset_name, check_openapi=True):
                 return True
 
-        # Also check parent directory for timestamped folders from previous runs
-        parent_dir = Path(output_dir).parent
-        if parent_dir.exists():
-            # Look for timestamped directories (format: YYYYMMDD_HHMMSS)
-            for subdir in parent_dir.iterdir():
-                if subdir.is_dir() and not subdir.name.startswith("tmp_"):
-                    if self._verify_files_in_directory(
-                        subdir, dataset_name, check_openapi=True
-                    ):
-                        return True
+        # Previous runs come from the artifact index: a run counts if every
+        # file it holds for this dataset is complete
+        current_run = os.path.basename(os.path.normpath(output_dir))
+        runs = {}
+        for artifact in self.artifact_index.find_prefix(f"{dataset_name}_"):
+            if artifact.run == current_run or artifact.run.startswith("tmp_"):
+                continue
+            if "/" in artifact.relpath:
+                continue
+            runs.setdefault(artifact.run, []).append(artifact)
+
+        for run, artifacts in runs.items():
+            if all(a.status == "complete" for a in artifacts):
+                logger.info(
+                    f"Found {len(artifacts)} complete files for dataset "
+                    f"{dataset_name} in run {run}"
+                )
+                return True
+            logger.warning(f"Dataset {dataset_name} has incomplete files in run {run}")
 
         return False
 
+    def close(self) -> None:
+        with self._lock:
+            try:
+                self._lock_journal()
+                if self._journal_entries:
+                    self._compact()
+                else:
+                    self._sync()
+            except OSError as e:
+                logger.error(f"Failed to save progress: {e}")
+            finally:
+                # Closing the file releases the lock
+                self._journal.close()
+        self.artifact_index.close()
+
     def get_stats(self) -> dict:
         """Get current progress statistics."""
         return {"completed_datasets": len(self.completed_datasets)}
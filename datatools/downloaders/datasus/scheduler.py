@@ -0,0 +1,83 @@
+"""
+Size-aware scheduling of DATASUS file downloads.
+
+Datasets used to be downloaded in listing order, so a few multi-GB datasets
+found late in the catalogue ran alone at the end of a crawl while the other
+workers sat idle. Prepared downloads now wait in a ``SizeScheduler`` and the
+file workers always take the largest one known (longest processing time
+first), which keeps the tail of the crawl short.
+
+Sizes come from the artifact history when an earlier run downloaded the
+dataset, otherwise from ``HEAD``/``Content-Length``. Downloads of unknown size
+go last: they are mostly API resources and small pages.
+"""
+
+import asyncio
+import itertools
+import logging
+from typing import Dict, Optional
+
+from .http_client import build_full_url
+from .segmented import probe_resource
+from .types import DownloadContext
+
+logger = logging.getLogger("downloader:DATASUS:scheduler")
+
+UNKNOWN_SIZE = 0
+
+
+def size_from_history(ctx: DownloadContext) -> Optional[int]:
+    """Bytes the dataset took in the newest earlier run that downloaded it."""
+    if ctx.artifact_index is None:
+        return None
+    sizes_by_run: Dict[str, int] = {}
+    for artifact in ctx.artifact_index.find_prefix(f"{ctx.dataset_name}_"):
+        if artifact.run.startswith("tmp_") or "/" in artifact.relpath:
+            continue
+        if artifact.size is not None:
+            previous = sizes_by_run.get(artifact.run, 0)
+            sizes_by_run[artifact.run] = previous + artifact.size
+    if not sizes_by_run:
+        return None
+    return sizes_by_run[max(sizes_by_run)]
+
+
+async def estimate_size(ctx: DownloadContext) -> int:
+    size = size_from_history(ctx)
+    if size is not None:
+        return size
+    if ctx.file_type == "api":
+        return UNKNOWN_SIZE
+    probe = await probe_resource(ctx.engine, build_full_url(ctx.download_href))
+    return probe.size if probe else UNKNOWN_SIZE
+
+
+class SizeScheduler:
+    """Queue of prepared downloads handing out the largest one first."""
+
+    def __init__(self):
+        self._queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
+        # Ties keep discovery order, and contexts are never compared
+        self._order = itertools.count()
+        self.queued_bytes = 0
+
+    async def put(self, ctx: DownloadContext, size: int) -> None:
+        self.queued_bytes += size
+        logger.debug(
+            f"Scheduled {ctx.dataset_name} ({size} bytes), "
+            f"{self._queue.qsize() + 1} waiting"
+        )
+        await self._queue.put((-size, next(self._order), ctx))
+
+    async def get(self) -> Optional[DownloadContext]:
+        """The largest waiting download, or None once the scheduler is closed."""
+        negative_size, _, ctx = await self._queue.get()
+        if ctx is not None:
+            self.queued_bytes += negative_size
+        return ctx
+
+    async def close(self, workers: int) -> None:
+        """Tell the workers no more downloads will come, after the queued ones."""
+        for _ in range(workers):
+            # Sorts after every real entry
+            await self._queue.put((float("inf"), next(self._order), None))
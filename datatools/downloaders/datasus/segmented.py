@@ -0,0 +1,259 @@
+import asyncio
+import base64
+import hashlib
+import logging
+import os
+from dataclasses import dataclass
+from typing import Optional
+
+import httpx
+
+from ..conditional import Validators
+from ..hashing import format_digest, new_hasher
+from . import codec
+from .engine import DownloadEngine
+from .types import (
+    CHUNK_SIZE,
+    FILE_RETRY_POLICY,
+    PART_SUFFIX,
+    RemoteChangedError,
+    TransferError,
+)
+
+logger = logging.getLogger("downloader:DATASUS:segmented")
+
+# Stored as "<name>.segments.part" so it is treated like any other partial file
+SEGMENTS_STATE_SUFFIX = ".segments"
+
+
+@dataclass
+class ResourceProbe:
+    size: int
+    accepts_ranges: bool
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    content_md5: Optional[str] = None
+
+    @property
+    def validators(self) -> Validators:
+        return Validators(self.etag, self.last_modified)
+
+
+async def probe_resource(
+    engine: DownloadEngine, url: str, auth: Optional[httpx.BasicAuth] = None
+) -> Optional[ResourceProbe]:
+    """
+    Ask the server for the size of a resource and whether it serves byte ranges.
+    Returns None if the server does not answer HEAD or omits Content-Length.
+    """
+    try:
+        response = await engine.request(
+            "HEAD", url, auth=auth, headers={"Accept-Encoding": "identity"}
+        )
+        response.raise_for_status()
+    except httpx.HTTPError as e:
+        logger.debug(f"HEAD request failed for {url}: {e}")
+        return None
+
+    content_length = response.headers.get("Content-Length", "")
+    if not content_length.isdigit():
+        return None
+
+    return ResourceProbe(
+        size=int(content_length),
+        accepts_ranges=response.headers.get("Accept-Ranges", "").lower() == "bytes",
+        etag=response.headers.get("ETag"),
+        last_modified=response.headers.get("Last-Modified"),
+        content_md5=response.headers.get("Content-MD5"),
+    )
+
+
+def split_ranges(size: int, segments: int) -> list[list[int]]:
+    """Split [0, size) into inclusive [start, end] byte ranges."""
+    segment_size = -(-size // segments)
+    return [
+        [start, min(start + segment_size, size) - 1]
+        for start in range(0, size, segment_size)
+    ]
+
+
+def preallocate(path: str, size: int) -> None:
+    """Reserve ``size`` bytes on disk up front so positional writes never grow it."""
+    with open(path, "wb") as f:
+        if hasattr(os, "posix_fallocate"):
+            os.posix_fallocate(f.fileno(), 0, size)
+        else:
+            f.truncate(size)
+
+
+def load_segments_state(state_path: str, probe: ResourceProbe) -> Optional[dict]:
+    if not os.path.exists(state_path):
+        return None
+    try:
+        with open(state_path, "rb") as f:
+            state = codec.loads(f.read())
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable segment state {state_path}: {e}")
+        return None
+
+    if (
+        state.get("size") != probe.size
+        or state.get("etag") != probe.etag
+        or state.get("last_modified") != probe.last_modified
+    ):
+        logger.info(f"Remote file changed since {state_path} was written, restarting")
+        return None
+    return state
+
+
+def save_segments_state(state_path: str, state: dict) -> None:
+    tmp_path = f"{state_path}.tmp{PART_SUFFIX}"
+    with open(tmp_path, "wb") as f:
+        f.write(codec.dumps(state))
+    os.replace(tmp_path, state_path)
+
+
+async def fetch_segment(
+    engine: DownloadEngine,
+    url: str,
+    fd: int,
+    segment: list[int],
+    probe: ResourceProbe,
+    auth: Optional[httpx.BasicAuth] = None,
+) -> None:
+    """
+    Download the inclusive byte range ``segment`` of ``url`` with positional
+    writes. ``segment[0]`` advances as bytes land on disk, so after a failure
+    it points at the first byte still missing.
+
+    Every request carries ``If-Range`` with the probed validators, so a
+    changed file comes back whole (200) instead of as a range of the new
+    version; that, or a ``Content-Range`` other than the one requested,
+    raises RemoteChangedError before anything is written.
+    """
+    start, end = segment
+    headers = {"Accept-Encoding": "identity", "Range": f"bytes={start}-{end}"}
+    if_range = probe.validators.if_range()
+    if if_range:
+        headers["If-Range"] = if_range
+    async with engine.stream("GET", url, auth=auth, headers=headers) as response:
+        response.raise_for_status()
+        if response.status_code != 206:
+            raise RemoteChangedError(
+                f"Got {response.status_code} instead of range {start}-{end} of "
+                f"{url}: the file changed or the server ignored Range"
+            )
+        content_range = response.headers.get("Content-Range")
+        if content_range not in (
+            f"bytes {start}-{end}/{probe.size}",
+            f"bytes {start}-{end}/*",
+        ):
+            raise RemoteChangedError(
+                f"Asked for bytes {start}-{end}/{probe.size} of {url}, "
+                f"got Content-Range {content_range}"
+            )
+
+        async for chunk in response.aiter_bytes():
+            os.pwrite(fd, chunk, segment[0])
+            segment[0] += len(chunk)
+
+    if segment[0] != end + 1:
+        raise TransferError(
+            f"Segment {start}-{end} of {url} ended early at {segment[0]}"
+        )
+
+
+def verify_download(path: str, probe: ResourceProbe) -> str:
+    """
+    Check the final size and, when the server announced one, the MD5.
+    Returns the content hash of the file for its sidecar.
+    """
+    size = os.path.getsize(path)
+    if size != probe.size:
+        raise TransferError(f"Size mismatch for {path}: {size} != {probe.size}")
+
+    # Segments arrive out of order, so the file is hashed in one pass at the end
+    hasher = new_hasher()
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            hasher.update(chunk)
+            if probe.content_md5:
+                md5.update(chunk)
+    if (
+        probe.content_md5
+        and base64.b64encode(md5.digest()).decode() != probe.content_md5
+    ):
+        raise TransferError(f"Content-MD5 mismatch for {path}")
+    return format_digest(hasher)
+
+
+async def download_segmented(
+    engine: DownloadEngine,
+    url: str,
+    save_path: str,
+    probe: ResourceProbe,
+    segments: int,
+    auth: Optional[httpx.BasicAuth] = None,
+) -> str:
+    """
+    Fetch ``url`` as ``segments`` concurrent byte ranges into a preallocated
+    ``.part`` file and rename it to ``save_path`` once verified.
+
+    Segment progress is recorded in a ``.segments.part`` sidecar, so a retry
+    only fetches the bytes that are still missing. Raises on failure; returns
+    the content hash of the verified file.
+    """
+    part_path = save_path + PART_SUFFIX
+    state_path = save_path + SEGMENTS_STATE_SUFFIX + PART_SUFFIX
+
+    state = load_segments_state(state_path, probe)
+    if state is None or not os.path.exists(part_path):
+        state = {
+            "size": probe.size,
+            "etag": probe.etag,
+            "last_modified": probe.last_modified,
+            "segments": split_ranges(probe.size, segments),
+        }
+        preallocate(part_path, probe.size)
+        save_segments_state(state_path, state)
+
+    pending = [segment for segment in state["segments"] if segment[0] <= segment[1]]
+    logger.info(
+        f"Segmented download of {url}: {probe.size} bytes, "
+        f"{len(pending)}/{len(state['segments'])} segments pending"
+    )
+
+    fd = os.open(part_path, os.O_WRONLY)
+    try:
+
+        async def run_segment(segment: list[int]) -> None:
+            try:
+                await fetch_segment(engine, url, fd, segment, probe, auth)
+            finally:
+                os.fsync(fd)
+                save_segments_state(state_path, state)
+
+        results = await asyncio.gather(
+            *(run_segment(segment) for segment in pending), return_exceptions=True
+        )
+    finally:
+        os.close(fd)
+
+    errors = [result for result in results if isinstance(result, Exception)]
+    if any(isinstance(error, RemoteChangedError) for error in errors):
+        # The bytes on disk may belong to another version of the file
+        os.remove(part_path)
+        os.remove(state_path)
+    # Errors that a retry won't fix, like a full disk, are raised as they are
+    for error in errors:
+        if not FILE_RETRY_POLICY.is_retryable(error):
+            raise error
+    if errors:
+        raise TransferError(f"{len(errors)} segment(s) failed for {url}: {errors[0]}")
+
+    # A full pass over a large file, kept off the event loop
+    content_hash = await asyncio.to_thread(verify_download, part_path, probe)
+    os.replace(part_path, save_path)
+    os.remove(state_path)
+    return content_hash
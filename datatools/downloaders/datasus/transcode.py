@@ -0,0 +1,305 @@
+"""
+Transcoding of downloaded DATASUS CSV and ZIP resources to Parquet.
+
+DATASUS publishes most tabular data as latin-1, semicolon-delimited CSV files,
+bare or inside ZIP archives, often several GB large. With transcoding enabled
+every such file is converted, as soon as it is downloaded, into a typed,
+zstd-compressed table under ``<run>/parquet/datasus_files/file=<name>/``, so
+later analyses don't parse the raw text again.
+
+The work runs in a process pool next to the network workers. The encoding of
+each CSV (or ZIP member) is sniffed from its first MBs; the stream is then
+decoded in batches of whole records, and every batch is parsed by polars and
+written as one ``part-<nnnnn>.parquet`` of the partition. Memory stays bounded by
+the batch size and nothing but the Parquet parts is written to disk.
+Rows with more fields than the header are cut to its width, and the number
+of rows that lost values that way is logged for each file.
+"""
+
+import asyncio
+import codecs
+import csv
+import io
+import logging
+import multiprocessing
+import os
+import re
+import shutil
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import IO, Callable, Iterator, List, Optional, Tuple
+
+import polars as pl
+
+# parquet imports the datasus package too; its names are looked up on use
+from .. import parquet
+
+logger = logging.getLogger("downloader:DATASUS:transcode")
+
+TABLE = "datasus_files"
+# Tried in order; latin-1 decodes any byte sequence, so it always succeeds
+SOURCE_ENCODINGS = ("utf-8-sig", "latin-1")
+DELIMITERS = (";", ",", "\t", "|")
+# Rows used to infer column types before falling back to all-string columns
+INFER_SCHEMA_LENGTH = 10_000
+SNIFF_BYTES = 4 * 1024 * 1024
+BATCH_BYTES = 64 * 1024 * 1024
+
+
+def sniff_encoding(open_source: Callable[[], IO[bytes]]) -> str:
+    """The first of SOURCE_ENCODINGS that decodes the start of the stream."""
+    with open_source() as source:
+        head = source.read(SNIFF_BYTES)
+    for encoding in SOURCE_ENCODINGS[:-1]:
+        try:
+            # Not final: the sample may end inside a multi-byte character
+            codecs.getincrementaldecoder(encoding)().decode(head)
+            return encoding
+        except UnicodeDecodeError:
+            continue
+    return SOURCE_ENCODINGS[-1]
+
+
+def split_records(text: str) -> Tuple[str, str]:
+    """Split text after its last complete record; a quoted newline isn't one."""
+    quotes = text.count('"')
+    end = len(text)
+    while (newline := text.rfind("\n", 0, end)) >= 0:
+        quotes -= text.count('"', newline, end)
+        if quotes % 2 == 0:
+            return text[: newline + 1], text[newline + 1 :]
+        end = newline
+    # Unbalanced quotes all the way back: cut at the last line to bound memory
+    cut = text.rfind("\n") + 1
+    return text[:cut], text[cut:]
+
+
+def iter_batches(open_source: Callable[[], IO[bytes]], encoding: str) -> Iterator[str]:
+    """Decoded text of about BATCH_BYTES at a time, cut between records."""
+    decoder = codecs.getincrementaldecoder(encoding)()
+    pending = ""
+    with open_source() as source:
+        while chunk := source.read(BATCH_BYTES):
+            batch, pending = split_records(pending + decoder.decode(chunk))
+            if batch:
+                yield batch
+    pending += decoder.decode(b"", final=True)
+    if pending.strip():
+        yield pending
+
+
+def sniff_delimiter(text: str) -> str:
+    header = text.partition("\n")[0]
+    return max(DELIMITERS, key=header.count)
+
+
+def count_ragged_rows(
+    text: str, separator: str, width: Optional[int]
+) -> Tuple[int, int]:
+    """
+    Rows with more fields than ``width`` (the first row's when None), and how
+    many of them have values in the extra fields.
+    """
+    rows = csv.reader(io.StringIO(text, newline=""), delimiter=separator)
+    if width is None:
+        width = len(next(rows, []))
+    ragged = lossy = 0
+    for row in rows:
+        if len(row) > width:
+            ragged += 1
+            lossy += any(field.strip() for field in row[width:])
+    return ragged, lossy
+
+
+def read_batch(
+    text: str, separator: str, width: Optional[int], **read_options
+) -> Tuple[pl.DataFrame, int]:
+    """
+    Parse a batch of records. Rows with more fields than the header are cut
+    to fit; returns the frame and how many rows lost values that way.
+    """
+    data = io.BytesIO(text.encode("utf-8"))
+    try:
+        return pl.read_csv(data, separator=separator, **read_options), 0
+    except (pl.exceptions.ComputeError, pl.exceptions.SchemaError):
+        # Only counted on failure, so well-formed batches are parsed once
+        ragged, lossy = count_ragged_rows(text, separator, width)
+        if not ragged:
+            raise
+    data.seek(0)
+    # extra_columns covers a ragged first row when the schema is given
+    frame = pl.read_csv(
+        data,
+        separator=separator,
+        truncate_ragged_lines=True,
+        extra_columns="ignore",
+        **read_options,
+    )
+    return frame, lossy
+
+
+def write_parts(batches: Iterator[str], directory: str, **schema_options) -> int:
+    """
+    Write each batch as a Parquet part, all with the schema of the first.
+    Returns the number of rows whose values past the header's were dropped.
+    """
+    separator = None
+    schema = None
+    truncated = 0
+    for number, text in enumerate(batches):
+        if schema is None:
+            separator = sniff_delimiter(text)
+            frame, lossy = read_batch(text, separator, None, **schema_options)
+            schema = frame.schema
+        else:
+            frame, lossy = read_batch(
+                text, separator, len(schema), has_header=False, schema=schema
+            )
+        truncated += lossy
+        frame.write_parquet(
+            os.path.join(directory, parquet.PART_FILENAME.format(number)),
+            compression=parquet.COMPRESSION,
+            statistics=True,
+        )
+    return truncated
+
+
+def write_partition(
+    open_source: Callable[[], IO[bytes]], encoding: str, directory: str
+) -> int:
+    """
+    Stream a CSV into Parquet parts, typed where inference allows. Returns
+    the number of rows truncated to the header's width.
+    """
+
+    def write(**schema_options) -> int:
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+        return write_parts(
+            iter_batches(open_source, encoding), directory, **schema_options
+        )
+
+    try:
+        return write(infer_schema_length=INFER_SCHEMA_LENGTH)
+    except pl.exceptions.PolarsError:
+        # A column changed type after the inferred rows; keep everything as text
+        return write(infer_schema=False)
+
+
+@dataclass
+class Partition:
+    path: str
+    # Rows with values past the header's last column, which were dropped
+    truncated_rows: int = 0
+
+
+def transcode_stream(
+    open_source: Callable[[], IO[bytes]], run_dir: str, name: str
+) -> Optional[Partition]:
+    """Write one CSV stream as the ``file=<name>`` partition; None if it exists."""
+    partition_dir = parquet.partition_dir(run_dir, TABLE, "file", name)
+    if os.path.exists(partition_dir):
+        return None
+    with parquet.staged_partition(run_dir, TABLE, "file", name) as staging_dir:
+        try:
+            truncated = write_partition(
+                open_source, sniff_encoding(open_source), staging_dir
+            )
+        except UnicodeDecodeError:
+            # Valid UTF-8 only in the sniffed head; latin-1 decodes anything
+            truncated = write_partition(open_source, SOURCE_ENCODINGS[-1], staging_dir)
+    return Partition(partition_dir, truncated)
+
+
+def csv_members(archive: zipfile.ZipFile) -> List[str]:
+    return [
+        info.filename
+        for info in archive.infolist()
+        if not info.is_dir() and info.filename.lower().endswith(".csv")
+    ]
+
+
+def member_name(stem: str, member: str) -> str:
+    member_stem = os.path.splitext(os.path.basename(member))[0]
+    return f"{stem}__{re.sub(r'[^0-9A-Za-z_.-]+', '_', member_stem)}"
+
+
+def transcode_file(raw_path: str, run_dir: str, keep_raw: bool) -> List[Partition]:
+    """
+    Convert a downloaded CSV or ZIP of CSVs; returns the partitions written.
+
+    Runs in a worker process. The raw file is removed afterwards unless
+    keep_raw, and only if it held at least one CSV.
+    """
+    stem, extension = os.path.splitext(os.path.basename(raw_path))
+    written = []
+    if extension.lower() == ".zip":
+        with zipfile.ZipFile(raw_path) as archive:
+            members = csv_members(archive)
+            for member in members:
+                name = stem if len(members) == 1 else member_name(stem, member)
+                written.append(
+                    transcode_stream(lambda: archive.open(member), run_dir, name)
+                )
+        converted = bool(members)
+    else:
+        written.append(transcode_stream(lambda: open(raw_path, "rb"), run_dir, stem))
+        converted = True
+
+    if converted and not keep_raw:
+        os.remove(raw_path)
+    return [partition for partition in written if partition is not None]
+
+
+class Transcoder:
+    """Process pool transcoding files while the network workers carry on."""
+
+    def __init__(self, run_dir: str, workers: int, keep_raw: bool = True):
+        self.run_dir = run_dir
+        self.keep_raw = keep_raw
+        # polars is multithreaded and not fork-safe
+        self._executor = ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        )
+        self._pending: set[asyncio.Future] = set()
+        self.converted = 0
+        self.failed = 0
+        self.truncated_rows = 0
+
+    def submit(self, raw_path: str) -> None:
+        """Queue a downloaded file for transcoding without waiting for it."""
+        future = asyncio.get_running_loop().run_in_executor(
+            self._executor, transcode_file, raw_path, self.run_dir, self.keep_raw
+        )
+        self._pending.add(future)
+        future.add_done_callback(lambda f: self._finished(raw_path, f))
+
+    def _finished(self, raw_path: str, future: asyncio.Future) -> None:
+        self._pending.discard(future)
+        if future.exception() is not None:
+            self.failed += 1
+            logger.error(f"Failed to transcode {raw_path}: {future.exception()}")
+            return
+        written = future.result()
+        self.converted += len(written)
+        logger.info(f"Transcoded {raw_path} into {len(written)} partition(s)")
+        for partition in written:
+            if partition.truncated_rows:
+                self.truncated_rows += partition.truncated_rows
+                logger.warning(
+                    f"{partition.truncated_rows} row(s) of {raw_path} had more "
+                    f"fields than the header; their extra values are missing "
+                    f"from {partition.path}"
+                )
+
+    async def close(self) -> None:
+        """Wait for the queued files and shut the pool down."""
+        if self._pending:
+            logger.info(f"Waiting for {len(self._pending)} file(s) to transcode")
+            await asyncio.gather(*self._pending, return_exceptions=True)
+        self._executor.shutdown()
+        logger.info(
+            f"Transcoding finished: {self.converted} partition(s), "
+            f"{self.failed} failure(s), {self.truncated_rows} truncated row(s)"
+        )
@@ -1,6 +1,12 @@
 from dataclasses import dataclass
+from typing import TYPE_CHECKING, Optional
 
-from bs4 import BeautifulSoup
+from ..retry import RetryPolicy
+
+if TYPE_CHECKING:
+    from ..artifact_index import ArtifactIndex
+    from .engine import DownloadEngine
+    from .transcode import Transcoder
 
 FILE_FORMAT_PRIORITY = [
     "api",
@@ -20,13 +26,123 @@ PRE_URL_API = "https://apidadosabertos.saude.gov.br"
 OPEN_API_URL = "https://apidadosabertos.saude.gov.br/"
 
 MAX_RETRIES = 5
-RETRY_DELAY_SECONDS = 20
 REQUEST_TIMEOUT = 30
 
 
+class TransferError(IOError):
+    """A download was cut short or its bytes don't match what was announced."""
+
+
+class RemoteChangedError(Exception):
+    """
+    A resource changed while it was downloaded in segments. Not an IOError,
+    so it is not retried against the stale probe; the next run starts over.
+    """
+
+
+# Transient failures are retried with jittered exponential backoff (see
+# ..retry). File downloads also retry interrupted or short transfers, which
+# the streaming and segmented downloaders report as TransferError; other
+# OSErrors, like a full disk, are not worth retrying.
+RETRY_POLICY = RetryPolicy(max_attempts=MAX_RETRIES)
+FILE_RETRY_POLICY = RetryPolicy(max_attempts=MAX_RETRIES, retry_on=(TransferError,))
+
+# Files are streamed to "<name>.part" in CHUNK_SIZE pieces and renamed once
+# complete, so an interrupted download can be resumed with a Range request.
+CHUNK_SIZE = 1024 * 1024
+PART_SUFFIX = ".part"
+
+# Opt-in segmented downloads: files of at least SEGMENT_THRESHOLD bytes are
+# fetched as several concurrent byte ranges when the server allows it.
+DEFAULT_SEGMENTS = 1
+SEGMENT_THRESHOLD = 512 * 1024 * 1024
+
+# Maximum number of in-flight requests per host. Hosts not listed here use
+# DEFAULT_HOST_CONCURRENCY (overridden by the number of download workers).
+DEFAULT_HOST_CONCURRENCY = 4
+HOST_CONCURRENCY_LIMITS = {
+    "opendatasus.saude.gov.br": 8,
+    "apidadosabertos.saude.gov.br": 4,
+}
+
+# Discovery pipeline: how many catalogue listing pages are crawled at once, how
+# many parsed datasets may wait to be prepared, and how many workers resolve
+# their download links and sizes for the download workers.
+LISTING_PAGE_CONCURRENCY = 2
+DISCOVERY_QUEUE_SIZE = 8
+PREPARE_WORKERS = 4
+
+# In-memory budget of the per-run HTML page cache
+PAGE_CACHE_BYTES = 64 * 1024 * 1024
+
+# Opt-in transcoding of downloaded CSV/ZIP resources to Parquet, done by a
+# pool of TRANSCODE_WORKERS processes while the crawl goes on
+TRANSCODED_FILE_TYPES = ("csv", "zip csv")
+TRANSCODE_WORKERS = 2
+
+# Task names in the work queue of a shared run (--shared-run)
+DATASET_TASK_PREFIX = "dataset/"
+OPENAPI_TASK = "openapi"
+
+
+@dataclass
+class DownloadOptions:
+    segments: int = DEFAULT_SEGMENTS
+    segment_threshold: int = SEGMENT_THRESHOLD
+    # Revalidate datasets finished by earlier runs instead of skipping them
+    refresh: bool = False
+    # Per-run cache of HTML pages; evicted pages go to a temp dir if spilling
+    page_cache_bytes: int = PAGE_CACHE_BYTES
+    page_cache_spill: bool = False
+    # Transcode CSV/ZIP resources to Parquet; the raw file is deleted after a
+    # successful conversion unless keep_raw
+    transcode: bool = False
+    keep_raw: bool = True
+    transcode_workers: int = TRANSCODE_WORKERS
+
+
+@dataclass
+class DatasetLink:
+    title: str
+    href: str
+
+
+@dataclass
+class ListingPage:
+    datasets: list[DatasetLink]
+    page_count: int
+
+
+@dataclass
+class ResourceLink:
+    # Anchor text: resource name followed by the format label
+    title: str
+    format: Optional[str]
+    href: Optional[str]
+    is_heading: bool = False
+
+
+@dataclass
+class DatasetPage:
+    resources: list[ResourceLink]
+
+
+@dataclass
+class ResourcePage:
+    download_href: Optional[str]
+    content_href: Optional[str]
+    username: Optional[str] = None
+    password: Optional[str] = None
+
+
+@dataclass
+class ApiConfigPage:
+    api_path: Optional[str]
+
+
 @dataclass
 class ResourceInfo:
-    resource: any
+    resource: ResourceLink
     priority: int
     name: str
     type: str
@@ -36,7 +152,7 @@ class ResourceInfo:
 class DatasetInfo:
     name: str
     url: str
-    page_content: BeautifulSoup
+    page: DatasetPage
 
 
 @dataclass
@@ -45,6 +161,35 @@ class DownloadContext:
     resource_name: str
     file_type: str
     output_dir: str
-    resource_page: BeautifulSoup
-    download_item: any
+    resource_page: ResourcePage
+    download_href: str
     dataset_info: DatasetInfo
+    engine: "DownloadEngine"
+    options: DownloadOptions
+    artifact_index: Optional["ArtifactIndex"] = None
+    transcoder: Optional["Transcoder"] = None
+
+
+@dataclass
+class CrawlStats:
+    discovered: int = 0
+    succeeded: int = 0
+    failed: int = 0
+    discovery_done: bool = False
+
+    @property
+    def processed(self) -> int:
+        return self.succeeded + self.failed
+
+    def record(self, success: bool) -> None:
+        if success:
+            self.succeeded += 1
+        else:
+            self.failed += 1
+
+    def progress(self) -> str:
+        total = str(self.discovered) if self.discovery_done else f"{self.discovered}+"
+        return (
+            f"Progress: {self.processed}/{total} "
+            f"(Success: {self.succeeded}, Failed: {self.failed})"
+        )
@@ -1,12 +1,18 @@
 import os
 import shutil
+from contextlib import nullcontext
 from datetime import datetime
 from uuid import uuid4
 
+from .artifact_index import INDEX_FILENAME, ArtifactIndex
 from .datasus.datasus import download_datasus_data
+from .datasus.types import DownloadOptions
 from .ibge.agregados import download_ibge_agregados
 from .ibge.localidades import download_ibge_localidades
+from .integrity import HASH_WORKERS, verify_run, write_run_manifest
 from .ipea.ipea import download_ipea_data
+from .parquet import write_parquet
+from .work_queue import WorkQueue, queue_path
 
 
 # In this function, download_path represents a temporary directory.
@@ -14,17 +20,33 @@ from .ipea.ipea import download_ipea_data
 # data is transferred to its final destination—a permanent directory
 # named with a unique identifying timestamp.
 def pick_downloader(
-    source: str, tmp_download_path: str, skip_files: list[str], max_workers: int = 4
+    source: str,
+    tmp_download_path: str,
+    skip_files: list[str],
+    max_workers: int = 4,
+    segments: int = 1,
+    segment_threshold_mb: int = 512,
+    refresh: bool = False,
+    parquet: bool = False,
+    keep_raw: bool = True,
+    queue: WorkQueue | None = None,
 ):
     match source:
         case "ipea":
-            download_ipea_data(tmp_download_path)
+            download_ipea_data(tmp_download_path, queue, refresh)
         case "ibge_localidades":
             download_ibge_localidades(tmp_download_path)
         case "ibge_agregados":
-            download_ibge_agregados(tmp_download_path, skip_files)
+            download_ibge_agregados(tmp_download_path, skip_files, queue, refresh)
         case "datasus":
-            download_datasus_data(tmp_download_path, max_workers)
+            options = DownloadOptions(
+                segments=segments,
+                segment_threshold=segment_threshold_mb * 1024 * 1024,
+                refresh=refresh,
+                transcode=parquet,
+                keep_raw=keep_raw,
+            )
+            download_datasus_data(tmp_download_path, max_workers, options, queue)
         case _:
             raise NotImplementedError
 
@@ -32,13 +54,43 @@ def pick_downloader(
 # Nothing bellow this comment needs to be modified when adding
 # a new downloading source
 def download_from_source(
-    source: str, download_path: str, skip: str | None, max_workers: int = 4
+    source: str,
+    download_path: str,
+    skip: str | None,
+    max_workers: int = 4,
+    segments: int = 1,
+    segment_threshold_mb: int = 512,
+    refresh: bool = False,
+    parquet: bool = False,
+    keep_raw: bool = True,
+    shared_run: str | None = None,
 ):
-    download_id = uuid4()
+    # Processes joining the same shared run download into one directory and
+    # split the work through a queue next to it; the last one to finish
+    # finalizes the run
+    download_id = shared_run or uuid4()
     tmp_path = f"{download_path}/{source}/tmp_{download_id}"
     os.makedirs(tmp_path, exist_ok=True)
     skip_files = read_skip_file(skip) if skip else []
-    pick_downloader(source, tmp_path, skip_files, max_workers)
+    with shared_queue(f"{download_path}/{source}", shared_run) as queue:
+        pick_downloader(
+            source,
+            tmp_path,
+            skip_files,
+            max_workers,
+            segments,
+            segment_threshold_mb,
+            refresh,
+            parquet,
+            keep_raw,
+            queue,
+        )
+        if queue is not None and not queue.leave():
+            print(f"Download concluded; another worker finalizes run {shared_run}")
+            return
+
+    if parquet:
+        write_parquet(source, tmp_path)
 
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     final_path = f"{download_path}/{source}/{timestamp}/"
@@ -46,14 +98,43 @@ def download_from_source(
     os.makedirs(final_path, exist_ok=True)
     move_content(tmp_path, final_path)
     os.rmdir(tmp_path)
+    rename_indexed_run(f"{download_path}/{source}", f"tmp_{download_id}", timestamp)
+    if shared_run:
+        os.remove(queue_path(f"{download_path}/{source}", shared_run))
+    write_run_manifest(final_path)
     print(f"Download concluded ({final_path})")
 
 
+def verify_download(run_dir: str, workers: int = HASH_WORKERS) -> bool:
+    """Re-check every file of a run against its manifest; True if all match."""
+    problems = verify_run(run_dir, workers)
+    for relpath, problem in sorted(problems.items()):
+        print(f"{relpath}: {problem}")
+    if problems:
+        print(f"{len(problems)} file(s) failed verification in {run_dir}")
+        return False
+    print(f"All files of {run_dir} match its manifest")
+    return True
+
+
+def shared_queue(source_dir: str, shared_run: str | None):
+    if not shared_run:
+        return nullcontext()
+    return WorkQueue(queue_path(source_dir, shared_run))
+
+
 def move_content(source_dir: str, destination: str):
     for file in os.listdir(source_dir):
         shutil.move(os.path.join(source_dir, file), destination)
 
 
+def rename_indexed_run(source_dir: str, tmp_run: str, final_run: str):
+    # Sources that keep an artifact index address files by run directory
+    if os.path.exists(os.path.join(source_dir, INDEX_FILENAME)):
+        with ArtifactIndex(source_dir) as index:
+            index.rename_run(tmp_run, final_run)
+
+
 def read_skip_file(file_path: str) -> list[str]:
     with open(file_path, "r") as f:
         content = f.read()
@@ -0,0 +1,85 @@
+"""
+Content hashing shared by the downloaders and the integrity manifests.
+
+Every content hash is a ``blake2b:<hex>`` string. Downloads hash their bytes
+while they stream in, through a ``StreamHasher`` backed by one thread pool per
+process; finished files are hashed with ``hash_file``. This module is a leaf:
+it imports nothing from the source packages, so hashing a file doesn't pull
+in a crawler.
+"""
+
+import hashlib
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional
+
+HASH_ALGORITHM = "blake2b"
+HASH_WORKERS = min(8, os.cpu_count() or 1)
+CHUNK_SIZE = 1024 * 1024
+
+_pool: Optional[ThreadPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def new_hasher() -> "hashlib._Hash":
+    return hashlib.blake2b()
+
+
+def format_digest(hasher: "hashlib._Hash") -> str:
+    return f"{HASH_ALGORITHM}:{hasher.hexdigest()}"
+
+
+def hash_file(
+    path: str, hasher: Optional["hashlib._Hash"] = None, limit: Optional[int] = None
+) -> "hashlib._Hash":
+    """Feed the first ``limit`` bytes of ``path`` (default: all) into a hasher."""
+    hasher = hasher or new_hasher()
+    remaining = limit
+    with open(path, "rb") as f:
+        while remaining is None or remaining > 0:
+            size = CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining)
+            chunk = f.read(size)
+            if not chunk:
+                break
+            hasher.update(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+    return hasher
+
+
+def hash_pool() -> ThreadPoolExecutor:
+    """Threads shared by every StreamHasher of the process."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(HASH_WORKERS, thread_name_prefix="hash")
+        return _pool
+
+
+class StreamHasher:
+    """
+    Hasher fed by a download loop. Chunks are hashed on the shared pool, in
+    order, so hashing overlaps with receiving and writing the next chunks
+    instead of blocking the event loop or re-reading the file afterwards.
+    hashlib releases the GIL on large buffers, so the threads run in parallel.
+    """
+
+    def __init__(self, hasher: Optional["hashlib._Hash"] = None):
+        self._hasher = hasher or new_hasher()
+        self._tail: Optional[Future] = None
+
+    def _update(self, previous: Optional[Future], chunk: bytes) -> None:
+        # The previous chunk was queued first, so it is running or done
+        if previous is not None:
+            previous.result()
+        self._hasher.update(chunk)
+
+    def update(self, chunk: bytes) -> None:
+        self._tail = hash_pool().submit(self._update, self._tail, chunk)
+
+    def hexdigest(self) -> str:
+        """Wait for the queued chunks and return the digest."""
+        if self._tail is not None:
+            self._tail.result()
+        return self._hasher.hexdigest()
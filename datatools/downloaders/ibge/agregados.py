@@ -1,42 +1,85 @@
-import json
+import asyncio
 import logging
 import os
-import time
+from typing import Dict, Optional
 
-import requests
+import httpx
+
+from ..artifact_index import Artifact, ArtifactIndex, clone_file
+from ..compression import artifact_path, candidate_paths, find_artifact
+from ..conditional import NotModified, Validators
+from ..datasus.artifact_meta import meta_path_for, read_meta, write_meta
+from ..rate_limiter import SlidingWindowLimiter
+from ..retry import CircuitBreaker, CircuitOpenError, RetryPolicy, retry_async
+from ..work_queue import WorkQueue, claim_task, remaining, working_on
+from .batches import Batch, estimate_periods, plan_batches, split_response
+from .writer import AggregateWriter, adopt_partial, metadata_hash
 
 logger = logging.getLogger("downloader: IBGE agregados")
 logging.basicConfig(level=logging.DEBUG)
 
+AGREGADOS_URL = "https://servicodados.ibge.gov.br/api/v3/agregados"
 DC_PLACES = ["N1", "N3", "N6"]
 MAX_CALLS_PER_INTERVAL = 120
 INTERVAL = 60
+RETRY_POLICY = RetryPolicy()
+REQUEST_TIMEOUT = 120
+
+# Every call, across all aggregates, takes a slot in one sliding window of
+# MAX_CALLS_PER_INTERVAL calls per INTERVAL seconds. AGGREGATE_CONCURRENCY
+# aggregates are processed side by side, each with one values call in flight,
+# so slow responses don't leave the budget unused; MAX_CONNECTIONS bounds how
+# many calls are in flight at once.
+AGGREGATE_CONCURRENCY = 16
+MAX_CONNECTIONS = 32
+
+
+class IncompleteAggregateError(Exception):
+    """Some values of an aggregate could not be fetched; its partial file stays."""
+
 
+class AgregadosClient:
+    """Rate-limited access to the IBGE agregados API shared by all tasks."""
+
+    def __init__(self, client: httpx.AsyncClient, limiter: SlidingWindowLimiter):
+        self.client = client
+        self.limiter = limiter
+        self.breaker = CircuitBreaker()
+
+    async def request_with_retries(
+        self, url: str, headers: Optional[dict] = None
+    ) -> Optional[httpx.Response]:
+        async def request() -> httpx.Response:
+            await self.limiter.acquire()
+            logger.debug(f"Making API call: {url}")
+            r = await self.client.get(url, headers=headers)
+            if r.status_code != 304:
+                r.raise_for_status()
+            logger.debug("Request concluded")
+            return r
 
-def make_api_call(url: str):
-    retries = 0
-    max_retries = 5
-    while retries < max_retries:
         try:
-            logger.debug(f"Making API call: {url} {retries=}")
-            r = requests.get(url, timeout=120)
-            if r.status_code == 200:
-                logger.debug("Request concluded")
-                return r.json()
-        except requests.exceptions.Timeout:
-            logger.error("Request timeout")
-        except Exception as e:
-            logger.error(f"Request failed: Status {e}")
+            return await retry_async(request, url, RETRY_POLICY, self.breaker, logger)
+        except (httpx.HTTPError, CircuitOpenError) as e:
+            logger.error(f"Request failed for {url}: {e}")
+            return None
 
-        retries += 1
-        logger.debug(f"Retrying after sleep time: {retries=}")
-        time.sleep(120)
+    async def make_api_call(self, url: str):
+        r = await self.request_with_retries(url)
+        return r.json() if r is not None else {}
 
-    return {}
+    async def make_conditional_api_call(self, url: str, validators: Validators):
+        """Like make_api_call, but raises NotModified if the server answers 304."""
+        r = await self.request_with_retries(url, validators.request_headers())
+        if r is None:
+            return {}, Validators()
+        if r.status_code == 304:
+            raise NotModified(url)
+        return r.json(), Validators.from_headers(r.headers)
 
 
-def get_aggregates() -> list[str]:
-    aggregates_json = make_api_call("https://servicodados.ibge.gov.br/api/v3/agregados")
+async def get_aggregates(api: AgregadosClient) -> list[str]:
+    aggregates_json = await api.make_api_call(AGREGADOS_URL)
     return [
         aggregate["id"]
         for item in aggregates_json
@@ -44,27 +87,166 @@ def get_aggregates() -> list[str]:
     ]
 
 
-def get_aggregates_metadata(aggregate_id: str) -> dict:
-    return make_api_call(
-        f"https://servicodados.ibge.gov.br/api/v3/agregados/{aggregate_id}/metadados"
+def get_aggregates_metadata_url(aggregate_id: str) -> str:
+    return f"{AGREGADOS_URL}/{aggregate_id}/metadados"
+
+
+async def get_aggregates_metadata(api: AgregadosClient, aggregate_id: str) -> dict:
+    return await api.make_api_call(get_aggregates_metadata_url(aggregate_id))
+
+
+def get_values_url(aggregate_id: str, variable_ids: list, place_ids: list) -> str:
+    variables = "|".join(str(variable_id) for variable_id in variable_ids)
+    places = "|".join(place_ids)
+    return (
+        f"{AGREGADOS_URL}/{aggregate_id}/periodos/-100/variaveis/{variables}"
+        f"?localidades={places}"
     )
 
 
-def get_values(aggregate_id: str, variable_id: str, place_id: str):
-    return make_api_call(
-        f"https://servicodados.ibge.gov.br/api/v3/agregados/{aggregate_id}/periodos/-100/variaveis/{variable_id}?localidades={place_id}"
+async def get_values(
+    api: AgregadosClient,
+    aggregate_id: str,
+    variable_ids: list,
+    place_ids: list,
+    seen: Dict[str, dict],
+):
+    """Values of a call; the validators of every answered call go to ``seen``."""
+    url = get_values_url(aggregate_id, variable_ids, place_ids)
+    values, validators = await api.make_conditional_api_call(url, Validators())
+    if values:
+        seen[url] = validators.as_fields()
+    return values
+
+
+async def get_batch_values(
+    api: AgregadosClient, aggregate_id: str, batch: Batch, seen: Dict[str, dict]
+) -> dict:
+    """Values of every (variable, place) pair of a batch, keyed by pair."""
+    values = await get_values(api, aggregate_id, batch.variables, batch.places, seen)
+    if values or len(batch.pairs) == 1:
+        return split_response(values, batch)
+
+    # The combined call failed, e.g. because its response was larger than
+    # estimated; fall back to one call per pair
+    logger.warning(
+        f"Batched values call failed for aggregate {aggregate_id}, "
+        f"retrying {len(batch.pairs)} pairs one by one"
     )
+    split = {}
+    for variable_id, place in batch.pairs:
+        single = Batch(variables=[variable_id], places=[place])
+        split.update(await get_batch_values(api, aggregate_id, single, seen))
+    return split
+
 
+async def write_batch(
+    api: AgregadosClient,
+    aggregate_id: str,
+    batch: Batch,
+    writer: AggregateWriter,
+    seen: Dict[str, dict],
+) -> bool:
+    """
+    Fetch the pairs of a batch not yet in the file, append and checkpoint.
+    Returns True only if every pair was fetched by this call, so that the
+    validators in ``seen`` vouch for all of the batch's values.
+    """
+    pending = [pair for pair in batch.pairs if not writer.is_done(*pair)]
+    if not pending:
+        return False
+    values_by_pair = await get_batch_values(api, aggregate_id, batch, seen)
+    for pair in pending:
+        if values_by_pair.get(pair):
+            writer.append(values_by_pair[pair])
+    # Pairs whose call failed stay pending for a resumed run
+    fetched = [pair for pair in pending if pair in values_by_pair]
+    await asyncio.to_thread(writer.checkpoint, fetched)
+    return len(fetched) == len(batch.pairs)
+
+
+async def values_unchanged(api: AgregadosClient, previous_path: str) -> bool:
+    """
+    Revalidate every values call of a previous aggregate file with the
+    validators recorded in its sidecar. Values can be revised without any
+    change to the metadata, so only a 304 on each of them proves the file
+    is still current.
+    """
+    meta = read_meta(previous_path) or {}
+    calls = meta.get("values")
+    if not calls:
+        return False
+    for url, fields in calls.items():
+        validators = Validators(**fields)
+        if not validators:
+            return False
+        try:
+            await api.make_conditional_api_call(url, validators)
+        except NotModified:
+            continue
+        logger.info(f"Values changed or unavailable: {url}")
+        return False
+    return True
 
-def process_and_save_aggregate(aggregate_id: str, output_dir: str):
+
+def reuse_aggregate(index: ArtifactIndex, previous: Artifact, output_path: str):
+    """Link the previous run's aggregate file and its sidecar into this run."""
+    previous_path = index.absolute_path(previous)
+    clone_file(meta_path_for(previous_path), meta_path_for(output_path))
+    index.reuse(previous, *index.locate(output_path))
+
+
+async def fetch_metadata(
+    api: AgregadosClient,
+    index: Optional[ArtifactIndex],
+    previous: Optional[Artifact],
+    aggregate_id: str,
+    output_path: str,
+) -> Optional[tuple[dict, Validators]]:
+    """
+    The metadata of an aggregate and its validators, or None if the previous
+    run's file was reused because neither the metadata nor the values changed.
+    """
+    # The metadata lists the periods an aggregate covers, so it changes when a
+    # new period is published; values may be revised without it changing
+    metadata_url = get_aggregates_metadata_url(aggregate_id)
+    try:
+        return await api.make_conditional_api_call(
+            metadata_url, Validators.from_artifact(previous)
+        )
+    except NotModified:
+        pass
+    if await values_unchanged(api, index.absolute_path(previous)):
+        logger.info(f"Aggregate {aggregate_id} not modified. Reusing previous run.")
+        reuse_aggregate(index, previous, output_path)
+        return None
+    return await api.make_conditional_api_call(metadata_url, Validators())
+
+
+async def process_and_save_aggregate(
+    api: AgregadosClient,
+    aggregate_id: str,
+    output_dir: str,
+    index: Optional[ArtifactIndex] = None,
+    refresh: bool = False,
+):
     logger.info(f"Processing aggregate ID: {aggregate_id}")
 
-    output_path = os.path.join(output_dir, f"{aggregate_id}.json")
-    if os.path.exists(output_path):
+    plain_path = os.path.join(output_dir, f"{aggregate_id}.json")
+    if find_artifact(plain_path):
         logger.info(f"Aggregate {aggregate_id} already exists. Skipping.")
         return
 
-    metadata = get_aggregates_metadata(aggregate_id)
+    # On refresh, nothing is revalidated against previous runs
+    output_path = artifact_path(plain_path)
+    previous = (
+        index.previous_of(output_path) if index is not None and not refresh else None
+    )
+    fetched = await fetch_metadata(api, index, previous, aggregate_id, output_path)
+    if fetched is None:
+        return
+    metadata, validators = fetched
+
     if not metadata:
         logger.warning(f"Empty metadata for aggregate {aggregate_id}")
         return
@@ -75,29 +257,120 @@ def process_and_save_aggregate(aggregate_id: str, output_dir: str):
     )
     places_to_search = [place for place in defined_places if place in DC_PLACES]
 
-    series = []
-    for variable_id in variables_ids:
-        for place in places_to_search:
-            values = get_values(aggregate_id, variable_id, place)
-            if values:
-                series.append(values)
-
-    result = {
-        "assunto": metadata.get("assunto", ""),
-        "values": series,
-    }
+    # Variables and places are combined into as few calls as the response
+    # size limit allows. Batches are fetched one after the other and their
+    # series appended to the file as they arrive, checkpointing after each.
+    batches = plan_batches(variables_ids, places_to_search, estimate_periods(metadata))
+    # Resuming rehashes the partial file; both run off the event loop
+    await asyncio.to_thread(adopt_partial, output_path)
+    writer = await asyncio.to_thread(
+        AggregateWriter,
+        output_path,
+        metadata.get("assunto", ""),
+        metadata_hash(metadata),
+    )
+    # Validators of each values call, for the next run to revalidate them
+    seen: Dict[str, dict] = {}
+    try:
+        vouched = [
+            await write_batch(api, aggregate_id, batch, writer, seen)
+            for batch in batches
+        ]
+        missing = [
+            pair
+            for batch in batches
+            for pair in batch.pairs
+            if not writer.is_done(*pair)
+        ]
+        if missing:
+            # Not published nor indexed: the partial file and its progress
+            # stay, so a resumed run or another process fetches only these
+            raise IncompleteAggregateError(
+                f"{len(missing)} series of aggregate {aggregate_id} failed"
+            )
+        await asyncio.to_thread(writer.finish)
+    finally:
+        writer.close()
 
-    with open(output_path, "w+", encoding="utf-8") as file:
-        json.dump(result, file, ensure_ascii=False)
+    metadata_url = get_aggregates_metadata_url(aggregate_id)
+    # Values fetched by an earlier attempt have no validators here, so the
+    # next run fetches them again
+    write_meta(
+        output_path,
+        url=metadata_url,
+        content_hash=writer.content_hash,
+        values=seen if all(vouched) else None,
+    )
+    if index is not None:
+        index.record_file(
+            output_path,
+            url=metadata_url,
+            content_hash=writer.content_hash,
+            **validators.as_fields(),
+        )
     logger.info(f"Saved aggregate {aggregate_id} to {output_path}")
 
 
-def download_ibge_agregados(output_dir: str, skip_files: list[str]):
+def download_ibge_agregados(
+    output_dir: str,
+    skip_files: list[str],
+    queue: Optional[WorkQueue] = None,
+    refresh: bool = False,
+):
+    asyncio.run(download_agregados(output_dir, skip_files, queue, refresh))
+
+
+async def download_agregados(
+    output_dir: str,
+    skip_files: list[str],
+    queue: Optional[WorkQueue] = None,
+    refresh: bool = False,
+):
+    """
+    Download every aggregate into output_dir. With a shared work queue, only
+    the aggregates this process leases are downloaded, and afterwards the ones
+    other processes left behind. With refresh, aggregates are fetched again
+    even when a previous run's file is still current.
+    """
     os.makedirs(output_dir, exist_ok=True)
-    aggregate_ids = get_aggregates()
-    for aggregate_id in aggregate_ids:
-        if f"{aggregate_id}.json" in skip_files:
-            logger.info(f"File already exists: {aggregate_id=}.")
-            continue
+    limiter = SlidingWindowLimiter(MAX_CALLS_PER_INTERVAL, INTERVAL)
+    limits = httpx.Limits(
+        max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_CONNECTIONS
+    )
+    async with httpx.AsyncClient(
+        timeout=REQUEST_TIMEOUT, limits=limits, follow_redirects=True
+    ) as client:
+        api = AgregadosClient(client, limiter)
+        aggregate_ids = []
+        for aggregate_id in await get_aggregates(api):
+            if any(
+                name in skip_files for name in candidate_paths(f"{aggregate_id}.json")
+            ):
+                logger.info(f"File already exists: {aggregate_id=}.")
+                continue
+            aggregate_ids.append(str(aggregate_id))
+        aggregate_slots = asyncio.Semaphore(AGGREGATE_CONCURRENCY)
+        if queue is not None:
+            queue.add(aggregate_ids)
+
+        with ArtifactIndex(os.path.dirname(output_dir)) as index:
+
+            async def run_claimed(aggregate_id: str) -> None:
+                try:
+                    with working_on(queue, aggregate_id):
+                        await process_and_save_aggregate(
+                            api, aggregate_id, output_dir, index, refresh
+                        )
+                except Exception as e:
+                    logger.error(f"Error processing aggregate {aggregate_id}: {e}")
+
+            async def run_aggregate(aggregate_id: str) -> None:
+                async with aggregate_slots:
+                    if await asyncio.to_thread(claim_task, queue, aggregate_id):
+                        await run_claimed(aggregate_id)
 
-        process_and_save_aggregate(aggregate_id, output_dir)
+            await asyncio.gather(
+                *(run_aggregate(aggregate_id) for aggregate_id in aggregate_ids)
+            )
+            async for aggregate_id, _ in remaining(queue):
+                await run_claimed(aggregate_id)
@@ -0,0 +1,106 @@
+"""
+Batching of IBGE agregados values requests.
+
+``/agregados/{id}/periodos/{p}/variaveis/{v}?localidades={l}`` accepts several
+pipe-separated variables and territorial levels, so the values of one
+aggregate can be fetched in a single call instead of one per (variable,
+level) pair. The API refuses responses above ``MAX_VALUES_PER_CALL`` values,
+so ``plan_batches`` estimates the size of each call from the metadata and
+splits the work where needed. ``split_response`` turns a combined response
+back into the per-pair series the single calls used to return.
+"""
+
+from dataclasses import dataclass
+from typing import Any, Dict, List, Tuple
+
+MAX_VALUES_PER_CALL = 100_000
+PERIODS_REQUESTED = 100
+
+# Upper bounds for the number of localities of each level in one response
+LOCALITIES_PER_LEVEL = {"N1": 1, "N3": 27, "N6": 5_570}
+PERIODS_PER_YEAR = {"anual": 1, "semestral": 2, "trimestral": 4, "mensal": 12}
+
+
+@dataclass
+class Batch:
+    variables: List[Any]
+    places: List[str]
+
+    @property
+    def pairs(self) -> List[Tuple[Any, str]]:
+        return [(v, p) for v in self.variables for p in self.places]
+
+
+def estimate_periods(metadata: Dict[str, Any]) -> int:
+    """Number of periods a ``-100`` request returns, from the periodicity."""
+    periodicity = metadata.get("periodicidade") or {}
+    try:
+        years = int(str(periodicity["fim"])[:4]) - int(str(periodicity["inicio"])[:4])
+    except (KeyError, TypeError, ValueError):
+        return PERIODS_REQUESTED
+    per_year = PERIODS_PER_YEAR.get(periodicity.get("frequencia"), 12)
+    return max(1, min(PERIODS_REQUESTED, (years + 1) * per_year))
+
+
+def plan_batches(
+    variables: List[Any],
+    places: List[str],
+    periods: int,
+    max_values: int = MAX_VALUES_PER_CALL,
+) -> List[Batch]:
+    """
+    Group (variable, place) pairs into as few calls as fit in ``max_values``.
+
+    Places are packed together first, then each group of places takes as many
+    variables per call as fit. A place too large for one variable alone still
+    gets its own call per variable, as before batching.
+    """
+    if not variables or not places:
+        return []
+
+    def values_per_variable(group: List[str]) -> int:
+        return periods * sum(LOCALITIES_PER_LEVEL.get(p, 1) for p in group)
+
+    place_groups: List[List[str]] = []
+    for place in places:
+        if place_groups and (
+            values_per_variable(place_groups[-1] + [place]) <= max_values
+        ):
+            place_groups[-1].append(place)
+        else:
+            place_groups.append([place])
+
+    batches = []
+    for group in place_groups:
+        step = max(1, max_values // values_per_variable(group))
+        for i in range(0, len(variables), step):
+            batches.append(Batch(variables=variables[i : i + step], places=group))
+    return batches
+
+
+def split_response(
+    response: List[Dict[str, Any]], batch: Batch
+) -> Dict[Tuple[Any, str], List[Dict[str, Any]]]:
+    """
+    Split a combined response into ``{(variable, place): values}``, where
+    values is what a call for that single variable and place returns.
+    """
+    by_variable = {str(item.get("id")): item for item in response or []}
+    split = {}
+    for variable, place in batch.pairs:
+        item = by_variable.get(str(variable))
+        if item is None:
+            continue
+        results = [
+            {
+                **result,
+                "series": [
+                    s
+                    for s in result.get("series", [])
+                    if s.get("localidade", {}).get("nivel", {}).get("id") == place
+                ],
+            }
+            for result in item.get("resultados", [])
+        ]
+        split[(variable, place)] = [{**item, "resultados": results}]
+    return split
@@ -1,19 +1,42 @@
 import json
 import os
+from typing import Optional
 
 import requests
 
+from ..artifact_index import ArtifactIndex
+from ..compression import artifact_path, write_artifact
+from ..conditional import NotModified, Validators
+from ..retry import CircuitBreaker, CircuitOpenError, RetryPolicy, retry_sync
 
-def get_values(localidade):
-    r = requests.get(
-        f"https://servicodados.ibge.gov.br/api/v1/localidades/{localidade}"
-    )
+LOCALIDADES_URL = "https://servicodados.ibge.gov.br/api/v1/localidades"
+RETRY_POLICY = RetryPolicy()
+REQUEST_TIMEOUT = 120
 
-    if r.status_code != 200:
-        print("Falha na requisição: Status", r.status_code)
-        return {}
 
-    return r.json()
+def get_values(
+    localidade,
+    validators: Optional[Validators] = None,
+    breaker: Optional[CircuitBreaker] = None,
+):
+    url = f"{LOCALIDADES_URL}/{localidade}"
+    headers = validators.request_headers() if validators else {}
+
+    def request() -> requests.Response:
+        r = requests.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+        r.raise_for_status()
+        return r
+
+    try:
+        r = retry_sync(request, url, RETRY_POLICY, breaker)
+    except (requests.RequestException, CircuitOpenError) as e:
+        print("Falha na requisição:", e)
+        return {}, Validators()
+
+    if r.status_code == 304:
+        raise NotModified(localidade)
+
+    return r.json(), Validators.from_headers(r.headers)
 
 
 def download_ibge_localidades(output_dir: str):
@@ -32,9 +55,29 @@ def download_ibge_localidades(output_dir: str):
     ]
 
     os.makedirs(output_dir, exist_ok=True)
-    for localidade in localidades:
-        localidade_json = get_values(localidade)
-        file_path = f"{output_dir}/{localidade}.json"
+    breaker = CircuitBreaker()
+    # Validators of the previous run make each request conditional; unchanged
+    # files are linked from that run instead of downloaded again
+    with ArtifactIndex(os.path.dirname(output_dir)) as index:
+        for localidade in localidades:
+            file_path = artifact_path(f"{output_dir}/{localidade}.json")
+            previous = index.previous_of(file_path)
+
+            try:
+                localidade_json, validators = get_values(
+                    localidade, Validators.from_artifact(previous), breaker
+                )
+            except NotModified:
+                print("Sem alterações, reaproveitando:", localidade)
+                index.reuse(previous, *index.locate(file_path))
+                continue
+
+            text = json.dumps(localidade_json, ensure_ascii=False, indent=4)
+            write_artifact(file_path, text.encode("utf-8"))
 
-        with open(file_path, "w", encoding="utf-8") as file:
-            json.dump(localidade_json, file, ensure_ascii=False, indent=4)
+            if localidade_json:
+                index.record_file(
+                    file_path,
+                    url=f"{LOCALIDADES_URL}/{localidade}",
+                    **validators.as_fields(),
+                )
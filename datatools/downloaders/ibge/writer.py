@@ -0,0 +1,180 @@
+"""
+Incremental, resumable writer for IBGE aggregate files.
+
+An aggregate is written to ``<id>.json.part`` series by series as the values
+arrive, in the same ``{"assunto": ..., "values": [...]}`` layout as before,
+so memory no longer grows with the aggregate. After every batch of series the
+file is fsynced and ``<id>.json.progress`` records the committed size, the
+(variable, place) pairs it holds and a hash of the metadata they were fetched
+for. A writer opened again for the same metadata truncates the partial file
+back to the last checkpoint and only the missing pairs are fetched. The
+finished file is renamed to ``<id>.json``. The file is compressed as
+``<id>.json.zst`` and every checkpoint appends one zstd frame, so the
+truncation still lands on a frame boundary.
+
+Runs download into a fresh ``tmp_<uuid>`` directory, so partial aggregates left
+behind by a run that died are adopted from sibling ``tmp_*`` directories. A
+writer holds a POSIX lock on its partial file for as long as it is open, and
+only files nobody holds a lock on are adopted, so overlapping runs never take
+each other's files.
+"""
+
+import fcntl
+import glob
+import hashlib
+import json
+import logging
+import os
+from typing import Any, Dict, Iterable, Optional
+
+from ..compression import FrameWriter, is_compressed
+from ..hashing import StreamHasher, format_digest, hash_file
+
+logger = logging.getLogger("downloader: IBGE agregados")
+
+PART_SUFFIX = ".part"
+PROGRESS_SUFFIX = ".progress"
+
+
+def pair_key(variable_id: Any, place: str) -> str:
+    return f"{variable_id}|{place}"
+
+
+def metadata_hash(metadata: Dict[str, Any]) -> str:
+    encoded = json.dumps(metadata, sort_keys=True, ensure_ascii=False).encode()
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def adopt_candidate(candidate: str, output_path: str) -> bool:
+    """Move a partial file and its progress into place unless a writer holds it."""
+    progress = candidate.removesuffix(PART_SUFFIX) + PROGRESS_SUFFIX
+    if not os.path.exists(progress):
+        return False
+    try:
+        with open(candidate, "r+b") as f:
+            try:
+                fcntl.lockf(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                logger.info(f"Partial file {candidate} is in use by a live run")
+                return False
+            # Moved while locked, so its writer can't come back in between
+            os.replace(progress, output_path + PROGRESS_SUFFIX)
+            os.replace(candidate, output_path + PART_SUFFIX)
+    except OSError as e:
+        logger.warning(f"Could not adopt partial file {candidate}: {e}")
+        return False
+    return True
+
+
+def adopt_partial(output_path: str) -> bool:
+    """Move a partial file of output_path from an abandoned tmp_ run, if any."""
+    part_path = output_path + PART_SUFFIX
+    if os.path.exists(part_path):
+        return True
+
+    run_dir = os.path.dirname(output_path)
+    name = os.path.basename(part_path)
+    pattern = os.path.join(os.path.dirname(run_dir), "tmp_*", name)
+    for candidate in glob.glob(pattern):
+        if os.path.dirname(candidate) == run_dir:
+            continue
+        if adopt_candidate(candidate, output_path):
+            logger.info(f"Adopted partial {name} from {os.path.dirname(candidate)}")
+            return True
+    return False
+
+
+class AggregateWriter:
+    def __init__(self, output_path: str, assunto: str, metadata_digest: str):
+        self.output_path = output_path
+        self.part_path = output_path + PART_SUFFIX
+        self.progress_path = output_path + PROGRESS_SUFFIX
+        self.metadata_digest = metadata_digest
+
+        progress = self._read_progress()
+        if (
+            progress
+            and progress.get("metadata_hash") == metadata_digest
+            and os.path.exists(self.part_path)
+        ):
+            self.done = set(progress["done"])
+            self.count = progress["count"]
+            self._file = open(self.part_path, "r+b")
+            self._file.truncate(progress["bytes"])
+            self._file.seek(progress["bytes"])
+            self._frames = FrameWriter(self._file, is_compressed(output_path))
+            self._hasher = StreamHasher(
+                hash_file(self.part_path, limit=progress["bytes"])
+            )
+            # After the hash: closing its handle would drop a POSIX lock
+            self._lock()
+            logger.info(
+                f"Resuming {os.path.basename(output_path)} with {self.count} series"
+            )
+        else:
+            self.done = set()
+            self.count = 0
+            self._file = open(self.part_path, "wb")
+            self._frames = FrameWriter(self._file, is_compressed(output_path))
+            self._hasher = StreamHasher()
+            self._lock()
+            header = '{"assunto": ' + json.dumps(assunto, ensure_ascii=False)
+            self._frames.write((header + ', "values": [').encode())
+
+    def _lock(self) -> None:
+        # Held until the file is closed; tells adopt_partial this run is alive
+        fcntl.lockf(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    def _read_progress(self) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self.progress_path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def is_done(self, variable_id: Any, place: str) -> bool:
+        return pair_key(variable_id, place) in self.done
+
+    def append(self, series: Any) -> None:
+        separator = ", " if self.count else ""
+        self._frames.write(
+            (separator + json.dumps(series, ensure_ascii=False)).encode()
+        )
+        self.count += 1
+
+    def checkpoint(self, pairs: Iterable[tuple]) -> None:
+        """Commit everything appended so far as covering ``pairs``."""
+        self._hasher.update(self._frames.commit())
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.done.update(pair_key(*pair) for pair in pairs)
+        progress = {
+            "metadata_hash": self.metadata_digest,
+            "bytes": self._file.tell(),
+            "count": self.count,
+            "done": sorted(self.done),
+        }
+        tmp_path = self.progress_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(progress, f)
+        os.replace(tmp_path, self.progress_path)
+
+    def finish(self) -> None:
+        """Close the JSON document and publish it as the aggregate file."""
+        self._frames.write(b"]}")
+        self._hasher.update(self._frames.commit())
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        os.replace(self.part_path, self.output_path)
+        if os.path.exists(self.progress_path):
+            os.remove(self.progress_path)
+
+    @property
+    def content_hash(self) -> str:
+        """Hash of the bytes committed to the file, computed as they were written."""
+        return format_digest(self._hasher)
+
+    def close(self) -> None:
+        if not self._file.closed:
+            self._file.close()
@@ -0,0 +1,189 @@
+"""
+Integrity manifests of download runs.
+
+When a run is finalised, ``<run>/_manifest.json`` lists every file it holds
+with its size, content hash, source URL and completion status. Hashes come
+from the artifact index, where the downloaders record the digest they
+computed while the data streamed in (``hashing.StreamHasher``); only files written
+without one (Parquet tables, sidecars, small catalogue files) are read again,
+on a thread pool, when the manifest is written.
+
+``datatools verify --input <run>`` re-hashes a run against its manifest in
+parallel. Files that are missing, changed size or no longer match their hash
+are reported and marked ``corrupt`` in the artifact index, so resume checks,
+conditional reuse and deduplication stop picking them.
+"""
+
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from .artifact_index import INDEX_FILENAME, Artifact, ArtifactIndex
+from .hashing import HASH_ALGORITHM, HASH_WORKERS, format_digest, hash_file
+
+logger = logging.getLogger("downloader:integrity")
+
+RUN_MANIFEST = "_manifest.json"
+# Leftovers of interrupted writes, never part of a finished run
+TRANSIENT_SUFFIXES = (".part", ".tmp", ".dedup")
+
+
+@dataclass
+class ManifestEntry:
+    path: str
+    size: int
+    content_hash: str
+    url: Optional[str]
+    status: str
+
+
+def list_run_files(run_dir: str) -> List[str]:
+    """Relative paths of every file of a run, without transient leftovers."""
+    relpaths = []
+    for root, _, files in os.walk(run_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            relpath = os.path.relpath(path, run_dir).replace(os.sep, "/")
+            if relpath == RUN_MANIFEST or name.endswith(TRANSIENT_SUFFIXES):
+                continue
+            relpaths.append(relpath)
+    return sorted(relpaths)
+
+
+def describe_file(
+    run_dir: str, relpath: str, artifact: Optional[Artifact]
+) -> ManifestEntry:
+    """Manifest entry of a file, hashed here only if no hash was recorded."""
+    size = os.path.getsize(os.path.join(run_dir, relpath))
+    if artifact is not None and artifact.content_hash and artifact.size == size:
+        content_hash = artifact.content_hash
+    else:
+        content_hash = format_digest(hash_file(os.path.join(run_dir, relpath)))
+    return ManifestEntry(
+        path=relpath,
+        size=size,
+        content_hash=content_hash,
+        url=artifact.url if artifact else None,
+        status=artifact.status if artifact else "unindexed",
+    )
+
+
+def open_source_index(run_dir: str) -> Optional[ArtifactIndex]:
+    """The artifact index of the source a run belongs to, if it keeps one."""
+    source_dir = os.path.dirname(os.path.normpath(run_dir))
+    if not os.path.exists(os.path.join(source_dir, INDEX_FILENAME)):
+        return None
+    return ArtifactIndex(source_dir)
+
+
+def write_run_manifest(run_dir: str, workers: int = HASH_WORKERS) -> Dict[str, Any]:
+    """Describe every file of a finished run in ``<run>/_manifest.json``."""
+    run = os.path.basename(os.path.normpath(run_dir))
+    index = open_source_index(run_dir)
+    try:
+        artifacts = (
+            {artifact.relpath: artifact for artifact in index.find_run(run)}
+            if index is not None
+            else {}
+        )
+        relpaths = list_run_files(run_dir)
+        with ThreadPoolExecutor(workers) as pool:
+            entries = list(
+                pool.map(
+                    lambda relpath: describe_file(
+                        run_dir, relpath, artifacts.get(relpath)
+                    ),
+                    relpaths,
+                )
+            )
+        # Hashes computed now serve later deduplication too
+        for entry in entries:
+            artifact = artifacts.get(entry.path)
+            if artifact is not None and artifact.content_hash != entry.content_hash:
+                index.update(
+                    run, entry.path, content_hash=entry.content_hash, size=entry.size
+                )
+    finally:
+        if index is not None:
+            index.close()
+
+    manifest = {
+        "run": run,
+        "created_at": datetime.now().isoformat(),
+        "hash_algorithm": HASH_ALGORITHM,
+        "total_files": len(entries),
+        "total_bytes": sum(entry.size for entry in entries),
+        "files": [asdict(entry) for entry in entries],
+    }
+    path = os.path.join(run_dir, RUN_MANIFEST)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+    logger.info(
+        f"Wrote manifest of {run}: {manifest['total_files']} files, "
+        f"{manifest['total_bytes']} bytes"
+    )
+    return manifest
+
+
+def read_run_manifest(run_dir: str) -> Optional[Dict[str, Any]]:
+    path = os.path.join(run_dir, RUN_MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def check_file(run_dir: str, entry: Dict[str, Any]) -> Optional[str]:
+    """What is wrong with a file of the manifest, or None if it is intact."""
+    path = os.path.join(run_dir, entry["path"])
+    if not os.path.exists(path):
+        return "missing"
+    size = os.path.getsize(path)
+    if size != entry["size"]:
+        return f"size {size} != {entry['size']}"
+    if format_digest(hash_file(path)) != entry["content_hash"]:
+        return "hash mismatch"
+    return None
+
+
+def verify_run(run_dir: str, workers: int = HASH_WORKERS) -> Dict[str, str]:
+    """
+    Re-hash a run against its manifest in parallel.
+    Returns {relative path: problem} for every file that failed.
+    """
+    manifest = read_run_manifest(run_dir)
+    if manifest is None:
+        raise FileNotFoundError(f"No {RUN_MANIFEST} in {run_dir}")
+
+    entries = manifest["files"]
+    with ThreadPoolExecutor(workers) as pool:
+        results = pool.map(lambda entry: check_file(run_dir, entry), entries)
+        problems = {
+            entry["path"]: problem
+            for entry, problem in zip(entries, results)
+            if problem is not None
+        }
+
+    listed = {entry["path"] for entry in entries}
+    for relpath in list_run_files(run_dir):
+        if relpath not in listed:
+            logger.warning(f"{relpath} is not in the manifest of {manifest['run']}")
+
+    if problems:
+        mark_corrupt(run_dir, manifest["run"], problems)
+    return problems
+
+
+def mark_corrupt(run_dir: str, run: str, problems: Dict[str, str]) -> None:
+    index = open_source_index(run_dir)
+    if index is None:
+        return
+    with index:
+        for relpath in problems:
+            index.update(run, relpath, status="corrupt")
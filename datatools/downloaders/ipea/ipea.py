@@ -1,64 +1,149 @@
-import concurrent.futures
+import asyncio
 import os
 import traceback
 
-import ipeadatapy
-import pandas as pd
+import httpx
 
+from ..artifact_index import Artifact, ArtifactIndex
+from ..conditional import Validators
+from ..retry import CircuitOpenError
+from ..work_queue import WorkQueue, claim_task, remaining, settle
+from .odata import (
+    LATEST_UPDATES_COLUMNS,
+    MAX_CONNECTIONS,
+    METADATA,
+    TABLES,
+    IpeaClient,
+    Table,
+    open_client,
+    parse_records,
+    values_table,
+    write_csv,
+)
 
-def get_values(code: str) -> tuple[bool, pd.DataFrame | None, str | None]:
-    try:
-        values = ipeadatapy.api_call(
-            f"http://www.ipeadata.gov.br/api/odata4/Metadados('{code}')/Valores"
-        )
-
-        return True, values, None
-
-    except Exception as e:
-        return False, None, traceback.format_exception(e)
 
+def values_url(code: str) -> str:
+    return values_table(code).request_url
 
-def save_file(path: str, code: str, data: pd.DataFrame) -> tuple[bool, str | None]:
-    try:
-        os.makedirs(f"{path}/values", exist_ok=True)
-        data.to_csv(f"{path}/values/{code}.csv")
-
-        return True, None
 
-    except Exception as e:
-        return False, traceback.format_exception(e)
+def values_path(path: str, code: str) -> str:
+    return f"{path}/values/{code}.csv"
 
 
-def process_code(save_path: str, code: str) -> tuple[bool, str | None]:
-    is_values_ok, data_df, values_error = get_values(code)
-    if not is_values_ok:
-        return False, values_error
+def save_values(path: str, code: str, body: bytes) -> None:
+    os.makedirs(f"{path}/values", exist_ok=True)
+    write_csv(values_path(path, code), values_table(code).columns, parse_records(body))
 
-    is_save_ok, save_error = save_file(save_path, code, data_df)
-    if not is_save_ok:
-        return False, save_error
 
-    return True, None
+async def process_code(
+    api: IpeaClient, save_path: str, code: str, validators: Validators
+) -> tuple[bool, str | None, Validators | None]:
+    """
+    Download and save the values of one series.
 
-
-def download_ipea_data(output_dir: str):
-    os.makedirs(output_dir, exist_ok=True)
-    ipeadatapy.metadata().to_csv(f"{output_dir}/metadata.csv", index=False)
-    ipeadatapy.countries().to_csv(f"{output_dir}/countries.csv", index=False)
-    ipeadatapy.latest_updates().to_csv(f"{output_dir}/latest_updates.csv", index=False)
-    ipeadatapy.sources().to_csv(f"{output_dir}/sources.csv", index=False)
-    ipeadatapy.themes().to_csv(f"{output_dir}/themes.csv", index=False)
-    ipeadatapy.territories().to_csv(f"{output_dir}/territories.csv", index=False)
-
-    df = ipeadatapy.list_series()
-    code_list = df["CODE"].tolist()
-
-    with open("logs.txt", "w+") as log_file:
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            results = executor.map(
-                lambda code: process_code(output_dir, code), code_list
-            )
-            for result in results:
-                is_success, error = result
+    The returned validators are None when the series did not change since
+    the run the given validators come from, and nothing was written.
+    """
+    try:
+        response = await api.get(values_url(code), validators.request_headers())
+        if response.status_code == 304:
+            return True, None, None
+        # Parsing and writing a large series would stall the other downloads
+        await asyncio.to_thread(save_values, save_path, code, response.content)
+        return True, None, Validators.from_headers(response.headers)
+
+    except (httpx.HTTPError, CircuitOpenError, OSError, ValueError, KeyError) as e:
+        return False, traceback.format_exception(e), None
+
+
+async def save_table(api: IpeaClient, output_dir: str, table: Table) -> list:
+    records = await api.get_records(table)
+    write_csv(f"{output_dir}/{table.name}.csv", table.columns, records)
+    return records
+
+
+async def download_tables(api: IpeaClient, output_dir: str) -> list:
+    """Write the catalogue tables concurrently; returns the metadata records."""
+    metadata, *_ = await asyncio.gather(
+        save_table(api, output_dir, METADATA),
+        *(save_table(api, output_dir, table) for table in TABLES),
+    )
+    # Same ordering as ipeadatapy.latest_updates, series never updated last
+    latest = sorted(
+        metadata, key=lambda record: record.get("SERATUALIZACAO") or "", reverse=True
+    )
+    write_csv(f"{output_dir}/latest_updates.csv", LATEST_UPDATES_COLUMNS, latest)
+    return metadata
+
+
+def record_result(
+    index: ArtifactIndex,
+    output_dir: str,
+    code: str,
+    previous: Artifact | None,
+    validators: Validators | None,
+) -> None:
+    file_path = values_path(output_dir, code)
+    if validators is None:
+        index.reuse(previous, *index.locate(file_path))
+    else:
+        index.record_file(file_path, url=values_url(code), **validators.as_fields())
+
+
+async def download_ipea(
+    output_dir: str, queue: WorkQueue | None = None, refresh: bool = False
+):
+    """
+    Download the catalogue tables and every series into output_dir. With a
+    shared work queue, only the series this process leases are downloaded,
+    and afterwards the ones other processes left behind. With refresh, series
+    are fetched again even when a previous run's file is still current.
+    """
+    async with open_client() as client:
+        api = IpeaClient(client)
+        metadata = await download_tables(api, output_dir)
+        code_list = [record["SERCODIGO"] for record in metadata]
+        if queue is not None:
+            queue.add(code_list)
+
+        # The index is only touched from the event loop; tasks get the
+        # validators of the previous run and hand back the ones they received
+        with (
+            ArtifactIndex(os.path.dirname(output_dir)) as index,
+            open("logs.txt", "w+") as log_file,
+        ):
+            semaphore = asyncio.Semaphore(MAX_CONNECTIONS)
+
+            async def run_claimed(code: str) -> None:
+                previous = (
+                    None
+                    if refresh
+                    else index.previous_of(values_path(output_dir, code))
+                )
+                _, error, validators = await process_code(
+                    api, output_dir, code, Validators.from_artifact(previous)
+                )
                 if error:
                     log_file.write(f"{error}\n")
+                    await asyncio.to_thread(settle, queue, code, False, "".join(error))
+                    return
+                record_result(index, output_dir, code, previous, validators)
+                await asyncio.to_thread(settle, queue, code, True)
+
+            async def run_code(code: str) -> None:
+                # Series are leased only once a slot is free, so that processes
+                # sharing the queue split the work between them
+                async with semaphore:
+                    if await asyncio.to_thread(claim_task, queue, code):
+                        await run_claimed(code)
+
+            await asyncio.gather(*(run_code(code) for code in code_list))
+            async for code, _ in remaining(queue):
+                await run_claimed(code)
+
+
+def download_ipea_data(
+    output_dir: str, queue: WorkQueue | None = None, refresh: bool = False
+):
+    os.makedirs(output_dir, exist_ok=True)
+    asyncio.run(download_ipea(output_dir, queue, refresh))
@@ -0,0 +1,155 @@
+"""
+Native client for the IPEA OData API.
+
+Replaces the ``ipeadatapy`` calls of the downloader: one pooled
+``httpx.AsyncClient`` serves every request, the catalogue tables are fetched
+side by side, and each request asks with ``$select`` for only the fields that
+are written. Records are written straight to CSV with the same column names
+and order ``ipeadatapy`` produced, without going through pandas.
+"""
+
+import csv
+import json
+import logging
+import os
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Optional
+from uuid import uuid4
+
+import httpx
+
+from ..retry import CircuitBreaker, RetryPolicy, retry_async
+
+logger = logging.getLogger("downloader:IPEA")
+
+IPEA_ODATA_URL = "http://www.ipeadata.gov.br/api/odata4"
+IPEA_V1_URL = "http://www.ipeadata.gov.br/api/v1"
+RETRY_POLICY = RetryPolicy()
+REQUEST_TIMEOUT = 120
+
+# Series downloaded at once; each holds at most one response body in memory
+MAX_CONNECTIONS = 16
+
+# OData field -> CSV column, in output order
+METADATA_COLUMNS = {
+    "SERCODIGO": "CODE",
+    "SERNOME": "NAME",
+    "SERCOMENTARIO": "COMMENT",
+    "SERATUALIZACAO": "LAST UPDATE",
+    "BASNOME": "BIG THEME",
+    "FNTSIGLA": "SOURCE ACRONYM",
+    "FNTNOME": "SOURCE",
+    "FNTURL": "SOURCE URL",
+    "PERNOME": "FREQUENCY",
+    "UNINOME": "MEASURE",
+    "MULNOME": "UNIT",
+    "SERSTATUS": "SERIES STATUS",
+    "TEMCODIGO": "THEME CODE",
+    "PAICODIGO": "COUNTRY",
+    "SERNUMERICA": "NUMERICA",
+}
+LATEST_UPDATES_COLUMNS = {
+    "SERCODIGO": "CODE",
+    "SERNOME": "NAME",
+    "SERATUALIZACAO": "LAST UPDATE",
+}
+VALUE_COLUMNS = {
+    "SERCODIGO": "SERCODIGO",
+    "VALDATA": "VALDATA",
+    "VALVALOR": "VALVALOR",
+    "NIVNOME": "NIVNOME",
+    "TERCODIGO": "TERCODIGO",
+}
+
+
+@dataclass
+class Table:
+    name: str
+    url: str
+    columns: Dict[str, str]
+    # The v1 endpoints don't take OData query options
+    select: bool = True
+
+    @property
+    def request_url(self) -> str:
+        if not self.select:
+            return self.url
+        return f"{self.url}?$select={','.join(self.columns)}"
+
+
+METADATA = Table("metadata", f"{IPEA_ODATA_URL}/Metadados", METADATA_COLUMNS)
+TABLES = [
+    Table(
+        "countries",
+        f"{IPEA_ODATA_URL}/Paises",
+        {"PAICODIGO": "ID", "PAINOME": "COUNTRY"},
+    ),
+    Table("themes", f"{IPEA_ODATA_URL}/Temas", {"TEMCODIGO": "ID", "TEMNOME": "NAME"}),
+    Table(
+        "territories",
+        f"{IPEA_ODATA_URL}/Territorios",
+        {
+            "TERNOME": "NAME",
+            "TERCODIGO": "ID",
+            "NIVNOME": "LEVEL",
+            "TERAREA": "AREA",
+            "TERCAPITAL": "CAPITAL",
+        },
+    ),
+    Table("sources", f"{IPEA_V1_URL}/Fontes", {"FNTSIGLA": "SIGLA"}, select=False),
+]
+
+
+def values_table(code: str) -> Table:
+    return Table(code, f"{IPEA_ODATA_URL}/Metadados('{code}')/Valores", VALUE_COLUMNS)
+
+
+def parse_records(body: bytes) -> List[Dict[str, Any]]:
+    return json.loads(body)["value"]
+
+
+def write_csv(
+    path: str, columns: Dict[str, str], records: Iterable[Dict[str, Any]]
+) -> None:
+    """Write records as CSV under the renamed columns, replacing path at the end."""
+    # Unique, since processes sharing a run write the same catalogue tables
+    tmp_path = f"{path}.{uuid4().hex}.tmp"
+    with open(tmp_path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow(columns.values())
+        for record in records:
+            writer.writerow(record.get(field) for field in columns)
+    os.replace(tmp_path, path)
+
+
+class IpeaClient:
+    """Pooled access to the IPEA API shared by all tasks."""
+
+    def __init__(self, client: httpx.AsyncClient):
+        self.client = client
+        self.breaker = CircuitBreaker()
+
+    async def get(self, url: str, headers: Optional[dict] = None) -> httpx.Response:
+        """GET url with retries; a 304 answer is returned, not raised."""
+
+        async def request() -> httpx.Response:
+            logger.debug(f"Making API call: {url}")
+            r = await self.client.get(url, headers=headers)
+            if r.status_code != 304:
+                r.raise_for_status()
+            return r
+
+        return await retry_async(request, url, RETRY_POLICY, self.breaker, logger)
+
+    async def get_records(self, table: Table) -> List[Dict[str, Any]]:
+        r = await self.get(table.request_url)
+        return parse_records(r.content)
+
+
+def open_client() -> httpx.AsyncClient:
+    limits = httpx.Limits(
+        max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_CONNECTIONS
+    )
+    return httpx.AsyncClient(
+        limits=limits, timeout=REQUEST_TIMEOUT, follow_redirects=True
+    )
@@ -0,0 +1,417 @@
+"""
+Optional Parquet stage of the download pipeline.
+
+After a run, raw payloads are normalised into typed, zstd-compressed Parquet
+tables under ``<run>/parquet/<table>/<key>=<value>/part-<nnnnn>.parquet``
+(Hive-style partitions, readable with
+``pl.scan_parquet(..., hive_partitioning=True)``):
+
+- ``ibge_agregados``: one row per aggregate, variable, classification,
+  locality and period, partitioned by ``aggregate_id``. ``value`` keeps the raw
+  string (IBGE uses markers such as ``-``, ``..`` and ``X``), ``value_numeric``
+  the parsed number or null.
+- ``datasus_openapi``: the records of each complete OpenAPI endpoint,
+  partitioned by ``endpoint``.
+- ``ipea_values``: the values of each series, partitioned by ``code``, with
+  ``VALVALOR`` as a float and the day of ``VALDATA`` as ``date``. The CSVs are
+  streamed through ``sink_parquet`` rather than loaded whole.
+
+Raw files, zstd-compressed or not, are read as streams and left untouched:
+aggregates are parsed one values call at a time and endpoints in batches of
+whole lines, and every ROWS_PER_PART rows or BATCH_BYTES of input become one
+part, so memory stays bounded whatever the size of the file. Partitions are
+written under ``<run>/parquet/.staging/`` and moved into their table once
+complete; tables that already exist are skipped. DATASUS CSV and ZIP resources
+are converted during the crawl instead, into ``datasus_files`` (see
+``datasus.transcode``).
+"""
+
+import io
+import json
+import logging
+import os
+import re
+import shutil
+from contextlib import contextmanager
+from itertools import islice
+from typing import IO, Any, Iterator, List, Optional, Tuple
+
+import polars as pl
+
+from .compression import logical_path, open_artifact
+from .datasus.ndjson import NDJSON_SUFFIX, manifest_path_for, read_manifest
+
+logger = logging.getLogger("downloader:parquet")
+
+PARQUET_DIRNAME = "parquet"
+COMPRESSION = "zstd"
+# Partitions are written here and moved into the table once complete
+STAGING_DIRNAME = ".staging"
+# Zero-padded, so the parts sort in the order of the rows
+PART_FILENAME = "part-{:05d}.parquet"
+# Rows of schema inference for OpenAPI endpoints before falling back to a full scan
+INFER_SCHEMA_LENGTH = 10_000
+ROWS_PER_PART = 1_000_000
+BATCH_BYTES = 64 * 1024 * 1024
+READ_CHARS = 1024 * 1024
+
+IPEA_SCHEMA = {
+    "SERCODIGO": pl.Utf8,
+    "VALDATA": pl.Utf8,
+    "VALVALOR": pl.Float64,
+    "NIVNOME": pl.Utf8,
+    "TERCODIGO": pl.Utf8,
+}
+
+IBGE_COLUMNS = (
+    "assunto",
+    "variable_id",
+    "variable",
+    "unit",
+    "classifications",
+    "place_level",
+    "place_id",
+    "place_name",
+    "period",
+    "value",
+)
+
+WHITESPACE = re.compile(r"\s*")
+
+
+def partition_dir(run_dir: str, table: str, key: str, value: str) -> str:
+    return os.path.join(run_dir, PARQUET_DIRNAME, table, f"{key}={value}")
+
+
+@contextmanager
+def staged_partition(run_dir: str, table: str, key: str, value: str) -> Iterator[str]:
+    """
+    Yield an empty staging directory for the parts of a partition and move it
+    into the table once the block completes; on failure nothing is published.
+    """
+    target = partition_dir(run_dir, table, key, value)
+    staging_dir = os.path.join(
+        run_dir, PARQUET_DIRNAME, STAGING_DIRNAME, table, f"{key}={value}"
+    )
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    os.makedirs(staging_dir)
+    try:
+        yield staging_dir
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(staging_dir, target)
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+
+def write_parts(frames: Iterator[pl.DataFrame], directory: str) -> None:
+    for number, frame in enumerate(frames):
+        frame.write_parquet(
+            os.path.join(directory, PART_FILENAME.format(number)),
+            compression=COMPRESSION,
+            statistics=True,
+        )
+
+
+class JsonStream:
+    """
+    Pull parser for a JSON document too large to load: values are decoded one
+    at a time from a buffer refilled as needed, so only the value being read
+    is held in memory.
+    """
+
+    def __init__(self, f: IO[str]):
+        self._file = f
+        self._buffer = ""
+        self._pos = 0
+        self._decoder = json.JSONDecoder()
+
+    def _fill(self) -> bool:
+        chunk = self._file.read(READ_CHARS)
+        if not chunk:
+            return False
+        self._buffer = self._buffer[self._pos :] + chunk
+        self._pos = 0
+        return True
+
+    def peek(self) -> str:
+        """The next character that isn't whitespace."""
+        while True:
+            self._pos = WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                raise ValueError("Unexpected end of JSON document")
+
+    def expect(self, characters: str) -> str:
+        """Consume the next character, which must be one of ``characters``."""
+        character = self.peek()
+        if character not in characters:
+            raise ValueError(f"Expected one of {characters!r}, found {character!r}")
+        self._pos += 1
+        return character
+
+    def value(self) -> Any:
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                # Most likely cut by the end of the buffer
+                if self._fill():
+                    continue
+                raise
+            # A number at the end of the buffer may go on in the next chunk
+            if end == len(self._buffer) and self._fill():
+                continue
+            self._pos = end
+            return value
+
+    def items(self) -> Iterator[Any]:
+        """Decode the elements of the array that comes next, one at a time."""
+        self.expect("[")
+        if self.peek() == "]":
+            self._pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.expect(",]") == "]":
+                return
+
+
+def iter_aggregate_values(f: IO[str]) -> Iterator[Tuple[str, Any]]:
+    """
+    Stream ``(assunto, values)`` for every values call of an aggregate file.
+    Writers put ``assunto`` ahead of ``values``, so it is known by then.
+    """
+    stream = JsonStream(f)
+    stream.expect("{")
+    assunto = ""
+    while stream.peek() != "}":
+        key = stream.value()
+        stream.expect(":")
+        if key == "values":
+            for values in stream.items():
+                yield assunto, values
+        elif key == "assunto":
+            assunto = stream.value()
+        else:
+            stream.value()
+        if stream.expect(",}") == "}":
+            return
+
+
+def iter_aggregate_rows(f: IO[str]) -> Iterator[tuple]:
+    """Flatten an aggregate file into rows in IBGE_COLUMNS order."""
+    for assunto, values in iter_aggregate_values(f):
+        for variable in values:
+            variable_id = variable.get("id")
+            name = variable.get("variavel")
+            unit = variable.get("unidade")
+            for result in variable.get("resultados", []):
+                classifications = json.dumps(
+                    result.get("classificacoes", []), ensure_ascii=False
+                )
+                for series in result.get("series", []):
+                    place = series.get("localidade", {})
+                    level = place.get("nivel", {}).get("id")
+                    for period, value in (series.get("serie") or {}).items():
+                        yield (
+                            assunto,
+                            variable_id,
+                            name,
+                            unit,
+                            classifications,
+                            level,
+                            place.get("id"),
+                            place.get("nome"),
+                            period,
+                            value,
+                        )
+
+
+def aggregate_frame(rows: List[tuple]) -> pl.DataFrame:
+    columns: List[list] = [[] for _ in IBGE_COLUMNS]
+    for row in rows:
+        for column, value in zip(columns, row):
+            column.append(None if value is None else str(value))
+    frame = pl.DataFrame(
+        {
+            name: pl.Series(name, column, dtype=pl.Utf8)
+            for name, column in zip(IBGE_COLUMNS, columns)
+        }
+    )
+    return frame.with_columns(
+        pl.col("variable_id").cast(pl.Int64, strict=False),
+        pl.col("value").cast(pl.Float64, strict=False).alias("value_numeric"),
+    )
+
+
+def aggregate_frames(f: IO[str]) -> Iterator[pl.DataFrame]:
+    """Frames of up to ROWS_PER_PART rows; an empty aggregate yields one empty frame."""
+    rows = iter_aggregate_rows(f)
+    while True:
+        batch = list(islice(rows, ROWS_PER_PART))
+        yield aggregate_frame(batch)
+        if len(batch) < ROWS_PER_PART:
+            return
+
+
+def write_ibge_agregados(run_dir: str) -> int:
+    """Convert every <id>.json(.zst) aggregate of a run; returns tables written."""
+    written = 0
+    for name in sorted(os.listdir(run_dir)):
+        if not logical_path(name).endswith(".json"):
+            continue
+        aggregate_id = logical_path(name).removesuffix(".json")
+        key = ("ibge_agregados", "aggregate_id", aggregate_id)
+        if os.path.exists(partition_dir(run_dir, *key)):
+            continue
+        try:
+            with (
+                open_artifact(os.path.join(run_dir, name)) as raw,
+                io.TextIOWrapper(raw, encoding="utf-8") as f,
+                staged_partition(run_dir, *key) as directory,
+            ):
+                write_parts(aggregate_frames(f), directory)
+            written += 1
+        except Exception as e:
+            logger.error(f"Failed to convert aggregate {aggregate_id}: {e}")
+    return written
+
+
+def iter_line_batches(data_path: str) -> Iterator[bytes]:
+    """Whole lines of a file, about BATCH_BYTES at a time."""
+    rest = b""
+    with open_artifact(data_path) as f:
+        while chunk := f.read(BATCH_BYTES):
+            lines, newline, rest = (rest + chunk).rpartition(b"\n")
+            if lines.strip():
+                yield lines + newline
+    if rest.strip():
+        yield rest
+
+
+def endpoint_schema(data_path: str) -> pl.Schema:
+    """Schema of every record of an endpoint, unified batch by batch."""
+    schema = pl.Schema()
+    for batch in iter_line_batches(data_path):
+        frame = pl.read_ndjson(io.BytesIO(batch), infer_schema_length=None)
+        schema = pl.concat(
+            [pl.DataFrame(schema=schema), frame.clear()], how="diagonal_relaxed"
+        ).schema
+    return schema
+
+
+def endpoint_frames(
+    data_path: str, schema: Optional[pl.Schema] = None
+) -> Iterator[pl.DataFrame]:
+    """
+    A frame per batch of lines; without a schema, the first batch's first
+    INFER_SCHEMA_LENGTH records set it for all of them.
+    """
+    for batch in iter_line_batches(data_path):
+        if schema is None:
+            frame = pl.read_ndjson(
+                io.BytesIO(batch), infer_schema_length=INFER_SCHEMA_LENGTH
+            )
+            schema = frame.schema
+        else:
+            frame = pl.read_ndjson(io.BytesIO(batch), schema=schema)
+        yield frame
+
+
+def write_endpoint(data_path: str, run_dir: str, endpoint: str) -> None:
+    key = ("datasus_openapi", "endpoint", endpoint)
+    try:
+        with staged_partition(run_dir, *key) as directory:
+            write_parts(endpoint_frames(data_path), directory)
+    except pl.exceptions.PolarsError:
+        # Types that only show up late in the file; infer from every record
+        schema = endpoint_schema(data_path)
+        with staged_partition(run_dir, *key) as directory:
+            write_parts(endpoint_frames(data_path, schema), directory)
+
+
+def write_datasus_openapi(run_dir: str) -> int:
+    """Convert every complete OpenAPI endpoint of a run; returns tables written."""
+    openapi_dir = os.path.join(run_dir, "openapi")
+    if not os.path.isdir(openapi_dir):
+        return 0
+
+    written = 0
+    for name in sorted(os.listdir(openapi_dir)):
+        if not logical_path(name).endswith(NDJSON_SUFFIX):
+            continue
+        data_path = os.path.join(openapi_dir, name)
+        manifest = read_manifest(manifest_path_for(data_path))
+        if not manifest or manifest.get("status") != "complete":
+            continue
+        endpoint = logical_path(name).removesuffix(NDJSON_SUFFIX)
+        if os.path.exists(
+            partition_dir(run_dir, "datasus_openapi", "endpoint", endpoint)
+        ):
+            continue
+        try:
+            write_endpoint(data_path, run_dir, endpoint)
+            written += 1
+        except Exception as e:
+            logger.error(f"Failed to convert endpoint {endpoint}: {e}")
+    return written
+
+
+def write_ipea_values(run_dir: str) -> int:
+    """Convert every values/<code>.csv series of a run; returns tables written."""
+    values_dir = os.path.join(run_dir, "values")
+    if not os.path.isdir(values_dir):
+        return 0
+
+    written = 0
+    for name in sorted(os.listdir(values_dir)):
+        if not name.endswith(".csv"):
+            continue
+        code = name.removesuffix(".csv")
+        key = ("ipea_values", "code", code)
+        if os.path.exists(partition_dir(run_dir, *key)):
+            continue
+        try:
+            with staged_partition(run_dir, *key) as directory:
+                (
+                    pl.scan_csv(
+                        os.path.join(values_dir, name), schema_overrides=IPEA_SCHEMA
+                    )
+                    # Files of older runs also carry a pandas index column
+                    .select(list(IPEA_SCHEMA))
+                    .with_columns(
+                        pl.col("VALDATA")
+                        .str.slice(0, 10)
+                        .str.to_date(strict=False)
+                        .alias("date")
+                    )
+                    .sink_parquet(
+                        os.path.join(directory, PART_FILENAME.format(0)),
+                        compression=COMPRESSION,
+                        statistics=True,
+                    )
+                )
+            written += 1
+        except Exception as e:
+            logger.error(f"Failed to convert IPEA series {code}: {e}")
+    return written
+
+
+PARQUET_WRITERS = {
+    "ibge_agregados": write_ibge_agregados,
+    "datasus": write_datasus_openapi,
+    "ipea": write_ipea_values,
+}
+
+
+def write_parquet(source: str, run_dir: str) -> None:
+    """Run the Parquet stage for a source, if it has one."""
+    writer = PARQUET_WRITERS.get(source)
+    if writer is None:
+        logger.warning(f"No Parquet stage for source {source}")
+        return
+    logger.info(f"Writing Parquet tables for {source} in {run_dir}")
+    written = writer(run_dir)
+    logger.info(f"Wrote {written} Parquet table(s) for {source}")
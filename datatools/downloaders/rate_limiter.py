@@ -0,0 +1,78 @@
+import asyncio
+import time
+from collections import deque
+
+
+class TokenBucket:
+    """
+    Asyncio token-bucket rate limiter.
+
+    Tokens refill continuously at ``rate`` per second up to ``capacity``; each
+    request takes one token and waits when the bucket is empty. Unlike a fixed
+    sleep between calls, idle time is banked (up to ``capacity``) and several
+    concurrent callers share one budget.
+    """
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self._updated_at
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+        self._updated_at = now
+
+    async def acquire(self, tokens: float = 1) -> None:
+        # The lock makes callers queue in FIFO order for the next token
+        async with self._lock:
+            self._refill()
+            if self._tokens < tokens:
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= tokens
+
+    async def __aenter__(self) -> "TokenBucket":
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        return None
+
+
+class SlidingWindowLimiter:
+    """
+    Asyncio sliding-window rate limiter.
+
+    Allows at most ``max_calls`` acquisitions in any ``period`` seconds. Unlike
+    a token bucket it never bursts above the budget, which is what APIs that
+    publish an "N calls per minute" quota count against.
+    """
+
+    def __init__(self, max_calls: int, period: float):
+        self.max_calls = max_calls
+        self.period = period
+        self._calls: deque[float] = deque()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                while self._calls and now - self._calls[0] >= self.period:
+                    self._calls.popleft()
+                if len(self._calls) < self.max_calls:
+                    break
+                # Wait until the oldest call in the window expires
+                await asyncio.sleep(self._calls[0] + self.period - now)
+            self._calls.append(now)
+
+    async def __aenter__(self) -> "SlidingWindowLimiter":
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        return None
@@ -0,0 +1,234 @@
+"""
+Retry policy shared by the downloaders.
+
+``retry_async`` / ``retry_sync`` run an operation until it succeeds, retrying
+only failures that can be transient: connection errors, timeouts and the
+status codes in ``RETRYABLE_STATUSES``. Between attempts they wait an
+exponentially growing, fully jittered delay, or what the server asked for in
+``Retry-After``.
+
+A ``CircuitBreaker`` shared by the callers of one host counts consecutive
+retryable failures per host. Once a host reaches the threshold its circuit
+opens and every call to it fails fast with ``CircuitOpenError`` instead of
+holding a worker through its retries; after ``reset_timeout`` a single trial
+call is let through and closes the circuit again if it succeeds. Errors that
+are not retryable (a 404, a bad payload) say nothing about the host's health
+and leave its count untouched.
+"""
+
+import asyncio
+import logging
+import random
+import threading
+import time
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from typing import Awaitable, Callable, Dict, Optional, Tuple, Type, TypeVar
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+
+logger = logging.getLogger("downloader:retry")
+
+T = TypeVar("T")
+
+RETRYABLE_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(Exception):
+    """Calls to a host are suspended after too many consecutive failures."""
+
+    def __init__(self, host: str, retry_in: float):
+        super().__init__(f"Circuit open for {host}, retrying in {retry_in:.0f}s")
+        self.host = host
+        self.retry_in = retry_in
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds to wait from a Retry-After header (delta-seconds or HTTP date)."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def failed_response(error: BaseException):
+    """The HTTP response an httpx or requests error carries, if any."""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response
+    if isinstance(error, requests.HTTPError):
+        return error.response
+    return None
+
+
+@dataclass
+class RetryPolicy:
+    max_attempts: int = 5
+    base_delay: float = 1.0
+    max_delay: float = 60.0
+    # Longest Retry-After honoured; longer requests are capped to this
+    max_retry_after: float = 300.0
+    # Further exception types a caller knows to be transient
+    retry_on: Tuple[Type[BaseException], ...] = ()
+
+    def is_retryable(self, error: BaseException) -> bool:
+        response = failed_response(error)
+        if response is not None:
+            return response.status_code in RETRYABLE_STATUSES
+        return isinstance(
+            error,
+            (
+                httpx.TransportError,
+                requests.ConnectionError,
+                requests.Timeout,
+                *self.retry_on,
+            ),
+        )
+
+    def delay(self, attempt: int, error: Optional[BaseException] = None) -> float:
+        """Seconds to wait after the given (0-based) failed attempt."""
+        response = failed_response(error) if error is not None else None
+        if response is not None:
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            if retry_after is not None:
+                return min(retry_after, self.max_retry_after)
+        # Full jitter keeps many workers failing together from retrying in step
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+
+DEFAULT_POLICY = RetryPolicy()
+
+
+class CircuitBreaker:
+    """Per-host circuit breaker, safe to share between threads and tasks."""
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures: Dict[str, int] = {}
+        self._opened_at: Dict[str, float] = {}
+        self._trials: set = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def host_of(url: str) -> str:
+        return urlsplit(url).netloc
+
+    def check(self, url: str) -> None:
+        """Raise CircuitOpenError if calls to the host of url are suspended."""
+        host = self.host_of(url)
+        with self._lock:
+            opened_at = self._opened_at.get(host)
+            if opened_at is None:
+                return
+            remaining = opened_at + self.reset_timeout - time.monotonic()
+            if remaining > 0 or host in self._trials:
+                raise CircuitOpenError(host, max(remaining, 0))
+            # Half-open: this call is the trial
+            self._trials.add(host)
+
+    def record_success(self, url: str) -> None:
+        host = self.host_of(url)
+        with self._lock:
+            self._failures.pop(host, None)
+            self._trials.discard(host)
+            if self._opened_at.pop(host, None) is not None:
+                logger.info(f"Circuit closed for {host}")
+
+    def release(self, url: str) -> None:
+        """End a call without judging the host, freeing its trial slot if held."""
+        with self._lock:
+            self._trials.discard(self.host_of(url))
+
+    def record_failure(self, url: str) -> None:
+        host = self.host_of(url)
+        with self._lock:
+            failures = self._failures.get(host, 0) + 1
+            self._failures[host] = failures
+            if failures >= self.failure_threshold or host in self._trials:
+                self._trials.discard(host)
+                self._opened_at[host] = time.monotonic()
+                logger.warning(
+                    f"Circuit opened for {host} after {failures} failures, "
+                    f"pausing calls for {self.reset_timeout:.0f}s"
+                )
+
+
+def _after_failure(
+    error: Exception,
+    attempt: int,
+    url: str,
+    policy: RetryPolicy,
+    breaker: Optional[CircuitBreaker],
+    log: logging.Logger,
+) -> float:
+    """Record a failed attempt and return the delay before the next, or raise."""
+    if not policy.is_retryable(error):
+        if breaker is not None:
+            # Not a sign of an unhealthy host (a 404, a 304, a bad payload),
+            # but not a success either: a pending failure streak stands
+            breaker.release(url)
+        raise error
+    if breaker is not None:
+        breaker.record_failure(url)
+    if attempt + 1 >= policy.max_attempts:
+        log.error(f"Giving up on {url} after {policy.max_attempts} attempts: {error}")
+        raise error
+    delay = policy.delay(attempt, error)
+    log.warning(
+        f"Attempt {attempt + 1}/{policy.max_attempts} for {url} failed: {error}. "
+        f"Retrying in {delay:.1f}s"
+    )
+    return delay
+
+
+async def retry_async(
+    operation: Callable[[], Awaitable[T]],
+    url: str,
+    policy: RetryPolicy = DEFAULT_POLICY,
+    breaker: Optional[CircuitBreaker] = None,
+    log: logging.Logger = logger,
+) -> T:
+    """Await operation() under the retry policy; the last error is re-raised."""
+    attempt = 0
+    while True:
+        if breaker is not None:
+            breaker.check(url)
+        try:
+            result = await operation()
+        except Exception as e:
+            await asyncio.sleep(_after_failure(e, attempt, url, policy, breaker, log))
+            attempt += 1
+            continue
+        if breaker is not None:
+            breaker.record_success(url)
+        return result
+
+
+def retry_sync(
+    operation: Callable[[], T],
+    url: str,
+    policy: RetryPolicy = DEFAULT_POLICY,
+    breaker: Optional[CircuitBreaker] = None,
+    log: logging.Logger = logger,
+) -> T:
+    """Blocking counterpart of retry_async, for requests-based clients."""
+    attempt = 0
+    while True:
+        if breaker is not None:
+            breaker.check(url)
+        try:
+            result = operation()
+        except Exception as e:
+            time.sleep(_after_failure(e, attempt, url, policy, breaker, log))
+            attempt += 1
+            continue
+        if breaker is not None:
+            breaker.record_success(url)
+        return result
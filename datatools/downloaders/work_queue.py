@@ -0,0 +1,345 @@
+"""
+Lease-based work queue shared by several download processes.
+
+``datatools download --shared-run <name>`` lets any number of processes, on
+one host or on several hosts mounting the same output volume, split one crawl.
+They all download into ``<source>/tmp_<name>`` and coordinate through
+``<source>/.queue_<name>.sqlite``:
+
+- Every process lists the work (datasets, aggregates, series) and adds it as
+  tasks; adding a task that exists is a no-op.
+- A task is worked on only by the process holding its lease. A heartbeat
+  thread renews the leases of live processes every ``lease_seconds / 3``; the
+  lease of a process that crashed expires and another process takes the task
+  over, until ``max_attempts`` is reached.
+- Once a process has nothing left to claim it waits for the other leases to
+  be released, picking up expired ones, so crashed work is never lost.
+- The last process to leave moves the run to its final timestamped directory.
+
+Each claim is a single SQLite statement, so it is atomic under SQLite's file
+locking. The database uses a rollback journal rather than WAL, which needs
+shared memory and does not work across hosts; the volume must support POSIX
+locks (local disks, NFSv4, most container volumes). Leases are wall-clock
+times, so hosts are expected to keep their clocks roughly in sync.
+"""
+
+import asyncio
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import AsyncIterator, ContextManager, Iterable, Iterator, Optional, Tuple
+from uuid import uuid4
+
+logger = logging.getLogger("downloader:queue")
+
+QUEUE_PREFIX = ".queue_"
+LEASE_SECONDS = 120.0
+MAX_ATTEMPTS = 3
+# How often an idle process checks for abandoned tasks
+POLL_SECONDS = 5.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    task TEXT PRIMARY KEY,
+    payload TEXT,
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status);
+CREATE TABLE IF NOT EXISTS workers (
+    worker TEXT PRIMARY KEY,
+    heartbeat_at REAL NOT NULL,
+    finished INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS run (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# Tasks nobody holds a live lease on
+CLAIMABLE = """
+    (status = 'pending'
+     OR (status = 'leased' AND lease_expires < :now AND attempts < :max_attempts))
+"""
+# Tasks named with a given prefix, for runs with several stages
+IN_STAGE = "substr(task, 1, length(:prefix)) = :prefix"
+
+
+def queue_path(source_dir: str, run_name: str) -> str:
+    return os.path.join(source_dir, f"{QUEUE_PREFIX}{run_name}.sqlite")
+
+
+def shared_run_active(source_dir: str) -> bool:
+    """Whether a shared run is downloading into source_dir (it has a queue)."""
+    try:
+        names = os.listdir(source_dir)
+    except FileNotFoundError:
+        return False
+    return any(
+        name.startswith(QUEUE_PREFIX) and name.endswith(".sqlite") for name in names
+    )
+
+
+class WorkQueue:
+    """Tasks of one shared run, claimed under expiring leases."""
+
+    def __init__(
+        self,
+        path: str,
+        lease_seconds: float = LEASE_SECONDS,
+        max_attempts: int = MAX_ATTEMPTS,
+    ):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.worker = f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+        # Shared with the heartbeat thread
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self._conn.execute("PRAGMA journal_mode=DELETE")
+        self._conn.executescript(SCHEMA)
+        self._stop = threading.Event()
+        self._heartbeat: Optional[threading.Thread] = None
+
+    def __enter__(self) -> "WorkQueue":
+        self.join()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _execute(self, query: str, params=()) -> sqlite3.Cursor:
+        with self._lock:
+            return self._conn.execute(query, params)
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def _params(self, **params) -> dict:
+        return {
+            "now": time.time(),
+            "worker": self.worker,
+            "expires": time.time() + self.lease_seconds,
+            "max_attempts": self.max_attempts,
+            **params,
+        }
+
+    def join(self) -> None:
+        """Register this process and start renewing its leases."""
+        self._execute(
+            "INSERT OR REPLACE INTO workers (worker, heartbeat_at) VALUES (?, ?)",
+            (self.worker, time.time()),
+        )
+        self._heartbeat = threading.Thread(
+            target=self._beat, name="work-queue-heartbeat", daemon=True
+        )
+        self._heartbeat.start()
+        logger.info(f"Joined shared run {self.path} as {self.worker}")
+
+    def _beat(self) -> None:
+        while not self._stop.wait(self.lease_seconds / 3):
+            try:
+                self.renew()
+            except sqlite3.Error as e:
+                logger.warning(f"Heartbeat failed: {e}")
+
+    def renew(self) -> None:
+        """Extend this process's leases and heartbeat."""
+        params = self._params()
+        with self._lock:
+            self._conn.execute(
+                "UPDATE tasks SET lease_expires = :expires "
+                "WHERE worker = :worker AND status = 'leased'",
+                params,
+            )
+            self._conn.execute(
+                "UPDATE workers SET heartbeat_at = :now WHERE worker = :worker",
+                params,
+            )
+
+    def add(self, tasks: Iterable[str], payloads: Optional[dict] = None) -> None:
+        """Add tasks not in the queue yet, with an optional payload each."""
+        payloads = payloads or {}
+        with self._transaction() as conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO tasks (task, payload) VALUES (?, ?)",
+                ((task, payloads.get(task)) for task in tasks),
+            )
+
+    def claim(self, task: str) -> bool:
+        """Lease a given task; False if it is done or leased by a live process."""
+        cursor = self._execute(
+            "UPDATE tasks SET status = 'leased', worker = :worker, "
+            "lease_expires = :expires, attempts = attempts + 1 "
+            f"WHERE task = :task AND {CLAIMABLE}",
+            self._params(task=task),
+        )
+        return cursor.rowcount == 1
+
+    def claim_next(self, prefix: str = "") -> Optional[Tuple[str, Optional[str]]]:
+        """Lease any claimable task under prefix; returns (task, payload) or None."""
+        self._give_up_abandoned()
+        with self._lock:
+            # Fetching every row runs the statement to completion and commits it
+            rows = self._conn.execute(
+                "UPDATE tasks SET status = 'leased', worker = :worker, "
+                "lease_expires = :expires, attempts = attempts + 1 "
+                "WHERE task = "
+                f"(SELECT task FROM tasks WHERE {CLAIMABLE} AND {IN_STAGE} LIMIT 1) "
+                "RETURNING task, payload",
+                self._params(prefix=prefix),
+            ).fetchall()
+        return (rows[0][0], rows[0][1]) if rows else None
+
+    def _give_up_abandoned(self) -> None:
+        """Fail expired tasks that have used up their attempts."""
+        self._execute(
+            "UPDATE tasks SET status = 'failed', error = 'lease expired' "
+            "WHERE status = 'leased' AND lease_expires < :now "
+            "AND attempts >= :max_attempts",
+            self._params(),
+        )
+
+    def complete(self, task: str) -> None:
+        self._execute(
+            "UPDATE tasks SET status = 'done', lease_expires = NULL, error = NULL "
+            "WHERE task = ?",
+            (task,),
+        )
+
+    def fail(self, task: str, error: str = "") -> None:
+        """Release a failed task: retried by any process until max_attempts."""
+        self._execute(
+            "UPDATE tasks SET worker = NULL, lease_expires = NULL, error = :error, "
+            "status = CASE WHEN attempts >= :max_attempts "
+            "THEN 'failed' ELSE 'pending' END "
+            "WHERE task = :task",
+            self._params(task=task, error=error),
+        )
+
+    @contextmanager
+    def working_on(self, task: str) -> Iterator[None]:
+        try:
+            yield
+        except Exception as e:
+            self.fail(task, str(e))
+            raise
+        self.complete(task)
+
+    def counts(self, prefix: str = "") -> dict:
+        rows = self._execute(
+            f"SELECT status, COUNT(*) FROM tasks WHERE {IN_STAGE} GROUP BY status",
+            {"prefix": prefix},
+        )
+        return dict(rows.fetchall())
+
+    def is_drained(self, prefix: str = "") -> bool:
+        """True once every task under prefix is done or failed."""
+        counts = self.counts(prefix)
+        return not counts.get("pending") and not counts.get("leased")
+
+    async def remaining(
+        self, prefix: str = ""
+    ) -> AsyncIterator[Tuple[str, Optional[str]]]:
+        """
+        Yield tasks under prefix left over by the other processes, leasing
+        each, until they are drained. Waits while live processes still hold
+        leases, since theirs become claimable if they crash.
+        """
+        while True:
+            claimed = await asyncio.to_thread(self.claim_next, prefix)
+            if claimed is not None:
+                yield claimed
+            elif await asyncio.to_thread(self.is_drained, prefix):
+                return
+            else:
+                await asyncio.sleep(POLL_SECONDS)
+
+    def leave(self) -> bool:
+        """
+        Deregister this process. Returns True for exactly one process: the
+        last live one, which then finalizes the run.
+        """
+        params = self._params(stale=time.time() - self.lease_seconds)
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE workers SET finished = 1 WHERE worker = :worker", params
+            )
+            others = conn.execute(
+                "SELECT COUNT(*) FROM workers WHERE finished = 0 "
+                "AND heartbeat_at >= :stale",
+                params,
+            ).fetchone()[0]
+            if others:
+                return False
+            conn.execute(
+                "INSERT OR IGNORE INTO run (key, value) "
+                "VALUES ('finalized_by', :worker)",
+                params,
+            )
+            finalizer = conn.execute(
+                "SELECT value FROM run WHERE key = 'finalized_by'"
+            ).fetchone()[0]
+        return finalizer == self.worker
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+        self._conn.close()
+
+
+def claim_task(queue: Optional[WorkQueue], task: str) -> bool:
+    """Whether this process should run task; always True without a queue."""
+    return queue is None or queue.claim(task)
+
+
+async def remaining(
+    queue: Optional[WorkQueue], prefix: str = ""
+) -> AsyncIterator[Tuple[str, Optional[str]]]:
+    """The tasks left over by other processes; none without a queue."""
+    if queue is None:
+        return
+    async for claimed in queue.remaining(prefix):
+        yield claimed
+
+
+def share_task(queue: Optional[WorkQueue], task: str, payload: Optional[str] = None):
+    """Add a task to the queue, if there is one."""
+    if queue is not None:
+        queue.add([task], {task: payload})
+
+
+def settle(queue: Optional[WorkQueue], task: str, success: bool, error: str = ""):
+    """Complete a leased task, or release it for a retry."""
+    if queue is None:
+        return
+    if success:
+        queue.complete(task)
+    else:
+        queue.fail(task, error)
+
+
+def working_on(queue: Optional[WorkQueue], task: str) -> ContextManager:
+    """Complete task when the block succeeds, release it for a retry if it raises."""
+    if queue is None:
+        return nullcontext()
+    return queue.working_on(task)
@@ -1,6 +1,7 @@
 import argparse
 
-from datatools.downloaders.downloaders import download_from_source
+from datatools.downloaders.downloaders import download_from_source, verify_download
+from datatools.downloaders.integrity import HASH_WORKERS
 from datatools.processor.processor import process_source
 
 
@@ -17,6 +18,62 @@ def main():
         default=4,
         help="Number of parallel workers for downloading (default: 4)",
     )
+    downloader_parser.add_argument(
+        "--segments",
+        type=int,
+        default=1,
+        help="Split large files into this many concurrent byte-range "
+        "downloads (DATASUS only, default: 1 = disabled)",
+    )
+    downloader_parser.add_argument(
+        "--segment-threshold-mb",
+        type=int,
+        default=512,
+        help="Minimum file size in MB for segmented downloads (default: 512)",
+    )
+    downloader_parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="DATASUS: revalidate finished files with conditional requests "
+        "instead of skipping them, linking unchanged ones. IBGE agregados and "
+        "IPEA: fetch everything again instead of reusing files from previous runs",
+    )
+    downloader_parser.add_argument(
+        "--parquet",
+        action="store_true",
+        help="Also write the downloaded data as partitioned Parquet tables "
+        "(IBGE agregados, IPEA values, DATASUS CSV/ZIP files and OpenAPI)",
+    )
+    downloader_parser.add_argument(
+        "--drop-raw",
+        action="store_true",
+        help="With --parquet, delete DATASUS CSV/ZIP files once they are "
+        "transcoded to Parquet",
+    )
+    downloader_parser.add_argument(
+        "--shared-run",
+        type=str,
+        metavar="NAME",
+        help="Split one download between every process started with the same "
+        "NAME on a shared output volume; crashed work is taken over by the "
+        "others (DATASUS, IBGE agregados and IPEA)",
+    )
+
+    verify_parser = subparser.add_parser(
+        "verify", help="Check a download run against its integrity manifest"
+    )
+    verify_parser.add_argument(
+        "--input",
+        type=str,
+        required=True,
+        help="Run directory, e.g. output/downloader/datasus/20250101_120000",
+    )
+    verify_parser.add_argument(
+        "--workers",
+        type=int,
+        default=HASH_WORKERS,
+        help=f"Files hashed in parallel (default: {HASH_WORKERS})",
+    )
 
     processor_parser = subparser.add_parser("process", help="")
     processor_parser.add_argument("--source", type=str, required=True, help="")
@@ -27,8 +84,20 @@ def main():
 
     if args.command == "download":
         download_from_source(
-            args.source, "output/downloader", args.skip, args.workers
+            args.source,
+            "output/downloader",
+            args.skip,
+            args.workers,
+            args.segments,
+            args.segment_threshold_mb,
+            args.refresh,
+            args.parquet,
+            not args.drop_raw,
+            args.shared_run,
         )
+    elif args.command == "verify":
+        if not verify_download(args.input, args.workers):
+            raise SystemExit(1)
     elif args.command == "process":
         process_source(args.source, args.input, f"{base_output_path}/processor")
     else:
@@ -3,10 +3,13 @@
 set -e
 
 if [ "$#" -lt 2 ]; then
-    echo "Usage: $0 [download|process|import] <source> [options]"
+    echo "Usage: $0 [download|verify|process|import] <source> [options]"
     echo ""
     echo "Commands:"
-    echo "  download <source> [workers]  - Download data from source (optional: number of workers, default: 4)"
+    echo "  download <source> [workers] [shared-run]"
+    echo "                               - Download data from source (optional: number of workers, default: 4;"
+    echo "                                 name of a run shared by several containers or hosts)"
+    echo "  verify <source> [timestamp]  - Check a download against its integrity manifest (default: latest)"
     echo "  process <source> [timestamp] - Process downloaded data (optional: specific timestamp)"
     echo "  import <source>              - Import processed data to Data Commons"
     exit 1
@@ -21,6 +24,10 @@ case $1 in
     download)
         flags="--rm"
         container_name=downloader_$2
+        # Containers joining a shared run can run side by side
+        if [ -n "$4" ]; then
+            container_name=downloader_$2_$4_$RANDOM
+        fi
         volumes="-v $downloader_output:/app/output/downloader"
         # image=ghcr.io/iscris/datatools:latest
         image=datatools
@@ -35,6 +42,26 @@ case $1 in
             echo "Starting download with default (4) parallel workers..."
         fi
 
+        if [ -n "$4" ]; then
+            command="$command --shared-run $4"
+            echo "Joining shared run $4..."
+        fi
+
+        docker run $flags --name $container_name $volumes $image $command
+        ;;
+    verify)
+        source_output=$downloader_output/$2
+        if [ -n "$3" ]; then
+            selected_timestamp=$3
+        else
+            selected_timestamp=$(ls -t $source_output | grep -v '^tmp_' | head -1)
+        fi
+
+        flags="--rm"
+        container_name=verify_$2
+        volumes="-v $source_output:/app/output/downloader/$2"
+        image=datatools
+        command="verify --input /app/output/downloader/$2/$selected_timestamp"
         docker run $flags --name $container_name $volumes $image $command
         ;;
     process)
@@ -63,7 +90,7 @@ case $1 in
         docker run $flags --name $container_name $volumes $env_vars $env_file $image
         ;;
     *)
-        echo "Invalid argument: $1. Use 'download', 'process', or 'import'."
+        echo "Invalid argument: $1. Use 'download', 'verify', 'process', or 'import'."
         exit 1
         ;;
 esac